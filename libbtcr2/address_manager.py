@@ -1,45 +1,152 @@
 import logging
+import time
 
 from buidl.tx import Tx, TxIn, TxOut
 
-from .constants import DEFAULT_TX_FEE, MAX_BTC_SUPPLY_SATOSHIS
+from .coin_selection import select_coins
+from .constants import DEFAULT_CONF_TARGET, DUST_LIMIT, MAX_BTC_SUPPLY_SATOSHIS
+from .fee_estimator import estimate_vsize, fee_for_vsize, input_weight, shared_fee_estimator
+from .metrics import REGISTRY
+from .utxo_pool import UTXOPool
 
 logger = logging.getLogger(__name__)
 
+UTXO_POOL_SIZE = REGISTRY.gauge(
+    "btcr2_utxo_pool_size", "Spendable UTXOs tracked by address managers", ["network"]
+)
+BROADCAST_DURATION = REGISTRY.histogram(
+    "btcr2_broadcast_duration_seconds", "Transaction broadcast latency", ["network", "kind"]
+)
+
+
+def output_tx_in(tx, index):
+    """A ``TxIn`` spending output ``index`` of ``tx``, with its value and script pubkey."""
+    tx_out = tx.tx_outs[index]
+    tx_in = TxIn(prev_tx=tx.hash(), prev_index=index)
+    tx_in._script_pubkey = tx_out.script_pubkey
+    tx_in._value = tx_out.amount
+    return tx_in
+
 
 class AddressManager:
-    def __init__(self, esplora_client, network, script_pubkey, signing_key, tx_fee=DEFAULT_TX_FEE):
+    def __init__(
+        self,
+        esplora_client,
+        network,
+        script_pubkey,
+        signing_key,
+        coin_selection=select_coins,
+        fee_estimator=None,
+    ):
         self.esplora_client = esplora_client
         self.network = network
         self.script_pubkey = script_pubkey
         self.address = script_pubkey.address(network)
         self.signing_key = signing_key
-        self.utxo_tx_ins = self.fetch_utxos()
-        self.tx_fee = tx_fee
+        self._tracked_utxo_count = 0
+        # Coin selection strategy, see coin_selection
+        self.coin_selection = coin_selection
+        self.utxos = UTXOPool()
+        # Fee rates by confirmation target, shared by the managers of an Esplora client
+        self.fee_estimator = fee_estimator or shared_fee_estimator(esplora_client)
+        self.refresh_utxos()
+
+    @property
+    def utxo_tx_ins(self):
+        """The tracked UTXOs as ``TxIn`` objects, including reserved ones."""
+        return list(self.utxos)
+
+    def fee_rate(self, conf_target=DEFAULT_CONF_TARGET):
+        """Fee rate in sat/vB for confirmation within ``conf_target`` blocks."""
+        return self.fee_estimator.fee_rate(conf_target)
+
+    def transaction_fee(self, input_count, tx_outs, fee_rate):
+        """Fee for a transaction spending ``input_count`` of this address's UTXOs to ``tx_outs``."""
+        return fee_for_vsize(estimate_vsize([self.script_pubkey] * input_count, tx_outs), fee_rate)
+
+    def track_utxo_pool(self):
+        """Report changes in the number of tracked UTXOs to the UTXO pool size gauge."""
+        count = len(self.utxos)
+        UTXO_POOL_SIZE.inc(count - self._tracked_utxo_count, labels=(str(self.network),))
+        self._tracked_utxo_count = count
 
     def fetch_utxos(self):
+        """
+        The address's UTXOs from Esplora, as ``(TxIn, confirmed)`` pairs, or None when they
+        could not be fetched.
+        """
         tx_ins = []
         try:
             utxos = self.esplora_client.get_address_utxos(self.address)
 
             logger.debug("utxos: %s", utxos)
-            # utxos = [utxo for utxo in utxos if utxo["status"]["confirmed"]]
             for utxo in utxos:
                 txid = bytes.fromhex(utxo["txid"])
                 prev_index = utxo["vout"]
-                logger.debug("txid: %s", txid)
-                logger.debug("prev_index: %s", prev_index)
-                logger.debug("value: %s", utxo["value"])
                 logger.debug("utxo: %s", utxo)
                 txin = TxIn(prev_tx=txid, prev_index=prev_index)
                 txin._script_pubkey = self.script_pubkey
                 txin._value = utxo["value"]
-                tx_ins.append(txin)
+                confirmed = (utxo.get("status") or {}).get("confirmed", True)
+                tx_ins.append((txin, confirmed))
             logger.info("Found %d UTXOs for %s", len(utxos), self.address)
         except Exception as e:
             logger.error("Error fetching UTXOs: %s", e)
+            return None
         return tx_ins
 
+    def refresh_utxos(self):
+        """
+        Replace the tracked UTXOs with the address's UTXOs. Reserved UTXOs are kept, and
+        those spent or taken since the pool last saw them are not added back while Esplora
+        still lists them. The pool is left as it is when Esplora cannot be reached.
+        """
+        utxos = self.fetch_utxos()
+        if utxos is None:
+            return
+        self.utxos.replace(utxos)
+        self.track_utxo_pool()
+
+    def ensure_utxos(self):
+        if self.utxos.available() == 0:
+            self.refresh_utxos()
+            if self.utxos.available() == 0:
+                raise Exception(f"No UTXOs, fund address {self.address}")
+
+    def take_utxo(self, min_value=0):
+        """
+        Remove and return the smallest UTXO worth at least ``min_value``, to be spent by a
+        transaction the caller builds, preferring confirmed UTXOs.
+        """
+        self.ensure_utxos()
+        tx_in = self.utxos.take(min_value)
+        if tx_in is None:
+            raise Exception(
+                f"Insufficient funds. No UTXO of {min_value} satoshis, fund address {self.address}"
+            )
+        self.track_utxo_pool()
+        return tx_in
+
+    def reserve_utxo(self, min_value=0):
+        """
+        Reserve and return the smallest UTXO worth at least ``min_value``, preferring
+        confirmed UTXOs, for a transaction the caller builds and broadcasts. Release it if
+        the transaction is not broadcast.
+        """
+        self.ensure_utxos()
+        tx_in = self.utxos.reserve_at_least(min_value)
+        if tx_in is None:
+            raise Exception(
+                f"Insufficient funds. No UTXO of {min_value} satoshis, fund address {self.address}"
+            )
+        return tx_in
+
+    def add_change(self, tx, index):
+        """Track output ``index`` of a transaction this manager broadcast as unconfirmed."""
+        tx_in = output_tx_in(tx, index)
+        self.utxos.add(tx_in, confirmed=False)
+        return tx_in
+
     def add_funding_tx(self, funding_tx):
         logger.info("Adding funding TX")
         for index, tx_out in enumerate(funding_tx.tx_outs):
@@ -47,14 +154,87 @@ class AddressManager:
             logger.debug("Comparing addresses: %s %s", self.address, addr)
             if self.address == addr:
                 logger.info("Found funding TXOUT")
-                tx_in = TxIn(prev_tx=funding_tx.hash(), prev_index=index)
-                tx_in._script_pubkey = tx_out.script_pubkey
-                tx_in._value = tx_out.amount
-                self.utxo_tx_ins.append(tx_in)
+                self.add_change(funding_tx, index)
+        self.track_utxo_pool()
+
+    def fan_out(self, count, value=None, conf_target=DEFAULT_CONF_TARGET, min_value=None):
+        """
+        Split this address's balance into ``count`` UTXOs in one transaction, so that many
+        transactions can spend from it concurrently instead of chaining through one change
+        output.
 
-    def send_to_address(self, script_pubkey, amount):
+        Each output gets ``value`` satoshis, an equal share of the balance by default; any
+        remainder above the dust limit is kept as one more output. Outputs must be worth at
+        least ``min_value``, by default enough to pay for a one-output transaction and keep
+        a change output above the dust limit. Returns the txid.
+        """
+        if count < 1:
+            raise ValueError("Fan-out count must be at least 1")
+
+        fee_rate = self.fee_rate(conf_target)
+        self.ensure_utxos()
+        keys = [key for _, key in self.utxos.candidates()]
+        tx_ins = self.utxos.reserve(keys)
+        try:
+            total_value = sum(tx_in.value() for tx_in in tx_ins)
+            # A fixed value may leave a remainder output, paid for whether or not it is kept
+            output_count = count if value is None else count + 1
+            tx_outs = [
+                TxOut(amount=0, script_pubkey=self.script_pubkey) for _ in range(output_count)
+            ]
+            tx_fee = self.transaction_fee(len(tx_ins), tx_outs, fee_rate)
+            spendable = total_value - tx_fee
+            if value is None:
+                value = spendable // count
+            if min_value is None:
+                # Every output must be able to pay for at least one transaction of its own
+                min_value = self.transaction_fee(1, tx_outs[:1], fee_rate) + DUST_LIMIT
+            if value < min_value:
+                raise Exception(
+                    f"Insufficient funds to fan out {count} UTXOs of {value} satoshis "
+                    f"from {total_value} satoshis"
+                )
+            remainder = spendable - value * count
+            if remainder < 0:
+                raise Exception(
+                    f"Insufficient funds. Need {value * count + tx_fee} satoshis, "
+                    f"but only have {total_value} satoshis"
+                )
+
+            for tx_out in tx_outs:
+                tx_out.amount = value
+            if output_count > count:
+                if remainder >= DUST_LIMIT:
+                    tx_outs[-1].amount = remainder
+                else:
+                    tx_outs.pop()
+            tx = Tx(version=1, tx_ins=tx_ins, tx_outs=tx_outs, network=self.network, segwit=True)
+            for index in range(len(tx.tx_ins)):
+                tx.sign_input(index, self.signing_key)
+
+            started = time.perf_counter()
+            tx_id = self.esplora_client.broadcast_tx(tx.serialize().hex())
+            BROADCAST_DURATION.observe(
+                time.perf_counter() - started, labels=(str(self.network), "fan_out")
+            )
+        except Exception:
+            self.utxos.release(keys)
+            raise
+        logger.info("Fanned out %d UTXOs of %d satoshis with txid %s", count, value, tx_id)
+
+        for key in keys:
+            self.utxos.remove(key)
+        for index in range(len(tx_outs)):
+            self.add_change(tx, index)
+        self.track_utxo_pool()
+        return tx_id
+
+    def send_to_address(self, script_pubkey, amount, conf_target=DEFAULT_CONF_TARGET):
+        """
+        Pay ``amount`` satoshis to ``script_pubkey`` at the fee rate for confirmation within
+        ``conf_target`` blocks, and return the txid.
+        """
         address = script_pubkey.address(network=self.network)
-        tx_fee = self.tx_fee  # satoshis
 
         # Validate amount
         if amount <= 0:
@@ -62,42 +242,48 @@ class AddressManager:
         if amount > MAX_BTC_SUPPLY_SATOSHIS:
             raise ValueError("Amount exceeds maximum Bitcoin supply")
 
-        if len(self.utxo_tx_ins) == 0:
-            self.utxo_tx_ins = self.fetch_utxos()
-            if len(self.utxo_tx_ins) == 0:
-                raise Exception(f"No UTXOs, fund address {self.address}")
+        fee_rate = self.fee_rate(conf_target)
+        self.ensure_utxos()
 
-        # Select UTXOs to spend
-        tx_ins = []
-        total_value = 0
-        for tx_in in self.utxo_tx_ins:
-            logger.debug("UTXO value: %d satoshis", tx_in.value())
-            total_value += tx_in.value()
-            tx_ins.append(tx_in)
-
-            if total_value >= amount + tx_fee:
-                break
+        # Select UTXOs by their value net of the fee for spending them
+        payment_out = TxOut(amount=amount, script_pubkey=script_pubkey)
+        refund_out = TxOut(amount=0, script_pubkey=self.script_pubkey)
+        input_fee = fee_for_vsize(input_weight(self.script_pubkey) / 4, fee_rate)
+        # Change pays for its output now and for being spent later, and must not be dust
+        cost_of_change = fee_for_vsize(len(refund_out.serialize()), fee_rate) + max(
+            input_fee, DUST_LIMIT
+        )
+        candidates = [
+            (value - input_fee, key) for value, key in self.utxos.candidates() if value > input_fee
+        ]
+        target = amount + self.transaction_fee(0, [payment_out], fee_rate)
+        keys = self.coin_selection(candidates, target, cost_of_change)
+        if keys is None:
+            raise Exception(
+                f"Insufficient funds. Need {amount} satoshis plus fees, "
+                f"but only have {self.utxos.total_value()} satoshis"
+            )
+        tx_ins = self.utxos.reserve(keys)
+        total_value = sum(tx_in.value() for tx_in in tx_ins)
 
         logger.info("Selected UTXOs with total value: %d satoshis", total_value)
         logger.info("Required amount: %d satoshis", amount)
-        logger.info("Transaction fee: %d satoshis", tx_fee)
-
-        if total_value < amount + tx_fee:
-            raise Exception(
-                f"Insufficient funds. Need {amount + tx_fee} satoshis, "
-                f"but only have {total_value} satoshis"
-            )
 
-        # Calculate refund amount
+        tx_fee = self.transaction_fee(len(tx_ins), [payment_out, refund_out], fee_rate)
         refund_amount = total_value - amount - tx_fee
-        if refund_amount < 0:
-            raise Exception("Transaction fee would make refund amount negative")
+        if refund_amount < DUST_LIMIT:
+            # Excess too small for a change output is left to the fee
+            tx_fee = total_value - amount
+            refund_amount = 0
+        logger.info("Transaction fee: %d satoshis at %.2f sat/vB", tx_fee, fee_rate)
 
         # Create transaction outputs
         logger.info("Creating output for %d satoshis to %s", amount, address)
-        txout = TxOut(amount=amount, script_pubkey=script_pubkey)
-        logger.info("Creating refund output for %d satoshis to %s", refund_amount, self.address)
-        refund_out = TxOut(amount=refund_amount, script_pubkey=self.script_pubkey)
+        tx_outs = [payment_out]
+        if refund_amount:
+            logger.info("Creating refund output for %d satoshis to %s", refund_amount, self.address)
+            refund_out.amount = refund_amount
+            tx_outs.append(refund_out)
 
         logger.info("Transaction details:")
         logger.info("Inputs: %d UTXOs totaling %d satoshis", len(tx_ins), total_value)
@@ -107,9 +293,7 @@ class AddressManager:
         logger.info("Fee: %d satoshis", tx_fee)
 
         # Create and sign transaction
-        tx = Tx(
-            version=1, tx_ins=tx_ins, tx_outs=[txout, refund_out], network=self.network, segwit=True
-        )
+        tx = Tx(version=1, tx_ins=tx_ins, tx_outs=tx_outs, network=self.network, segwit=True)
 
         for index in range(len(tx.tx_ins)):
             tx.sign_input(index, self.signing_key)
@@ -117,16 +301,22 @@ class AddressManager:
         # Broadcast transaction
         tx_hex = tx.serialize().hex()
         try:
+            started = time.perf_counter()
             tx_id = self.esplora_client.broadcast_tx(tx_hex)
+            BROADCAST_DURATION.observe(
+                time.perf_counter() - started, labels=(str(self.network), "payment")
+            )
             logger.info("Sent %d to %s with txid %s", amount, address, tx_id)
-            # Refresh UTXOs after successful broadcast
-            new_utxo_txin = TxIn(prev_tx=tx.hash(), prev_index=0)
-            new_utxo_txin._script_pubkey = refund_out.script_pubkey
-            new_utxo_txin._value = refund_out.amount
-            self.utxo_tx_ins.append(new_utxo_txin)
-
-            return tx_id
         except Exception as e:
             logger.error("Failed to broadcast transaction: %s", e)
             logger.debug("Transaction hex: %s", tx_hex)
+            self.utxos.release(keys)
             raise
+
+        # The inputs are spent; the refund (output 1) can be spent while unconfirmed
+        for key in keys:
+            self.utxos.remove(key)
+        if refund_amount:
+            self.add_change(tx, 1)
+        self.track_utxo_pool()
+        return tx_id
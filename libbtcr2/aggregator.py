@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import time
+
+import jcs
+from buidl.helper import sha256
+from ipfs_cid import cid_sha256_wrap_digest
+
+from .address_manager import BROADCAST_DURATION
+from .constants import (
+    CID_AGGREGATE_BEACON_TYPE,
+    DEFAULT_AGGREGATION_WINDOW,
+    DEFAULT_MAX_AGGREGATE_BATCH,
+    SMT_AGGREGATE_BEACON_TYPE,
+)
+from .did_manager import UPDATES_ANNOUNCED
+from .metrics import DEFAULT_COUNT_BUCKETS, REGISTRY
+from .service import CIDAggregateBeaconService, SMTAggregateBeaconService
+from .smt import SparseMerkleTree
+
+logger = logging.getLogger(__name__)
+
+AGGREGATE_BATCH_SIZE = REGISTRY.histogram(
+    "btcr2_aggregate_batch_size",
+    "DID updates announced per aggregate beacon signal",
+    ["network", "beacon_type"],
+    buckets=DEFAULT_COUNT_BUCKETS + (10000,),
+)
+
+
+class BeaconAggregator:
+    """
+    Announce the updates of many DIDs with one aggregate beacon signal per batch window.
+
+    DID managers ``register`` with the aggregator and ``submit`` updates, which are held
+    until the batch window closes (or ``max_batch_size`` updates are pending). The batch is
+    then committed in a single transaction from ``beacon_manager``'s address: the root of a
+    sparse Merkle tree over every member DID (``SMTAggregateBeacon``), or the hash of a bundle
+    mapping each updated DID to the CID of its update (``CIDAggregateBeacon``). Every member
+    gets the sidecar data for the signal in its ``signals_metadata``, including members with
+    no update in the batch, which need it to prove that to resolvers.
+
+    With a ``content_store``, CID bundles are published there instead of being copied into
+    the sidecar data of every member.
+    """
+
+    def __init__(
+        self,
+        beacon_manager,
+        beacon_type=SMT_AGGREGATE_BEACON_TYPE,
+        batch_window=DEFAULT_AGGREGATION_WINDOW,
+        max_batch_size=DEFAULT_MAX_AGGREGATE_BATCH,
+        content_store=None,
+    ):
+        if beacon_type not in (SMT_AGGREGATE_BEACON_TYPE, CID_AGGREGATE_BEACON_TYPE):
+            raise Exception(f"Unsupported aggregate beacon type: {beacon_type}")
+        self.beacon_manager = beacon_manager
+        self.beacon_type = beacon_type
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.content_store = content_store
+        # did -> DID manager, whose signals_metadata receives the sidecar data of each signal
+        self.members = {}
+        # did -> (secured update, update hash, future resolved with the signal txid)
+        self.pending = {}
+        self._timer = None
+        self._flushes = set()
+        # Batches are announced one at a time, each signal spending the previous one's change
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def address(self):
+        return self.beacon_manager.address
+
+    def beacon_service(self, did, ident="aggregateBeacon"):
+        """The beacon service a member adds to its DID document to use this aggregator."""
+        if self.beacon_type == SMT_AGGREGATE_BEACON_TYPE:
+            service_class = SMTAggregateBeaconService
+        else:
+            service_class = CIDAggregateBeaconService
+        return service_class.make(id=f"{did}#{ident}", service_endpoint=f"bitcoin:{self.address}")
+
+    def register(self, did, did_manager):
+        self.members[did] = did_manager
+
+    async def submit(self, did, secured_update):
+        """Queue ``did``'s update for the next batch and return the txid that announced it."""
+        if did not in self.members:
+            raise Exception(f"{did} is not a member of aggregate beacon {self.address}")
+        if did in self.pending:
+            # A signal can only announce one update per DID
+            raise Exception(f"Update already pending for {did}")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[did] = (secured_update, sha256(jcs.canonicalize(secured_update)), future)
+        if len(self.pending) >= self.max_batch_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_window, self._schedule_flush)
+        return await future
+
+    def _schedule_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        """
+        Publish the pending updates now; returns the signal txid, or None if none pending.
+        Waits for a flush already in progress, then publishes whatever is pending by then.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._flush_lock:
+            return await self._flush()
+
+    async def _flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return None
+
+        try:
+            # Building proofs for every member is CPU bound, broadcasting blocks on the network
+            commitment, metadata = await asyncio.to_thread(self.build_batch, batch)
+            signal_id = await asyncio.to_thread(self.broadcast_signal, commitment)
+        except Exception as e:
+            logger.error("Failed to announce aggregate batch of %d updates: %s", len(batch), e)
+            for _, _, future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return None
+
+        for did, did_metadata in metadata.items():
+            self.members[did].signals_metadata[signal_id] = did_metadata
+        network = str(self.beacon_manager.network)
+        UPDATES_ANNOUNCED.inc(len(batch), labels=(network,))
+        AGGREGATE_BATCH_SIZE.observe(len(batch), labels=(network, self.beacon_type))
+        logger.info("Aggregate beacon signal %s announced %d updates", signal_id, len(batch))
+
+        for _, _, future in batch.values():
+            if not future.done():
+                future.set_result(signal_id)
+        return signal_id
+
+    def build_batch(self, batch):
+        """
+        The 32-byte commitment for ``batch`` and the sidecar data of the signal for each
+        member DID.
+        """
+        metadata = {}
+        if self.beacon_type == SMT_AGGREGATE_BEACON_TYPE:
+            tree = SparseMerkleTree()
+            for did in self.members:
+                update_hash = batch[did][1] if did in batch else None
+                tree.set(did, os.urandom(32), update_hash)
+            commitment = tree.root()
+            for did in self.members:
+                metadata[did] = {"smtProof": tree.proof(did)}
+        else:
+            bundle = {
+                did: cid_sha256_wrap_digest(update_hash)
+                for did, (_, update_hash, _) in batch.items()
+            }
+            bundle_bytes = jcs.canonicalize(bundle)
+            commitment = sha256(bundle_bytes)
+            if self.content_store is not None:
+                self.content_store.put(bundle_bytes)
+            else:
+                for did in self.members:
+                    metadata[did] = {"aggregateBundle": bundle}
+
+        for did, (secured_update, _, _) in batch.items():
+            metadata.setdefault(did, {})["updatePayload"] = secured_update
+        return commitment, metadata
+
+    def broadcast_signal(self, commitment):
+        pending_signal = self.beacon_manager.construct_beacon_signal(commitment)
+        started = time.perf_counter()
+        try:
+            signed_tx = self.beacon_manager.sign_beacon_signal(pending_signal)
+            signal_id = self.beacon_manager.esplora_client.broadcast_tx(signed_tx.serialize().hex())
+        except Exception:
+            self.beacon_manager.finish_broadcast(pending_signal, False)
+            raise
+        self.beacon_manager.finish_broadcast(signed_tx, True)
+        BROADCAST_DURATION.observe(
+            time.perf_counter() - started,
+            labels=(str(self.beacon_manager.network), "aggregate_beacon_signal"),
+        )
+        return signal_id
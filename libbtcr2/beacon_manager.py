@@ -1,10 +1,18 @@
 import logging
 
 from buidl.script import ScriptPubKey
+from buidl.timelock import Sequence
 from buidl.tx import Tx, TxIn, TxOut
 
-from .address_manager import AddressManager
-from .constants import OP_RETURN
+from .address_manager import AddressManager, output_tx_in
+from .constants import (
+    DEFAULT_CONF_TARGET,
+    DUST_LIMIT,
+    INCREMENTAL_RELAY_FEE_RATE,
+    OP_RETURN,
+    RBF_SEQUENCE,
+)
+from .utxo_pool import UNCONFIRMED, outpoint
 
 logger = logging.getLogger(__name__)
 
@@ -14,40 +22,134 @@ class BeaconManager(AddressManager):
         self.beacon_id = beacon_id
         super().__init__(esplora_client, network, script_pubkey, signing_key)
 
-    def construct_beacon_signal(self, commitment_bytes):
+    def signal_fee(self, fee_rate):
+        """Fee for a beacon signal spending one UTXO of the beacon address at ``fee_rate``."""
+        signal_outs = [TxOut(0, self.script_pubkey), TxOut(0, ScriptPubKey([OP_RETURN, bytes(32)]))]
+        return self.transaction_fee(1, signal_outs, fee_rate)
+
+    def construct_beacon_signal(
+        self, commitment_bytes, tx_in=None, conf_target=DEFAULT_CONF_TARGET
+    ):
+        """
+        Build an unsigned beacon signal committing to ``commitment_bytes``, with its change
+        in output 0 and the fee for its virtual size at the rate for confirmation within
+        ``conf_target`` blocks.
+
+        By default the smallest tracked UTXO that covers the fee is reserved; pass the signed
+        signal to ``finish_broadcast`` once its broadcast is accepted or has failed, to spend
+        or release it. A caller passing ``tx_in`` chooses the input itself and keeps track of
+        the change.
+        """
         logger.debug(
             "Constructing beacon signal for %s, commitment: %s",
             self.beacon_id,
             commitment_bytes.hex(),
         )
-        if len(self.utxo_tx_ins) == 0:
-            raise Exception(f"No UTXOs, fund beacon address {self.address}")
-
-        tx_in = self.utxo_tx_ins.pop(0)
-
+        fee_rate = self.fee_rate(conf_target)
+        reserved = tx_in is None
+        if reserved:
+            tx_in = self.reserve_utxo(self.signal_fee(fee_rate) + DUST_LIMIT)
+        try:
+            return self._build_signal(commitment_bytes, tx_in, fee_rate)
+        except Exception:
+            if reserved:
+                self.utxos.release([outpoint(tx_in)])
+            raise
+
+    def _build_signal(self, commitment_bytes, tx_in, fee_rate):
         script_pubkey = ScriptPubKey([OP_RETURN, commitment_bytes])
 
         beacon_signal_txout = TxOut(0, script_pubkey)
 
-        tx_fee = self.tx_fee
+        refund_script_pubkey = self.script_pubkey
+        refund_out = TxOut(amount=0, script_pubkey=refund_script_pubkey)
+        tx_fee = self.transaction_fee(1, [refund_out, beacon_signal_txout], fee_rate)
 
         refund_amount = tx_in.value() - tx_fee
-
-        refund_script_pubkey = self.script_pubkey
-        refund_out = TxOut(amount=refund_amount, script_pubkey=refund_script_pubkey)
+        if refund_amount < DUST_LIMIT:
+            raise Exception(f"Insufficient funds, fund beacon address {self.address}")
+        refund_out.amount = refund_amount
+        # Signal replaceability, so a stuck signal can be fee bumped
+        tx_in.sequence = Sequence(RBF_SEQUENCE)
         tx_ins = [tx_in]
 
         tx_outs = [refund_out, beacon_signal_txout]
-        pending_beacon_signal = Tx(
-            version=1, tx_ins=tx_ins, tx_outs=tx_outs, network=self.network, segwit=True
-        )
+        return Tx(version=1, tx_ins=tx_ins, tx_outs=tx_outs, network=self.network, segwit=True)
+
+    def finish_broadcast(self, signed_signal, broadcast):
+        """
+        Spend the input reserved by ``construct_beacon_signal`` and track the change once the
+        signal is broadcast, or release the input when its broadcast failed.
+        """
+        spent = outpoint(signed_signal.tx_ins[0])
+        if not broadcast:
+            self.utxos.release([spent])
+            return
+        self.utxos.remove(spent)
+        self.add_change(signed_signal, 0)
+        self.track_utxo_pool()
+
+    def change_tx_in(self, signed_signal):
+        """The change output of a signed beacon signal, as an input for the next signal."""
+        return output_tx_in(signed_signal, 0)
+
+    def build_replacement(self, signed_signal, fee_rate):
+        """
+        A signed BIP 125 replacement for a beacon signal whose change this manager tracks,
+        see ``replacement_signal``.
+
+        Returns None when the signal's change was already spent, as the replacement would
+        evict the spending transaction, or when the input does not cover the higher fee. The
+        change is reserved until ``finish_replacement``.
+        """
+        change = outpoint(self.change_tx_in(signed_signal))
+        if self.utxos.state(change) != UNCONFIRMED:
+            logger.debug("Change of %s spent or untracked, not replacing", signed_signal.id())
+            return None
+        replacement = self.replacement_signal(signed_signal, fee_rate)
+        if replacement is not None:
+            self.utxos.reserve([change])
+        return replacement
+
+    def replacement_signal(self, signed_signal, fee_rate):
+        """
+        A signed BIP 125 replacement for a beacon signal: the same input and commitment, with
+        less change to pay ``fee_rate`` and at least the incremental relay fee more than the
+        signal did. None when the input does not cover the higher fee.
+        """
+        spent = signed_signal.tx_ins[0]
+        tx_in = TxIn(prev_tx=spent.prev_tx, prev_index=spent.prev_index, sequence=RBF_SEQUENCE)
+        tx_in._script_pubkey = self.script_pubkey
+        tx_in._value = spent.value()
+        refund_out = TxOut(amount=0, script_pubkey=self.script_pubkey)
+        beacon_signal_txout = TxOut(0, signed_signal.tx_outs[1].script_pubkey)
+        tx_outs = [refund_out, beacon_signal_txout]
 
-        new_utxo_txin = TxIn(prev_tx=pending_beacon_signal.hash(), prev_index=0)
-        new_utxo_txin._script_pubkey = refund_out.script_pubkey
-        new_utxo_txin._value = refund_out.amount
-        self.utxo_tx_ins.append(new_utxo_txin)
+        signal_fee = tx_in.value() - signed_signal.tx_outs[0].amount
+        tx_fee = max(
+            self.transaction_fee(1, tx_outs, fee_rate),
+            signal_fee + self.transaction_fee(1, tx_outs, INCREMENTAL_RELAY_FEE_RATE),
+        )
+        refund_amount = tx_in.value() - tx_fee
+        if refund_amount < DUST_LIMIT:
+            logger.warning("Insufficient funds to replace beacon signal %s", signed_signal.id())
+            return None
+        refund_out.amount = refund_amount
 
-        return pending_beacon_signal
+        replacement = Tx(
+            version=1, tx_ins=[tx_in], tx_outs=tx_outs, network=self.network, segwit=True
+        )
+        return self.sign_beacon_signal(replacement)
+
+    def finish_replacement(self, signed_signal, replacement, broadcast):
+        """Track the replacement's change instead of the signal's once it is broadcast."""
+        change = outpoint(self.change_tx_in(signed_signal))
+        if not broadcast:
+            self.utxos.release([change])
+            return
+        self.utxos.remove(change)
+        self.add_change(replacement, 0)
+        self.track_utxo_pool()
 
     def sign_beacon_signal(self, pending_signal):
 
@@ -0,0 +1,75 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from .constants import BLOCK_INDEX_CACHE_SIZE, BLOCK_INDEX_REORG_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class BlockTimeIndex:
+    """
+    Lazily built index of block times, used to turn a ``versionTime`` into a block height.
+
+    Block header timestamps are not monotonic, but every block's timestamp is greater than
+    the median time past (MTP) of the blocks before it, and the MTP never decreases. So once
+    a block's MTP has reached ``versionTime``, no later block can be at or before it, and the
+    first such height can be found by bisection.
+
+    Headers are fetched from Esplora ten at a time and cached, except those within
+    ``reorg_depth`` blocks of the tip, which could still be replaced.
+    """
+
+    def __init__(
+        self,
+        esplora_client,
+        cache_size=BLOCK_INDEX_CACHE_SIZE,
+        reorg_depth=BLOCK_INDEX_REORG_DEPTH,
+    ):
+        self.esplora_client = esplora_client
+        self.cache_size = cache_size
+        self.reorg_depth = reorg_depth
+        # height -> median time past
+        self.median_times = OrderedDict()
+        self._lock = threading.Lock()
+
+    def median_time(self, height, tip_height):
+        with self._lock:
+            median_time = self.median_times.get(height)
+            if median_time is not None:
+                self.median_times.move_to_end(height)
+                return median_time
+
+        blocks = self.esplora_client.get_blocks(height)
+        with self._lock:
+            for block in blocks:
+                if block["height"] <= tip_height - self.reorg_depth:
+                    self.median_times[block["height"]] = block["mediantime"]
+                    self.median_times.move_to_end(block["height"])
+            while len(self.median_times) > self.cache_size:
+                self.median_times.popitem(last=False)
+        for block in blocks:
+            if block["height"] == height:
+                return block["mediantime"]
+        raise Exception(f"Block {height} not found")
+
+    def height_bound(self, version_time):
+        """
+        Highest block height that can have a timestamp at or before ``version_time``.
+
+        Returns None when any block up to the current tip could.
+        """
+        tip_height = self.esplora_client.get_tip_height()
+        if self.median_time(tip_height, tip_height) < version_time:
+            return None
+
+        # Smallest height whose median time past is at or after version_time
+        low, high = 0, tip_height
+        while low < high:
+            middle = (low + high) // 2
+            if self.median_time(middle, tip_height) >= version_time:
+                high = middle
+            else:
+                low = middle + 1
+        logger.debug("versionTime %s bounded to block height %d", version_time, low)
+        return low
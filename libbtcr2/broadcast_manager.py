@@ -0,0 +1,374 @@
+import asyncio
+import contextlib
+import logging
+import math
+import random
+import time
+
+from .address_manager import BROADCAST_DURATION
+from .constants import (
+    BUMP_CONF_TARGET,
+    DEFAULT_BROADCAST_ATTEMPTS,
+    DEFAULT_BROADCAST_BACKOFF,
+    DEFAULT_BROADCAST_BACKOFF_MAX,
+    DEFAULT_CONF_TARGET,
+    DEFAULT_TIP_POLL_INTERVAL,
+    INCREMENTAL_RELAY_FEE_RATE,
+)
+from .esplora_client import is_retryable
+from .fee_estimator import shared_fee_estimator
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+BROADCAST = "broadcast"
+CONFIRMED = "confirmed"
+FAILED = "failed"
+
+# Esplora's blocks endpoint returns this many blocks per request
+BLOCKS_PER_PAGE = 10
+
+TRANSACTIONS_IN_FLIGHT = REGISTRY.gauge(
+    "btcr2_broadcast_transactions_in_flight",
+    "Transactions queued or awaiting confirmation by broadcast managers, by status",
+    ["network", "status"],
+)
+FEE_BUMPS = REGISTRY.counter(
+    "btcr2_fee_bumps", "Unconfirmed transactions replaced with a higher fee", ["network", "kind"]
+)
+
+
+class PendingTransaction:
+    """A transaction submitted to a ``BroadcastManager``, followed through its replacements."""
+
+    def __init__(self, tx, kind, fee_rate=None, replacer=None, on_replaced=None):
+        self.tx = tx
+        self.txid = tx.id()
+        # Every version broadcast, any of which may be the one to confirm
+        self.txids = [self.txid]
+        self.kind = kind
+        self.fee_rate = fee_rate
+        self.replacer = replacer
+        self.on_replaced = on_replaced
+        self.status = QUEUED
+        self.attempts = 0
+        self.retry_at = 0.0
+        # Tip height when the current version was broadcast, and the confirming block
+        self.broadcast_height = None
+        self.block_height = None
+        self.error = None
+        self.broadcast_event = asyncio.Event()
+        self.settled_event = asyncio.Event()
+
+    def __repr__(self):
+        return f"PendingTransaction({self.txid!r}, status={self.status})"
+
+
+class BroadcastManager:
+    """
+    Broadcast signed transactions and follow them until they confirm.
+
+    ``submit`` queues a transaction and ``process`` (run in the background by ``start``)
+    broadcasts the queue in submission order, so a transaction is never sent before the
+    parent queued ahead of it. Transient failures are retried with exponential backoff, up to
+    ``max_attempts`` attempts. Confirmations are found by a single block tip watcher that
+    reads the txids of every new block once, however many transactions are in flight, rather
+    than polling each transaction.
+
+    A transaction submitted with a ``replacer`` is reported to
+    ``replacer.finish_broadcast(tx, broadcast)`` once it is broadcast or given up on, so
+    that its input is spent or released. One still unconfirmed ``target_blocks`` after
+    its broadcast is replaced (BIP 125) by ``replacer.build_replacement(tx, fee_rate)``, at
+    the next-block fee rate and at least ``INCREMENTAL_RELAY_FEE_RATE`` above its last one.
+    ``replacer.finish_replacement(tx, replacement, broadcast)`` is then told whether the
+    replacement was accepted, and ``on_replaced(pending, old_txid)`` is called when it was.
+    Any version confirming settles the transaction. Reorganisations after a confirmation
+    are not followed.
+    """
+
+    def __init__(
+        self,
+        esplora_client,
+        network=None,
+        fee_estimator=None,
+        target_blocks=DEFAULT_CONF_TARGET,
+        poll_interval=DEFAULT_TIP_POLL_INTERVAL,
+        max_attempts=DEFAULT_BROADCAST_ATTEMPTS,
+        retry_backoff=DEFAULT_BROADCAST_BACKOFF,
+        clock=time.monotonic,
+    ):
+        self.esplora_client = esplora_client
+        self.network = network
+        self.fee_estimator = fee_estimator or shared_fee_estimator(esplora_client)
+        self.target_blocks = target_blocks
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.clock = clock
+        # Unsettled transactions in submission order, and by the txid of each of their versions
+        self.transactions = []
+        self._by_txid = {}
+        # Height of the last block scanned for confirmations; None while nothing is in flight
+        self.tip_height = None
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._wakeup = None
+
+    def submit(self, tx, kind="transaction", fee_rate=None, replacer=None, on_replaced=None):
+        """Queue a signed transaction for broadcast and return its ``PendingTransaction``."""
+        pending = PendingTransaction(tx, kind, fee_rate, replacer, on_replaced)
+        self.transactions.append(pending)
+        self._by_txid[pending.txid] = pending
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return pending
+
+    async def broadcast(self, tx, **kwargs):
+        """
+        Submit a transaction and return its ``PendingTransaction`` once it is broadcast.
+
+        Without a background task (see ``start``), failed attempts are retried here until the
+        transaction is broadcast or given up on, so that it is never broadcast later without
+        its caller knowing.
+        """
+        pending = self.submit(tx, **kwargs)
+        await self.process()
+        while pending.status == QUEUED:
+            if self._task is not None:
+                await pending.broadcast_event.wait()
+                break
+            await asyncio.sleep(self._retry_delay())
+            await self.process()
+        if pending.status == FAILED:
+            raise pending.error
+        return pending
+
+    async def wait_for_confirmation(self, pending):
+        """Wait until ``pending`` confirms and return the height of its block."""
+        await pending.settled_event.wait()
+        if pending.status == FAILED:
+            raise pending.error
+        return pending.block_height
+
+    async def process(self):
+        """
+        Broadcast queued transactions that are due, then scan any new blocks for
+        confirmations and replace the transactions stuck for ``target_blocks``.
+        Returns the transactions confirmed.
+        """
+        async with self._lock:
+            now = self.clock()
+            confirmed = []
+            for pending in list(self.transactions):
+                if pending.status != QUEUED:
+                    continue
+                if pending.retry_at > now:
+                    break
+                if not await asyncio.to_thread(self._broadcast, pending):
+                    # Later transactions may spend this one
+                    break
+                if pending.status == BROADCAST:
+                    pending.broadcast_event.set()
+                    continue
+                if pending.status == CONFIRMED:
+                    confirmed.append(pending)
+                self._settle(pending)
+
+            if any(pending.status == BROADCAST for pending in self.transactions):
+                scanned = await asyncio.to_thread(self._scan_blocks)
+                for pending in scanned:
+                    self._settle(pending)
+                confirmed.extend(scanned)
+                for pending in list(self.transactions):
+                    if self._stuck(pending):
+                        # Whatever happens, wait another target_blocks before trying again
+                        pending.broadcast_height = self.tip_height
+                        replaced = await asyncio.to_thread(self._replace, pending)
+                        if replaced is not None:
+                            self._replaced(pending, *replaced)
+            if not self.transactions:
+                # Rescanned from the tip of the next broadcast, not from here
+                self.tip_height = None
+            self._report_gauges()
+            return confirmed
+
+    def _broadcast(self, pending):
+        """
+        Broadcast ``pending``; False when it failed transiently and will be retried. One the
+        network already has in a block is confirmed straight away.
+        """
+        started = time.perf_counter()
+        try:
+            if self.tip_height is None:
+                # Confirmations are looked for in the blocks after this one
+                self.tip_height = self.esplora_client.get_tip_height()
+            self.esplora_client.broadcast_tx(pending.tx.serialize().hex())
+        except Exception as e:
+            known = None if self.tip_height is None else self._known_transaction(pending.txid)
+            if known is None:
+                pending.attempts += 1
+                pending.error = e
+                if is_retryable(e) and pending.attempts < self.max_attempts:
+                    backoff = min(
+                        DEFAULT_BROADCAST_BACKOFF_MAX, self.retry_backoff * 2**pending.attempts
+                    )
+                    pending.retry_at = self.clock() + random.uniform(backoff / 2, backoff)
+                    logger.warning(
+                        "Broadcast of %s failed (attempt %d), retrying: %s",
+                        pending.txid,
+                        pending.attempts,
+                        e,
+                    )
+                    return False
+                logger.error("Giving up broadcasting %s: %s", pending.txid, e)
+                pending.status = FAILED
+                if pending.replacer is not None:
+                    pending.replacer.finish_broadcast(pending.tx, False)
+                return True
+            status = known.get("status") or {}
+            if status.get("confirmed"):
+                # Broadcast before, e.g. by a run that stopped before seeing it confirm
+                if pending.replacer is not None:
+                    pending.replacer.finish_broadcast(pending.tx, True)
+                pending.status = CONFIRMED
+                pending.block_height = status.get("block_height")
+                return True
+        BROADCAST_DURATION.observe(
+            time.perf_counter() - started, labels=(str(self.network), pending.kind)
+        )
+        if pending.replacer is not None:
+            pending.replacer.finish_broadcast(pending.tx, True)
+        pending.status = BROADCAST
+        pending.broadcast_height = self.tip_height
+        logger.info("Broadcast %s %s", pending.kind, pending.txid)
+        return True
+
+    def _known_transaction(self, txid):
+        """
+        The network's record of ``txid``, e.g. broadcast by an earlier attempt, or None when
+        it does not have it.
+        """
+        try:
+            return self.esplora_client.get_transaction(txid)
+        except Exception:
+            return None
+
+    def _scan_blocks(self):
+        """Look for in-flight transactions in the blocks mined since the last scan."""
+        tip_height = self.esplora_client.get_tip_height()
+        confirmed = []
+        while self.tip_height < tip_height:
+            blocks = self.esplora_client.get_blocks(
+                min(tip_height, self.tip_height + BLOCKS_PER_PAGE)
+            )
+            blocks = sorted(
+                (block for block in blocks if block["height"] > self.tip_height),
+                key=lambda block: block["height"],
+            )
+            if not blocks:
+                break
+            for block in blocks:
+                for txid in self.esplora_client.get_block_txids(block["id"]):
+                    pending = self._by_txid.get(txid)
+                    if pending is not None and pending.status == BROADCAST:
+                        pending.status = CONFIRMED
+                        pending.txid = txid
+                        pending.block_height = block["height"]
+                        confirmed.append(pending)
+                self.tip_height = block["height"]
+        return confirmed
+
+    def _stuck(self, pending):
+        return (
+            pending.status == BROADCAST
+            and pending.replacer is not None
+            and self.tip_height - pending.broadcast_height >= self.target_blocks
+        )
+
+    def _replace(self, pending):
+        """
+        Broadcast a higher-fee replacement of ``pending``; returns it and its fee rate, or
+        None when there is none or it was rejected. Runs in a worker thread, so ``pending``
+        is updated by ``_replaced`` on the event loop thread.
+        """
+        fee_rate = self.fee_estimator.fee_rate(BUMP_CONF_TARGET)
+        if pending.fee_rate is not None:
+            fee_rate = max(fee_rate, pending.fee_rate + INCREMENTAL_RELAY_FEE_RATE)
+        try:
+            replacement = pending.replacer.build_replacement(pending.tx, fee_rate)
+        except Exception:
+            logger.exception("Error building a replacement for %s", pending.txid)
+            return None
+        if replacement is None:
+            logger.info("%s unconfirmed but cannot be replaced", pending.txid)
+            return None
+
+        try:
+            self.esplora_client.broadcast_tx(replacement.serialize().hex())
+        except Exception as e:
+            logger.warning("Replacement of %s rejected: %s", pending.txid, e)
+            pending.replacer.finish_replacement(pending.tx, replacement, False)
+            return None
+        pending.replacer.finish_replacement(pending.tx, replacement, True)
+        return replacement, fee_rate
+
+    def _replaced(self, pending, replacement, fee_rate):
+        old_txid = pending.txid
+        pending.tx = replacement
+        pending.txid = replacement.id()
+        pending.txids.append(pending.txid)
+        pending.fee_rate = fee_rate
+        self._by_txid[pending.txid] = pending
+        FEE_BUMPS.inc(labels=(str(self.network), pending.kind))
+        logger.info("Replaced %s with %s at %.2f sat/vB", old_txid, pending.txid, fee_rate)
+        if pending.on_replaced is not None:
+            pending.on_replaced(pending, old_txid)
+
+    def _settle(self, pending):
+        self.transactions.remove(pending)
+        for txid in pending.txids:
+            self._by_txid.pop(txid, None)
+        if pending.status == CONFIRMED:
+            logger.info("%s confirmed at %s", pending.txid, pending.block_height)
+        pending.broadcast_event.set()
+        pending.settled_event.set()
+
+    def start(self):
+        """Broadcast and watch for confirmations in a background task until ``stop``."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+            self._wakeup = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.process()
+            except Exception:
+                logger.exception("Broadcast manager")
+            self._wakeup.clear()
+            timeout = min(self.poll_interval, self._retry_delay())
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+
+    def _retry_delay(self):
+        """Seconds until the next broadcast attempt is due, infinite with nothing queued."""
+        # The first queued transaction holds back the rest until its retry is due
+        queued = next((p for p in self.transactions if p.status == QUEUED), None)
+        if queued is None:
+            return math.inf
+        return max(0.0, queued.retry_at - self.clock())
+
+    def _report_gauges(self):
+        for status in (QUEUED, BROADCAST):
+            count = sum(1 for pending in self.transactions if pending.status == status)
+            TRANSACTIONS_IN_FLIGHT.set(count, labels=(str(self.network), status))
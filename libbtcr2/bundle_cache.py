@@ -0,0 +1,69 @@
+import logging
+from collections import OrderedDict
+
+from ipfs_cid import cid_sha256_unwrap_digest
+
+from .constants import DEFAULT_BUNDLE_CACHE_SIZE
+from .metrics import record_cache_lookup
+from .singleflight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+def index_bundle(bundle):
+    """
+    Index a CID aggregate beacon bundle, a JSON object mapping each DID to the CID of its
+    update payload, as DID -> SHA-256 digest of the payload.
+    """
+    if not isinstance(bundle, dict):
+        raise Exception("InvalidAggregateBundle")
+    index = {}
+    for did, cid in bundle.items():
+        try:
+            index[did] = cid_sha256_unwrap_digest(cid)
+        except Exception as e:
+            raise Exception("InvalidAggregateBundle") from e
+    return index
+
+
+class CIDBundleCache:
+    """
+    Parsed CID aggregate beacon bundles, keyed by the hash a beacon signal commits to.
+
+    A bundle announces updates for every DID sharing the beacon, so it is fetched and indexed
+    once and then served to every resolution that meets the same signal. Concurrent requests
+    for a bundle that is not cached yet share a single fetch. Cached indexes are shared and
+    must not be mutated.
+    """
+
+    def __init__(self, cache_size=DEFAULT_BUNDLE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._indexes = OrderedDict()
+        self._inflight = AsyncSingleFlight()
+
+    def __contains__(self, bundle_hash):
+        return bundle_hash in self._indexes
+
+    async def get(self, bundle_hash, fetch):
+        """
+        The index of the bundle hashing to ``bundle_hash``, calling the coroutine function
+        ``fetch(bundle_hash)`` to retrieve the bundle on a miss.
+        """
+        index = self._indexes.get(bundle_hash)
+        record_cache_lookup("bundle", index is not None)
+        if index is not None:
+            self._indexes.move_to_end(bundle_hash)
+            return index
+        return await self._inflight.do(bundle_hash, self._load, bundle_hash, fetch)
+
+    async def _load(self, bundle_hash, fetch):
+        bundle = await fetch(bundle_hash)
+        index = index_bundle(bundle)
+        logger.debug("Indexed aggregate bundle %s for %d DIDs", bundle_hash.hex(), len(index))
+        self._indexes[bundle_hash] = index
+        if len(self._indexes) > self.cache_size:
+            self._indexes.popitem(last=False)
+        return index
+
+    def clear(self):
+        self._indexes.clear()
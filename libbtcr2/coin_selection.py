@@ -0,0 +1,119 @@
+import bisect
+import logging
+import random
+
+from .constants import BNB_MAX_TRIES
+
+logger = logging.getLogger(__name__)
+
+# A coin selection strategy is called with the available UTXOs as ascending
+# ``(value, outpoint)`` pairs, the ``target`` value and the ``cost_of_change``: how much
+# excess is cheaper to leave to the fee than to return as a change output. Values are
+# effective values, net of the fee for spending the UTXO, and the target is the amount plus
+# the fee of a transaction without inputs or change. It returns the selected outpoints, or
+# None when it finds no selection.
+
+
+def select_branch_and_bound(candidates, target, cost_of_change, max_tries=BNB_MAX_TRIES):
+    """
+    Search for inputs worth between ``target`` and ``target + cost_of_change``, so that no
+    change output is needed, preferring the least excess.
+
+    Depth-first over the UTXOs by descending value, including each before excluding it, and
+    pruning branches that overshoot the window or can no longer reach the target. Gives up
+    after ``max_tries`` steps.
+    """
+    utxos = candidates[::-1]
+    available = sum(value for value, _ in utxos)
+    if available < target:
+        return None
+
+    selection = []
+    value = 0
+    best = None
+    best_excess = None
+    index = 0
+    for _ in range(max_tries):
+        backtrack = False
+        if value + available < target or value > target + cost_of_change:
+            backtrack = True
+        elif value >= target:
+            excess = value - target
+            if best_excess is None or excess < best_excess:
+                best = list(selection)
+                best_excess = excess
+                if excess == 0:
+                    break
+            backtrack = True
+
+        if backtrack:
+            if not selection:
+                break
+            # Put back the UTXOs skipped since the last inclusion, then exclude that one
+            index -= 1
+            while index > selection[-1]:
+                available += utxos[index][0]
+                index -= 1
+            value -= utxos[index][0]
+            selection.pop()
+        else:
+            utxo_value = utxos[index][0]
+            available -= utxo_value
+            # Excluding a UTXO of the same value as an excluded predecessor repeats a search
+            if not selection or index - 1 == selection[-1] or utxo_value != utxos[index - 1][0]:
+                selection.append(index)
+                value += utxo_value
+        index += 1
+
+    if best is None:
+        return None
+    return [utxos[index][1] for index in best]
+
+
+def select_single_random_draw(candidates, target, cost_of_change, rng=random):
+    """
+    Add UTXOs in random order until they cover ``target`` plus a worthwhile change output,
+    settling for just ``target`` when all of them together do not.
+    """
+    shuffled = list(candidates)
+    rng.shuffle(shuffled)
+    selection = []
+    value = 0
+    for utxo_value, key in shuffled:
+        selection.append(key)
+        value += utxo_value
+        if value >= target + cost_of_change:
+            return selection
+    return selection if value >= target else None
+
+
+def select_largest_first(candidates, target, cost_of_change):
+    """Add the largest UTXOs until they cover ``target``: fewest inputs, most change."""
+    selection = []
+    value = 0
+    for utxo_value, key in reversed(candidates):
+        selection.append(key)
+        value += utxo_value
+        if value >= target:
+            return selection
+    return None
+
+
+def select_lowest_larger(candidates, target, cost_of_change):
+    """The single smallest UTXO covering ``target`` plus a worthwhile change output."""
+    position = bisect.bisect_left(candidates, (target + cost_of_change,))
+    return [candidates[position][1]] if position < len(candidates) else None
+
+
+def select_coins(candidates, target, cost_of_change):
+    """
+    Default strategy: a changeless branch-and-bound match if there is one, else the single
+    smallest sufficient UTXO (a bisection of the sorted candidates), else a single random
+    draw.
+    """
+    for strategy in (select_branch_and_bound, select_lowest_larger, select_single_random_draw):
+        selection = strategy(candidates, target, cost_of_change)
+        if selection is not None:
+            logger.debug("Selected %d UTXOs with %s", len(selection), strategy.__name__)
+            return selection
+    return None
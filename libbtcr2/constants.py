@@ -107,7 +107,85 @@ CAPABILITY_ACTION = "Write"
 # Bitcoin constants
 MAX_BTC_SUPPLY_SATOSHIS = 21000000 * 100000000
 BECH32_CHECKSUM_LEN = 6
+# Outputs below this many satoshis are dust (non-standard) for P2PKH, the strictest case
+DUST_LIMIT = 546
+# nSequence of inputs signalling that their transaction may be replaced (BIP 125)
+RBF_SEQUENCE = 0xFFFFFFFD
 
 # Configurable defaults
-DEFAULT_TX_FEE = 4000
 DEFAULT_FUNDING_AMOUNT = 0.2
+DEFAULT_ETAG_CACHE_SIZE = 1024
+
+# Esplora client resilience
+DEFAULT_REQUEST_TIMEOUT = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.25
+DEFAULT_RETRY_BACKOFF_MAX = 5
+DEFAULT_HEDGE_WORKERS = 8
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+LATENCY_WINDOW = 256
+MIN_LATENCY_SAMPLES = 20
+MAX_RETRY_AFTER = 60
+
+# Esplora request priorities, lower is served first
+INTERACTIVE_PRIORITY = 0
+BACKGROUND_PRIORITY = 1
+DEFAULT_RESOLVE_CONCURRENCY = 8
+
+# Test vector capture
+DEFAULT_VECTOR_BATCH_SIZE = 64
+
+# Traversal pipeline: blocks of beacon signals prefetched ahead of update verification
+DEFAULT_PIPELINE_DEPTH = 4
+
+# Block timestamp index used to bound versionTime traversals
+BLOCK_INDEX_CACHE_SIZE = 100000
+BLOCK_INDEX_REORG_DEPTH = 6
+
+# Version history: full documents kept every this many versions, patches in between
+HISTORY_CHECKPOINT_INTERVAL = 32
+
+# Content-addressed storage for initial documents and update payloads
+DEFAULT_CONTENT_CACHE_SIZE = 4096
+DEFAULT_CONTENT_FETCH_WORKERS = 8
+
+# SMT aggregate beacons: verifiers kept per root
+SMT_VERIFIER_CACHE_SIZE = 64
+
+# CID aggregate beacons: parsed bundles kept by the resolver
+DEFAULT_BUNDLE_CACHE_SIZE = 256
+
+# Aggregate beacon batching: seconds a batch stays open, and updates that close it early
+DEFAULT_AGGREGATION_WINDOW = 60
+DEFAULT_MAX_AGGREGATE_BATCH = 10000
+
+# Beacon signal queues: Bitcoin Core's default limit on unconfirmed ancestors (including the
+# transaction itself), and seconds between confirmation polls
+MEMPOOL_ANCESTOR_LIMIT = 25
+DEFAULT_CONFIRMATION_POLL_INTERVAL = 30
+# Seconds between checks whether the fee bump of a chain's last signal has finished
+CHAIN_CLAIM_INTERVAL = 0.05
+
+# Beacon signal scheduling: independent UTXO chains per beacon
+DEFAULT_SIGNAL_LANES = 4
+
+# Coin selection: branch-and-bound search steps
+BNB_MAX_TRIES = 100000
+
+# Fee estimation: seconds Esplora fee estimates are cached, default confirmation target in
+# blocks, sat/vB paid without estimates (Bitcoin Core's -fallbackfee) and the relay minimum
+DEFAULT_FEE_ESTIMATE_TTL = 60
+DEFAULT_CONF_TARGET = 6
+FALLBACK_FEE_RATE = 20.0
+MIN_RELAY_FEE_RATE = 1.0
+# sat/vB a replacement must pay on top of the fee of the transaction it replaces
+INCREMENTAL_RELAY_FEE_RATE = 1.0
+
+# Broadcast manager: seconds between block tip checks, attempts and backoff in seconds for
+# transient broadcast failures, and the confirmation target of fee bumps
+DEFAULT_TIP_POLL_INTERVAL = 30
+DEFAULT_BROADCAST_ATTEMPTS = 10
+DEFAULT_BROADCAST_BACKOFF = 5
+DEFAULT_BROADCAST_BACKOFF_MAX = 300
+BUMP_CONF_TARGET = 1
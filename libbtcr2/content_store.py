@@ -0,0 +1,258 @@
+import abc
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from buidl.helper import sha256
+from ipfs_cid import cid_sha256_wrap_digest
+
+from .constants import (
+    DEFAULT_CONTENT_CACHE_SIZE,
+    DEFAULT_CONTENT_FETCH_WORKERS,
+    DEFAULT_REQUEST_TIMEOUT,
+)
+from .metrics import record_cache_lookup
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class ContentStore(abc.ABC):
+    """
+    Content-addressed storage keyed by the SHA-256 digest of the content.
+
+    Backends implement ``_read`` and ``_write``; ``get`` verifies that whatever a backend
+    returns hashes to the requested digest, so a corrupt or malicious backend can only make
+    content unavailable, never substitute it.
+    """
+
+    read_only = False
+
+    def get(self, digest: bytes) -> bytes | None:
+        data = self._read(digest)
+        if data is None:
+            return None
+        if sha256(data) != digest:
+            logger.warning("Content from %r does not match digest %s", self, digest.hex())
+            return None
+        return data
+
+    def get_json(self, digest: bytes):
+        data = self.get(digest)
+        return None if data is None else json.loads(data)
+
+    def put(self, data: bytes) -> bytes:
+        """Store ``data`` and return its digest."""
+        if self.read_only:
+            raise Exception(f"Content store {self!r} is read-only")
+        digest = sha256(data)
+        self._write(digest, data)
+        return digest
+
+    @abc.abstractmethod
+    def _read(self, digest):
+        """The content stored under ``digest``, unverified, or None."""
+
+    @abc.abstractmethod
+    def _write(self, digest, data):
+        """Store ``data`` under ``digest``; only called on writable stores."""
+
+
+class FileSystemStore(ContentStore):
+    """Content stored as files named by hex digest under ``root``."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __repr__(self):
+        return f"FileSystemStore({self.root!r})"
+
+    def path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    def _read(self, digest):
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, digest, data):
+        path = self.path(digest)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        # Write then rename, so concurrent readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+class SQLiteStore(ContentStore):
+    """Content stored in a single SQLite database file."""
+
+    def __init__(self, path):
+        self.db_path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS content (digest BLOB PRIMARY KEY, data BLOB NOT NULL)"
+            )
+
+    def __repr__(self):
+        return f"SQLiteStore({self.db_path!r})"
+
+    def _read(self, digest):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM content WHERE digest = ?", (digest,)
+            ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def _write(self, digest, data):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO content (digest, data) VALUES (?, ?)", (digest, data)
+            )
+
+    def close(self):
+        self._connection.close()
+
+
+class GatewayStore(ContentStore):
+    """
+    Read-only store backed by an IPFS HTTP gateway.
+
+    Content is requested as a raw block (``/ipfs/<cid>?format=raw``) for the CIDv1 that wraps
+    the digest, so any trustless gateway, or a local stand-in serving the same paths, works.
+    """
+
+    read_only = True
+
+    def __init__(self, base_url, timeout=DEFAULT_REQUEST_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def __repr__(self):
+        return f"GatewayStore({self.base_url!r})"
+
+    def _read(self, digest):
+        cid = cid_sha256_wrap_digest(digest)
+        response = self.session.get(
+            f"{self.base_url}/ipfs/{cid}",
+            params={"format": "raw"},
+            headers={"Accept": "application/vnd.ipld.raw"},
+            timeout=self.timeout,
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.content
+
+    def _write(self, digest, data):
+        raise Exception(f"Content store {self!r} is read-only")
+
+
+class CachingStore(ContentStore):
+    """
+    Read-through cache over a list of stores, tried in order.
+
+    Verified content is kept in an in-memory LRU of ``cache_size`` entries and written back
+    to the writable stores ahead of the one it was found in, so e.g. a local SQLite store in
+    front of a gateway fills up as content is resolved. Concurrent reads of the same digest
+    share one lookup, and ``get_many`` fetches several digests concurrently.
+    """
+
+    def __init__(
+        self,
+        stores,
+        cache_size=DEFAULT_CONTENT_CACHE_SIZE,
+        max_workers=DEFAULT_CONTENT_FETCH_WORKERS,
+    ):
+        self.stores = list(stores)
+        self.cache_size = cache_size
+        self.max_workers = max_workers
+        self.cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = SingleFlight()
+        self._executor = None
+
+    def __repr__(self):
+        return f"CachingStore({self.stores!r})"
+
+    @property
+    def read_only(self):
+        return all(store.read_only for store in self.stores)
+
+    def get(self, digest: bytes) -> bytes | None:
+        data = self._lookup(digest)
+        if data is not None:
+            self._remember(digest, data)
+        return data
+
+    def get_many(self, digests) -> dict:
+        """Fetch several digests concurrently; returns digest -> content or None."""
+        digests = list(dict.fromkeys(digests))
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="content-store"
+                )
+            executor = self._executor
+        results = dict(zip(digests, executor.map(self._lookup, digests), strict=True))
+        # Cached in request order, whatever order the lookups completed in
+        for digest, data in results.items():
+            if data is not None:
+                self._remember(digest, data)
+        return results
+
+    def _read(self, digest):
+        return self._lookup(digest)
+
+    def _write(self, digest, data):
+        store = next(store for store in self.stores if not store.read_only)
+        store._write(digest, data)
+        self._remember(digest, data)
+
+    def _lookup(self, digest):
+        with self._lock:
+            data = self.cache.get(digest)
+        record_cache_lookup("content", data is not None)
+        if data is not None:
+            return data
+        return self._inflight.do(digest, self._load, digest)
+
+    def _load(self, digest):
+        for index, store in enumerate(self.stores):
+            try:
+                data = store.get(digest)
+            except (OSError, requests.RequestException, sqlite3.Error) as e:
+                logger.warning("Content store %r failed for %s: %s", store, digest.hex(), e)
+                continue
+            if data is None:
+                continue
+            for earlier in self.stores[:index]:
+                if not earlier.read_only:
+                    earlier.put(data)
+            return data
+        return None
+
+    def _remember(self, digest, data):
+        with self._lock:
+            self.cache[digest] = data
+            self.cache.move_to_end(digest)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
@@ -0,0 +1,32 @@
+import contextvars
+import time
+
+from .error import DeadlineExceededError
+
+# time.monotonic() deadline of the operation running in the current context, if any. Set by
+# the resolver from the ``timeout`` resolution option and honored by the Esplora client.
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+def remaining_time():
+    """Seconds left before the current deadline, or None when there is no deadline."""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline():
+    """Raise DeadlineExceededError if the current deadline has passed."""
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError()
+
+
+def bounded_timeout(timeout):
+    """``timeout`` capped to the time left before the current deadline."""
+    check_deadline()
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    return remaining if timeout is None else min(timeout, remaining)
@@ -1,42 +1,58 @@
 import json
 import logging
+import time
 
 import jcs
 from buidl.helper import sha256
 from buidl.script import address_to_script_pubkey
 
+from .address_manager import BROADCAST_DURATION
 from .beacon_manager import BeaconManager
+from .broadcast_manager import BroadcastManager
 from .constants import EXTERNAL, NETWORKS, PLACEHOLDER_DID, VERSIONS
 from .did import encode_identifier
 from .diddoc.builder import Btcr2DIDDocumentBuilder
 from .diddoc.doc import Btcr2Document, IntermediateBtcr2DIDDocument
 from .diddoc.updater import Btcr2DIDDocumentUpdater
 from .esplora_client import EsploraClient
+from .metrics import REGISTRY
 from .network_config import DEFAULT_NETWORK_DEFINITIONS
+from .signal_queue import BeaconSignalQueue, BeaconSignalScheduler
 
 logger = logging.getLogger(__name__)
 
+UPDATES_ANNOUNCED = REGISTRY.counter(
+    "btcr2_updates_announced", "DID updates announced via beacon signals", ["network"]
+)
+
 
 class DIDManager:
     def __init__(self, did_network, btc_network=None, esplora_base=None):
         self.pending_updates = []
         self.initial_document = None
         self.beacon_managers = {}
+        # beacon_id -> BeaconAggregator announcing this DID's updates via an aggregate beacon
+        self.aggregators = {}
+        # beacon_id -> BeaconSignalQueue (or BeaconSignalScheduler) publishing its signals
+        self.signal_queues = {}
+        # BroadcastManager for signals announced directly, when one is used
+        self.broadcast_manager = None
         self.did = None
         self.did_network = did_network
 
         default_network_definition = DEFAULT_NETWORK_DEFINITIONS.get(self.did_network, {})
 
         logger.info("Initializing DID Manager for network: %s", self.did_network)
+        network_definition = dict(default_network_definition)
         if default_network_definition:
             if btc_network is None:
                 self.btc_network = default_network_definition.get("btc_network")
             logger.info("Using Bitcoin network: %s", btc_network)
-            if esplora_base is None:
-                esplora_base = default_network_definition.get("esplora_api")
-            logger.info("Using Esplora API: %s", esplora_base)
+        if esplora_base is not None:
+            network_definition["esplora_api"] = esplora_base
+        logger.info("Using Esplora API: %s", network_definition.get("esplora_api"))
 
-        self.esplora_client = EsploraClient(esplora_base)
+        self.esplora_client = EsploraClient.from_network_definition(network_definition)
 
     async def create_deterministic(self, initial_sk, network="bitcoin", identifierVersion=1):
         if network not in NETWORKS:
@@ -112,6 +128,11 @@ class DIDManager:
 
     async def announce_update(self, beacon_id, secured_update):
         logger.info("Announcing update via beacon %s", beacon_id)
+        aggregator = self.aggregators.get(beacon_id)
+        if aggregator is not None:
+            # Waits for the batch to be published; the aggregator fills in signals_metadata
+            return await aggregator.submit(self.did, secured_update)
+
         beacon_manager = self.beacon_managers.get(beacon_id)
 
         if not beacon_manager:
@@ -119,11 +140,45 @@ class DIDManager:
 
         update_hash = sha256(jcs.canonicalize(secured_update))
 
-        pending_beacon_signal = beacon_manager.construct_beacon_signal(update_hash)
+        signal_queue = self.signal_queues.get(beacon_id)
+        if signal_queue is not None:
+            signal_id = await signal_queue.announce(update_hash)
+            UPDATES_ANNOUNCED.inc(labels=(str(self.did_network),))
+            self.signals_metadata[signal_id] = {"updatePayload": secured_update}
+            return signal_id
 
-        signed_tx = beacon_manager.sign_beacon_signal(pending_beacon_signal)
+        pending_beacon_signal = beacon_manager.construct_beacon_signal(update_hash)
 
-        signal_id = self.esplora_client.broadcast_tx(signed_tx.serialize().hex())
+        try:
+            signed_tx = beacon_manager.sign_beacon_signal(pending_beacon_signal)
+        except Exception:
+            beacon_manager.finish_broadcast(pending_beacon_signal, False)
+            raise
+
+        if self.broadcast_manager is not None:
+            # The broadcast manager tells the beacon manager whether the signal was broadcast
+            pending = await self.broadcast_manager.broadcast(
+                signed_tx,
+                kind="beacon_signal",
+                fee_rate=beacon_manager.fee_rate(),
+                replacer=beacon_manager,
+                on_replaced=self.signal_replaced,
+            )
+            UPDATES_ANNOUNCED.inc(labels=(str(self.did_network),))
+            self.signals_metadata[pending.txid] = {"updatePayload": secured_update}
+            return pending.txid
+
+        started = time.perf_counter()
+        try:
+            signal_id = self.esplora_client.broadcast_tx(signed_tx.serialize().hex())
+        except Exception:
+            beacon_manager.finish_broadcast(signed_tx, False)
+            raise
+        beacon_manager.finish_broadcast(signed_tx, True)
+        BROADCAST_DURATION.observe(
+            time.perf_counter() - started, labels=(str(self.did_network), "beacon_signal")
+        )
+        UPDATES_ANNOUNCED.inc(labels=(str(self.did_network),))
         logger.info("Beacon signal broadcast with txid: %s", signal_id)
 
         self.signals_metadata[signal_id] = {"updatePayload": secured_update}
@@ -142,6 +197,55 @@ class DIDManager:
             raise Exception("Error announcing")
         return self.document
 
+    def join_aggregate_beacon(self, beacon_id, aggregator):
+        """Announce updates via ``beacon_id`` through the shared ``BeaconAggregator``."""
+        if beacon_id in self.aggregators or beacon_id in self.beacon_managers:
+            raise Exception("Beacon already exists")
+        if self.did is None:
+            raise Exception("Create the DID before joining an aggregate beacon")
+
+        self.aggregators[beacon_id] = aggregator
+        aggregator.register(self.did, self)
+        logger.debug("Joined aggregate beacon %s at %s", beacon_id, aggregator.address)
+
+    def use_signal_queue(self, beacon_id, state_path=None, lanes=1, **kwargs):
+        """
+        Announce updates via ``beacon_id`` through a ``BeaconSignalQueue``, so several can be
+        published per block; ``state_path`` persists the signals in flight. With more than
+        one lane, a ``BeaconSignalScheduler`` spreads them over independent UTXO chains and
+        ``state_path`` is the folder for the lanes' state.
+        """
+        beacon_manager = self.beacon_managers.get(beacon_id)
+        if not beacon_manager:
+            raise Exception("InvalidBeacon")
+        signal_queue = self.signal_queues.get(beacon_id)
+        if signal_queue is None:
+            if lanes > 1:
+                signal_queue = BeaconSignalScheduler(beacon_manager, lanes, state_path, **kwargs)
+            else:
+                signal_queue = BeaconSignalQueue(beacon_manager, state_path, **kwargs)
+            self.signal_queues[beacon_id] = signal_queue
+        return signal_queue
+
+    def use_broadcast_manager(self, broadcast_manager=None, **kwargs):
+        """
+        Broadcast the signals announced directly (not through a signal queue or aggregator)
+        with a ``BroadcastManager``, which retries failed broadcasts, watches for their
+        confirmation and fee bumps stuck signals. Pass one to share it between DID managers.
+        """
+        if broadcast_manager is None:
+            broadcast_manager = BroadcastManager(
+                self.esplora_client, network=self.did_network, **kwargs
+            )
+        self.broadcast_manager = broadcast_manager
+        return broadcast_manager
+
+    def signal_replaced(self, pending, old_txid):
+        """Keep the sidecar data of a fee-bumped signal under its new txid."""
+        metadata = self.signals_metadata.pop(old_txid, None)
+        if metadata is not None:
+            self.signals_metadata[pending.txid] = metadata
+
     def add_beacon_manager(self, beacon_id, initial_sk, script_pubkey):
         if beacon_id in self.beacon_managers:
             raise Exception("Beacon already exists")
@@ -1,3 +1,8 @@
 class InvalidDidError(Exception):
     def __init__(self, message="invalidDid"):
         super().__init__(message)
+
+
+class DeadlineExceededError(Exception):
+    def __init__(self, message="deadlineExceeded"):
+        super().__init__(message)
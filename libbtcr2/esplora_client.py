@@ -1,25 +1,523 @@
+import contextvars
+import json as jsonlib
 import logging
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
 
 import requests
+from urllib3.util.request import ACCEPT_ENCODING
+
+from .constants import (
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    CIRCUIT_BREAKER_RESET_TIMEOUT,
+    DEFAULT_ETAG_CACHE_SIZE,
+    DEFAULT_HEDGE_WORKERS,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_REQUEST_TIMEOUT,
+    DEFAULT_RETRY_BACKOFF,
+    DEFAULT_RETRY_BACKOFF_MAX,
+    LATENCY_WINDOW,
+    MAX_RETRY_AFTER,
+    MIN_LATENCY_SAMPLES,
+)
+from .deadline import bounded_timeout, check_deadline, remaining_time
+from .error import DeadlineExceededError
+from .instrumentation import record_transfer_bytes
+from .metrics import REGISTRY, record_cache_lookup
+from .rate_limiter import TokenBucket, request_priority
+from .singleflight import SingleFlight
+from .tracing import start_span
 
 logger = logging.getLogger(__name__)
 
+TOO_MANY_REQUESTS = 429
+RETRYABLE_STATUS_CODES = {TOO_MANY_REQUESTS, 500, 502, 503, 504}
 
-class EsploraClient:
-    def __init__(self, base_url: str):
+HTTP_REQUESTS = REGISTRY.counter(
+    "esplora_requests",
+    "Esplora HTTP requests by backend, route and status",
+    ["endpoint", "route", "status"],
+)
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "esplora_request_duration_seconds",
+    "Esplora HTTP request latency by backend and route",
+    ["endpoint", "route"],
+)
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker.
+
+    Opens after ``failure_threshold`` consecutive failures, so the endpoint is skipped while
+    other endpoints are available. After ``reset_timeout`` seconds it half-opens and lets a
+    single trial request through; its success closes the breaker, its failure re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+        reset_timeout=CIRCUIT_BREAKER_RESET_TIMEOUT,
+        clock=time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        # Thread sending the half-open trial request, while it is in flight
+        self._prober = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def available(self):
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and self._prober is None)
+
+    def acquire(self):
+        """Admit a request, claiming the half-open trial; False while the trial is in flight."""
+        with self._lock:
+            if self.state != self.HALF_OPEN:
+                return True
+            if self._prober is not None:
+                return False
+            self._prober = threading.get_ident()
+            return True
+
+    def release(self):
+        """End this thread's trial request whatever its outcome, e.g. when throttled."""
+        with self._lock:
+            if self._prober == threading.get_ident():
+                self._prober = None
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._prober = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._prober = None
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                # A failed half-open trial re-opens the breaker for another cool-down.
+                self.opened_at = self.clock()
+
+
+class EsploraEndpoint:
+    """One Esplora backend: its base URL, circuit breaker and recent latency samples."""
+
+    def __init__(self, base_url, breaker=None, latency_window=LATENCY_WINDOW):
         self.base_url = base_url
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=latency_window)
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+
+    def latency_percentile(self, percentile):
+        """The given percentile of recent successful request latencies, or None if too few."""
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        samples = sorted(self.latencies)
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+    def __repr__(self):
+        return f"EsploraEndpoint({self.base_url!r}, state={self.breaker.state})"
+
+
+def retry_after_seconds(response) -> float | None:
+    """Parse a Retry-After header given either as delay seconds or as an HTTP date."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+def is_retryable(error):
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is not None and response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class EsploraClient:
+    def __init__(
+        self,
+        base_url: str | list[str],
+        etag_cache_size: int = DEFAULT_ETAG_CACHE_SIZE,
+        timeout: float = DEFAULT_REQUEST_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+        hedge_percentile: float | None = None,
+        rate_limiter: TokenBucket | None = None,
+        coalesce_requests: bool = True,
+        tracer=None,
+    ):
+        """
+        Args:
+            base_url: An Esplora API base URL, or a list of equivalent backends in order of
+                preference. Requests fail over to the next backend on timeouts, connection
+                errors and 5xx responses.
+            etag_cache_size: Maximum number of revalidatable GET responses kept in memory.
+            timeout: Per-request timeout in seconds.
+            max_retries: Retries after the first attempt, with jittered exponential backoff.
+            retry_backoff: Base backoff in seconds between retries.
+            hedge_percentile: When set (e.g. 95), a GET that has not completed within this
+                percentile of the primary backend's recent latency is also sent to the next
+                backend, and the first response wins.
+            rate_limiter: Optional token bucket shared by all requests of this client. Waiting
+                requests are served by the ``request_priority`` of the calling context, and
+                a 429 Retry-After pauses the bucket.
+            coalesce_requests: Share one in-flight GET between concurrent identical calls.
+            tracer: OpenTelemetry-compatible tracer for request spans; falls back to the
+                global tracer.
+        """
+        base_urls = list(base_url) if isinstance(base_url, (list, tuple)) else [base_url]
+        if not base_urls:
+            raise ValueError("At least one Esplora base URL is required")
+        self.endpoints = [EsploraEndpoint(url) for url in base_urls]
+        self.base_url = self.endpoints[0].base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.hedge_percentile = hedge_percentile
+        self.rate_limiter = rate_limiter
+        self.coalesce_requests = coalesce_requests
+        self.tracer = tracer
+        self._inflight = SingleFlight()
         self.session = requests.Session()
+        # Advertise every content coding urllib3 can decode (gzip/deflate, plus br/zstd when
+        # the optional decoders are installed).
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        self.etag_cache_size = etag_cache_size
+        # url -> (validators, body) for responses that carried an ETag or Last-Modified
+        self.etag_cache = OrderedDict()
+        self.transfer_stats = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @classmethod
+    def from_network_definition(cls, network_definition: dict, tracer=None) -> "EsploraClient":
+        """
+        Build a client from a network definition (see ``network_config``).
+
+        ``esplora_api`` may be a single URL or a list of backends. The optional keys
+        ``request_timeout``, ``max_retries`` and ``hedge_percentile`` tune the client, and
+        ``rate_limit`` (``{"rate": requests_per_second, "burst": tokens}``) enables
+        client-side rate limiting.
+        """
+        return cls(
+            network_definition.get("esplora_api"),
+            timeout=network_definition.get("request_timeout", DEFAULT_REQUEST_TIMEOUT),
+            max_retries=network_definition.get("max_retries", DEFAULT_MAX_RETRIES),
+            hedge_percentile=network_definition.get("hedge_percentile"),
+            rate_limiter=TokenBucket.from_config(network_definition.get("rate_limit")),
+            tracer=tracer,
+        )
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.session.close()
 
     def _make_request(
-        self, method: str, endpoint: str, params: dict | None = None, json: dict | None = None
+        self,
+        method: str,
+        endpoint: str,
+        params: dict | None = None,
+        json: dict | None = None,
+        route: str | None = None,
     ) -> dict:
         """Helper method to make HTTP requests"""
-        url = f"{self.base_url}/{endpoint}"
-        logger.debug("%s %s", method, url)
-        response = self.session.request(method, url, params=params, json=json)
-        logger.debug("Response status: %d", response.status_code)
+        return jsonlib.loads(self._fetch(method, endpoint, params=params, json=json, route=route))
+
+    def _fetch(
+        self,
+        method: str,
+        endpoint: str,
+        params: dict | None = None,
+        json: dict | None = None,
+        data: str | None = None,
+        route: str | None = None,
+    ) -> str:
+        """
+        Perform a request with retries and failover, and return the decoded response body.
+
+        Each retry waits a jittered exponential backoff (at least the server's Retry-After when
+        there is no rate limiter to absorb it) and moves to the next backend whose circuit
+        breaker is not open. GETs are hedged when ``hedge_percentile`` is set.
+
+        Concurrent identical GETs are coalesced: while one is in flight, other callers for the
+        same URL and priority wait for and share its response body rather than issuing their
+        own request. Callers at different priorities do not share, so that an interactive
+        request never queues behind a background one at the rate limiter.
+
+        When the calling context has a deadline (see ``deadline.request_deadline``), request
+        timeouts, backoff sleeps and rate limiter waits are capped to the time left, and
+        ``DeadlineExceededError`` is raised once it has passed.
+        """
+        request = {
+            "params": params,
+            "json": json,
+            "data": data,
+            "route": route or endpoint,
+            # Captured here because hedged attempts run on executor threads.
+            "priority": request_priority.get(),
+        }
+        if method == "GET" and self.coalesce_requests:
+            key = (
+                endpoint,
+                tuple(sorted(params.items())) if params else None,
+                request["priority"],
+            )
+            try:
+                return self._inflight.do(key, self._fetch_with_retries, method, endpoint, request)
+            except DeadlineExceededError:
+                # The shared request ran out of another caller's budget; ours may have time left.
+                check_deadline()
+        return self._fetch_with_retries(method, endpoint, request)
+
+    def _fetch_with_retries(self, method, endpoint, request) -> str:
+        last_error = None
+        retry_after = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = self._backoff_delay(attempt)
+                if retry_after and not self.rate_limiter:
+                    delay = max(delay, retry_after)
+                logger.warning(
+                    "Retrying %s %s in %.2fs (attempt %d): %s",
+                    method,
+                    endpoint,
+                    delay,
+                    attempt,
+                    last_error,
+                )
+                time.sleep(bounded_timeout(delay))
+            check_deadline()
+            endpoints = self._candidate_endpoints(attempt)
+            try:
+                if self.hedge_percentile and method == "GET" and len(endpoints) > 1:
+                    return self._hedged_send(endpoints[0], endpoints[1], method, endpoint, request)
+                return self._send(endpoints[0], method, endpoint, request)
+            except requests.RequestException as e:
+                if not is_retryable(e):
+                    raise
+                if method != "GET" and isinstance(e, requests.ReadTimeout):
+                    # The request was sent and may have been acted on, e.g. a broadcast
+                    raise
+                last_error = e
+                retry_after = retry_after_seconds(getattr(e, "response", None))
+        raise last_error
+
+    def _backoff_delay(self, attempt):
+        # Full jitter: uniformly random up to the capped exponential backoff.
+        return random.uniform(0, min(DEFAULT_RETRY_BACKOFF_MAX, self.retry_backoff * 2**attempt))
+
+    def _candidate_endpoints(self, attempt):
+        """Usable endpoints in preference order, rotated so each retry tries a new backend."""
+        endpoints = [e for e in self.endpoints if e.breaker.available()] or list(self.endpoints)
+        offset = attempt % len(endpoints)
+        return endpoints[offset:] + endpoints[:offset]
+
+    def _hedged_send(self, primary, secondary, method, endpoint, request):
+        hedge_delay = primary.latency_percentile(self.hedge_percentile)
+        if hedge_delay is None:
+            return self._send(primary, method, endpoint, request)
+
+        executor = self._get_executor()
+        # Run each attempt in a copy of the caller's context so that transfer bytes are still
+        # attributed to the caller's resolution profile.
+        pending = {
+            executor.submit(
+                contextvars.copy_context().run, self._send, primary, method, endpoint, request
+            )
+        }
+        done, pending = wait(pending, timeout=hedge_delay)
+        if not done:
+            logger.debug("Hedging %s to %s after %.3fs", endpoint, secondary.base_url, hedge_delay)
+            pending.add(
+                executor.submit(
+                    contextvars.copy_context().run, self._send, secondary, method, endpoint, request
+                )
+            )
+
+        error = None
+        while done or pending:
+            for future in done:
+                try:
+                    return future.result()
+                except requests.RequestException as e:
+                    error = e
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        raise error
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=DEFAULT_HEDGE_WORKERS, thread_name_prefix="esplora-hedge"
+                )
+            return self._executor
+
+    def _send(self, esplora_endpoint, method, endpoint, request) -> str:
+        """
+        Send a single request to one backend.
+
+        GET responses that carry an ETag or Last-Modified validator are cached so that later
+        requests for the same URL are revalidated with If-None-Match / If-Modified-Since; a
+        304 Not Modified answer is served from the cache. Wire bytes in both directions are
+        accounted against the request route (the endpoint template, e.g. ``tx/:txid/hex``).
+        """
+        url = f"{esplora_endpoint.base_url}/{endpoint}"
+        route = request["route"]
+        params = request["params"]
+        headers = {}
+        cached = None
+        # Only GETs without a query string are cached
+        cacheable = method == "GET" and params is None
+        if cacheable:
+            with self._lock:
+                cached = self.etag_cache.get(url)
+                if cached:
+                    self.etag_cache.move_to_end(url)
+            if cached:
+                headers.update(cached[0])
+
+        # The breaker is asked first, so a request it turns away spends no rate limit token
+        if not esplora_endpoint.breaker.acquire():
+            raise requests.ConnectionError(
+                f"{esplora_endpoint.base_url} is half-open with a trial request in flight"
+            )
+        try:
+            timeout = bounded_timeout(self.timeout)
+            if self.rate_limiter and not self.rate_limiter.acquire(
+                request["priority"], timeout=remaining_time()
+            ):
+                raise DeadlineExceededError()
+
+            logger.debug("%s %s", method, url)
+            started = time.monotonic()
+            span_attributes = {"http.method": method, "http.url": url, "esplora.route": route}
+            with start_span("esplora.request", span_attributes, self.tracer) as span:
+                try:
+                    response = self.session.request(
+                        method,
+                        url,
+                        params=params,
+                        json=request["json"],
+                        data=request["data"],
+                        headers=headers,
+                        timeout=timeout,
+                    )
+                    body = response.content
+                except requests.RequestException:
+                    esplora_endpoint.breaker.record_failure()
+                    HTTP_REQUESTS.inc(labels=(esplora_endpoint.base_url, route, "error"))
+                    raise
+                span.set_attribute("http.status_code", response.status_code)
+            elapsed = time.monotonic() - started
+            logger.debug("Response status: %d in %.3fs", response.status_code, elapsed)
+            self._record_transfer(route, response)
+            HTTP_REQUESTS.inc(labels=(esplora_endpoint.base_url, route, str(response.status_code)))
+            HTTP_REQUEST_DURATION.observe(elapsed, labels=(esplora_endpoint.base_url, route))
+
+            if response.status_code == TOO_MANY_REQUESTS:
+                # Throttling says nothing about backend health, so leave the breaker alone.
+                retry_after = retry_after_seconds(response)
+                logger.warning(
+                    "Throttled by %s, Retry-After: %s", esplora_endpoint.base_url, retry_after
+                )
+                if retry_after and self.rate_limiter:
+                    self.rate_limiter.pause(retry_after)
+            elif response.status_code in RETRYABLE_STATUS_CODES:
+                esplora_endpoint.breaker.record_failure()
+            else:
+                esplora_endpoint.breaker.record_success()
+                esplora_endpoint.record_latency(elapsed)
+        finally:
+            esplora_endpoint.breaker.release()
+
+        if cacheable:
+            record_cache_lookup("esplora_etag", cached is not None and response.status_code == 304)
+        if cached and response.status_code == 304:
+            logger.debug("Not modified, serving cached body for %s", url)
+            return cached[1]
+
         response.raise_for_status()
-        return response.json()
+        text = response.text
+
+        if method == "GET" and params is None:
+            validators = {}
+            if response.headers.get("ETag"):
+                validators["If-None-Match"] = response.headers["ETag"]
+            if response.headers.get("Last-Modified"):
+                validators["If-Modified-Since"] = response.headers["Last-Modified"]
+            if validators and self.etag_cache_size > 0:
+                with self._lock:
+                    self.etag_cache[url] = (validators, text)
+                    self.etag_cache.move_to_end(url)
+                    while len(self.etag_cache) > self.etag_cache_size:
+                        self.etag_cache.popitem(last=False)
+
+        logger.debug("Received %d bytes for %s", len(body), route)
+        return text
+
+    def _record_transfer(self, route, response):
+        bytes_in = wire_bytes_in(response)
+        bytes_out = wire_bytes_out(response.request)
+        record_transfer_bytes(bytes_in)
+        with self._lock:
+            stats = self.transfer_stats.setdefault(
+                route, {"requests": 0, "not_modified": 0, "bytes_in": 0, "bytes_out": 0}
+            )
+            stats["requests"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            if response.status_code == 304:
+                stats["not_modified"] += 1
+
+    def get_transfer_stats(self) -> dict:
+        """
+        Get per-endpoint transfer counters.
+
+        Returns:
+            Dict keyed by endpoint template, each containing:
+            - requests: Number of requests made
+            - not_modified: Number of requests answered with 304 Not Modified
+            - bytes_in: Bytes received over the wire (before decompression where known)
+            - bytes_out: Bytes sent, including the request line and headers
+        """
+        with self._lock:
+            return {route: dict(stats) for route, stats in self.transfer_stats.items()}
 
     def get_address(self, address: str) -> dict:
         """
@@ -33,7 +531,7 @@ class EsploraClient:
             - chain_stats: Statistics for the main chain
             - mempool_stats: Statistics for the mempool
         """
-        return self._make_request("GET", f"address/{address}")
+        return self._make_request("GET", f"address/{address}", route="address/:address")
 
     def get_address_utxos(self, address: str) -> list[dict]:
         """
@@ -49,7 +547,7 @@ class EsploraClient:
             - value: Amount in satoshis
             - status: Status of the UTXO
         """
-        return self._make_request("GET", f"address/{address}/utxo")
+        return self._make_request("GET", f"address/{address}/utxo", route="address/:address/utxo")
 
     def get_address_transactions(self, address: str) -> list[dict]:
         """
@@ -70,7 +568,7 @@ class EsploraClient:
             - fee: Transaction fee in satoshis
             - status: Transaction status
         """
-        return self._make_request("GET", f"address/{address}/txs")
+        return self._make_request("GET", f"address/{address}/txs", route="address/:address/txs")
 
     def get_transaction(self, txid: str) -> dict:
         """
@@ -91,7 +589,7 @@ class EsploraClient:
             - fee: Transaction fee in satoshis
             - status: Transaction status
         """
-        return self._make_request("GET", f"tx/{txid}")
+        return self._make_request("GET", f"tx/{txid}", route="tx/:txid")
 
     def get_transaction_hex(self, txid: str) -> str:
         """
@@ -102,11 +600,53 @@ class EsploraClient:
 
         Returns: the hex string of the transaction
         """
-        url = f"{self.base_url}/tx/{txid}/hex"
-        logger.debug("GET %s", url)
-        response = self.session.get(url)
-        response.raise_for_status()
-        return response.text
+        return self._fetch("GET", f"tx/{txid}/hex", route="tx/:txid/hex")
+
+    def get_tip_height(self) -> int:
+        """
+        Get the height of the last block in the best chain.
+
+        Returns: the block height
+        """
+        return int(self._fetch("GET", "blocks/tip/height", route="blocks/tip/height"))
+
+    def get_blocks(self, start_height: int) -> list[dict]:
+        """
+        Get the 10 newest blocks at or below a height.
+
+        Args:
+            start_height: Height of the first (highest) block to return
+
+        Returns:
+            List of blocks in descending height order, each containing:
+            - id: Block hash
+            - height: Block height
+            - timestamp: Block header timestamp
+            - mediantime: Median time past of the block and its 10 predecessors
+        """
+        return self._make_request("GET", f"blocks/{start_height}", route="blocks/:start_height")
+
+    def get_block_txids(self, block_hash: str) -> list[str]:
+        """
+        Get the IDs of the transactions in a block.
+
+        Args:
+            block_hash: Hash of the block
+
+        Returns: the txids, in block order
+        """
+        return self._make_request("GET", f"block/{block_hash}/txids", route="block/:hash/txids")
+
+    def get_fee_estimates(self) -> dict:
+        """
+        Get fee rate estimates.
+
+        Returns:
+            Dict mapping a confirmation target in blocks (as a string) to the estimated fee
+            rate in sat/vB, e.g. ``{"1": 87.882, "6": 68.285, "144": 1.027}``. Empty when
+            the backend has no estimates, as on regtest.
+        """
+        return self._make_request("GET", "fee-estimates", route="fee-estimates")
 
     def broadcast_tx(self, tx_hex):
         """
@@ -117,9 +657,33 @@ class EsploraClient:
 
         Returns: The txid will be returned on success.
         """
-        url = f"{self.base_url}/tx"
-        logger.debug("POST %s", url)
-        response = self.session.post(url, tx_hex)
-        response.raise_for_status()
-        logger.info("Broadcast tx: %s", response.text)
-        return response.text
+        txid = self._fetch("POST", "tx", data=tx_hex)
+        logger.info("Broadcast tx: %s", txid)
+        return txid
+
+
+def wire_bytes_in(response) -> int:
+    """Bytes of response body as received, i.e. compressed size when a coding was applied."""
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit():
+        return int(content_length)
+    raw = getattr(response, "raw", None)
+    if raw is not None and hasattr(raw, "tell"):
+        try:
+            return raw.tell()
+        except (OSError, ValueError):
+            pass
+    return len(response.content or b"")
+
+
+def wire_bytes_out(request) -> int:
+    """Approximate bytes sent for a prepared request: request line, headers and body."""
+    if request is None:
+        return 0
+    size = len(request.method or "") + len(request.url or "") + len(" HTTP/1.1\r\n")
+    for name, value in request.headers.items():
+        size += len(name) + len(str(value)) + 4
+    body = request.body
+    if body:
+        size += len(body)
+    return size
@@ -0,0 +1,133 @@
+import logging
+import math
+import threading
+import time
+import weakref
+
+from .constants import (
+    DEFAULT_CONF_TARGET,
+    DEFAULT_FEE_ESTIMATE_TTL,
+    FALLBACK_FEE_RATE,
+    MIN_RELAY_FEE_RATE,
+)
+from .metrics import record_cache_lookup
+
+logger = logging.getLogger(__name__)
+
+# Transaction weight, in weight units (4 per non-witness byte, 1 per witness byte):
+# version and locktime, plus the segwit marker and flag
+TX_OVERHEAD_WEIGHT = 8 * 4 + 2
+# Outpoint, script length and sequence of an input
+INPUT_BASE_SIZE = 32 + 4 + 1 + 4
+# Witness item count, then a DER signature of at most 72 bytes and a compressed public key
+P2WPKH_WITNESS_WEIGHT = 1 + 1 + 72 + 1 + 33
+P2PKH_SCRIPT_SIG_SIZE = 1 + 72 + 1 + 33
+P2SH_P2WPKH_SCRIPT_SIG_SIZE = 1 + 22
+# Witness item count and a Schnorr signature with the default sighash
+P2TR_WITNESS_WEIGHT = 1 + 1 + 64
+
+
+def input_weight(script_pubkey):
+    """
+    Weight of an input spending ``script_pubkey`` once signed, assuming the largest
+    signature so that a fee computed from it is never short.
+    """
+    if script_pubkey.is_p2wpkh():
+        return INPUT_BASE_SIZE * 4 + P2WPKH_WITNESS_WEIGHT
+    if script_pubkey.is_p2tr():
+        return INPUT_BASE_SIZE * 4 + P2TR_WITNESS_WEIGHT
+    if script_pubkey.is_p2sh():
+        # Only P2SH-wrapped P2WPKH is signed by this library
+        return (INPUT_BASE_SIZE + P2SH_P2WPKH_SCRIPT_SIG_SIZE) * 4 + P2WPKH_WITNESS_WEIGHT
+    if not script_pubkey.is_p2pkh():
+        logger.warning("Unknown script type %s, sizing its input as P2PKH", script_pubkey)
+    # Legacy inputs still take an empty witness in a segwit transaction
+    return (INPUT_BASE_SIZE + P2PKH_SCRIPT_SIG_SIZE) * 4 + 1
+
+
+def varint_size(count):
+    if count < 0xFD:
+        return 1
+    return 3 if count <= 0xFFFF else 5
+
+
+def estimate_vsize(script_pubkeys, tx_outs):
+    """
+    Virtual size of a transaction spending outputs locked by ``script_pubkeys`` to
+    ``tx_outs``, once signed. Output amounts do not change the size, so it can be computed
+    before they are known.
+    """
+    weight = TX_OVERHEAD_WEIGHT
+    weight += (varint_size(len(script_pubkeys)) + varint_size(len(tx_outs))) * 4
+    weight += sum(input_weight(script_pubkey) for script_pubkey in script_pubkeys)
+    weight += sum(len(tx_out.serialize()) * 4 for tx_out in tx_outs)
+    return math.ceil(weight / 4)
+
+
+def fee_for_vsize(vsize, fee_rate):
+    """Satoshis to pay for ``vsize`` virtual bytes at ``fee_rate`` sat/vB, rounded up."""
+    return math.ceil(vsize * max(fee_rate, MIN_RELAY_FEE_RATE))
+
+
+class FeeEstimator:
+    """
+    Fee rates in sat/vB by confirmation target, from Esplora's ``fee-estimates`` endpoint.
+
+    The estimates are fetched at most once every ``ttl`` seconds. When a refresh fails the
+    previous estimates are kept; with none at all (or on regtest, where Esplora has no
+    estimates) the rate is ``FALLBACK_FEE_RATE``.
+    """
+
+    def __init__(self, esplora_client, ttl=DEFAULT_FEE_ESTIMATE_TTL, clock=time.monotonic):
+        self.esplora_client = esplora_client
+        self.ttl = ttl
+        self.clock = clock
+        # Confirmation target in blocks -> sat/vB
+        self._estimates = {}
+        self._fetched_at = None
+        self._lock = threading.Lock()
+
+    def estimates(self):
+        """The cached estimates, refreshed first if they are older than ``ttl``."""
+        with self._lock:
+            fresh = self._fetched_at is not None and self.clock() - self._fetched_at < self.ttl
+            record_cache_lookup("fee_estimates", fresh)
+            if not fresh:
+                try:
+                    raw = self.esplora_client.get_fee_estimates()
+                    self._estimates = {int(target): float(rate) for target, rate in raw.items()}
+                except Exception as e:
+                    logger.warning("Error fetching fee estimates, keeping previous ones: %s", e)
+                # Failures are not retried before the next refresh either
+                self._fetched_at = self.clock()
+            return self._estimates
+
+    def fee_rate(self, conf_target=DEFAULT_CONF_TARGET):
+        """
+        Rate expected to confirm within ``conf_target`` blocks: the estimate for the
+        largest target not above it, or for the smallest target when all are above it.
+        """
+        estimates = self.estimates()
+        if not estimates:
+            return FALLBACK_FEE_RATE
+        targets = [target for target in estimates if target <= conf_target]
+        rate = estimates[max(targets) if targets else min(estimates)]
+        return max(rate, MIN_RELAY_FEE_RATE)
+
+    def invalidate(self):
+        """Fetch the estimates again on next use, e.g. after a fee-related broadcast error."""
+        with self._lock:
+            self._fetched_at = None
+
+
+_shared_estimators = weakref.WeakKeyDictionary()
+_shared_lock = threading.Lock()
+
+
+def shared_fee_estimator(esplora_client):
+    """The ``FeeEstimator`` of ``esplora_client``, shared by every manager using it."""
+    with _shared_lock:
+        estimator = _shared_estimators.get(esplora_client)
+        if estimator is None:
+            estimator = _shared_estimators[esplora_client] = FeeEstimator(esplora_client)
+        return estimator
@@ -0,0 +1,166 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+# Profile of the resolution running in the current context, and the phase in progress that
+# bytes reported by the Esplora client are attributed to.
+current_profile = contextvars.ContextVar("current_profile", default=None)
+current_scope = contextvars.ContextVar("current_scope", default=None)
+
+ESPLORA = "esplora"
+TX_PARSE = "txParse"
+SIGNAL_PROCESSING = "signalProcessing"
+VERIFY_PROOF = "verifyProof"
+JSON_PATCH = "jsonPatch"
+CANONICALIZE = "canonicalize"
+CAS_RETRIEVAL = "casRetrieval"
+
+
+class ResolutionHooks:
+    """
+    Instrumentation hook interface for ``Btcr2Resolver``.
+
+    Subclass and override the callbacks of interest, then pass instances to the resolver's
+    ``hooks`` argument. Callbacks run inline on the resolution path and should be cheap.
+    """
+
+    def on_phase(self, identifier, phase, seconds, nbytes, beacon_id=None):
+        """Called after each timed phase (e.g. one Esplora request or proof verification)."""
+
+    def on_resolution(self, identifier, profile):
+        """Called once a resolution finishes, with its ``ResolutionProfile``."""
+
+
+class PhaseScope:
+    """A timed phase in progress, collecting the bytes transferred within it."""
+
+    __slots__ = ("name", "beacon_id", "nbytes")
+
+    def __init__(self, name, beacon_id=None):
+        self.name = name
+        self.beacon_id = beacon_id
+        self.nbytes = 0
+
+
+class ResolutionProfile:
+    """
+    Wall time, call counts and bytes per phase (and per beacon) for one resolution.
+    """
+
+    def __init__(self, identifier=None, hooks=()):
+        self.identifier = identifier
+        self.hooks = list(hooks)
+        self.started = time.perf_counter()
+        self.finished = None
+        self.phases = {}
+        self.beacons = {}
+        self.counters = {}
+        # Esplora bytes are reported from worker threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, beacon_id=None):
+        """
+        Time a phase. Bytes transferred within it, on any thread running a copy of this
+        context, are recorded with it and reported to the hooks when it ends.
+        """
+        scope = PhaseScope(name, beacon_id)
+        token = current_scope.set(scope)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            current_scope.reset(token)
+            with self._lock:
+                nbytes = scope.nbytes
+            self.record(name, time.perf_counter() - started, nbytes, beacon_id)
+
+    def record(self, name, seconds, nbytes=0, beacon_id=None, calls=1):
+        self._add(self.phases, name, seconds, nbytes, calls)
+        if beacon_id is not None:
+            self._add(self.beacons.setdefault(str(beacon_id), {}), name, seconds, nbytes, calls)
+        for hook in self.hooks:
+            hook.on_phase(self.identifier, name, seconds, nbytes, beacon_id)
+
+    def add_bytes(self, name, nbytes, beacon_id=None):
+        """Record bytes transferred outside any timed phase; hooks are not told of these."""
+        self._add(self.phases, name, 0.0, nbytes, 0)
+        if beacon_id is not None:
+            self._add(self.beacons.setdefault(str(beacon_id), {}), name, 0.0, nbytes, 0)
+
+    def add_scope_bytes(self, scope, nbytes):
+        with self._lock:
+            scope.nbytes += nbytes
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _add(self, phases, name, seconds, nbytes, calls):
+        with self._lock:
+            stats = phases.get(name)
+            if stats is None:
+                stats = phases[name] = {"calls": 0, "seconds": 0.0, "bytes": 0}
+            stats["calls"] += calls
+            stats["seconds"] += seconds
+            stats["bytes"] += nbytes
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        for hook in self.hooks:
+            hook.on_resolution(self.identifier, self)
+
+    def serialize(self):
+        end = self.finished or time.perf_counter()
+        return {
+            "totalSeconds": end - self.started,
+            "phases": {name: dict(stats) for name, stats in self.phases.items()},
+            "beacons": {
+                beacon: {name: dict(stats) for name, stats in phases.items()}
+                for beacon, phases in self.beacons.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+
+class NullProfile:
+    """Stand-in used when a resolution is not being profiled; every method is a no-op."""
+
+    _null_context = nullcontext()
+
+    def phase(self, name, beacon_id=None):
+        return self._null_context
+
+    def record(self, name, seconds, nbytes=0, beacon_id=None, calls=1):
+        pass
+
+    def add_bytes(self, name, nbytes, beacon_id=None):
+        pass
+
+    def add_scope_bytes(self, scope, nbytes):
+        pass
+
+    def count(self, name, amount=1):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+def record_transfer_bytes(nbytes):
+    """Attribute bytes received by the Esplora client to the active resolution, if any."""
+    profile = current_profile.get()
+    if profile is None:
+        return
+    scope = current_scope.get()
+    if scope is None:
+        profile.add_bytes(ESPLORA, nbytes)
+    else:
+        profile.add_scope_bytes(scope, nbytes)
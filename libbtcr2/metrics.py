@@ -0,0 +1,256 @@
+import abc
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DEFAULT_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _ThreadShards:
+    """
+    Per-thread storage for metric values.
+
+    Each thread updates only its own shard, so recording a sample on the hot path takes no
+    lock; shards are merged when the registry is collected.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def snapshots(self):
+        with self._lock:
+            shards = list(self._shards)
+        # dict.copy is atomic under the GIL, so this is safe while owners keep writing
+        return [shard.copy() for shard in shards]
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+    suffix = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @property
+    def exposed_name(self):
+        return self.name + self.suffix
+
+    @abc.abstractmethod
+    def samples(self):
+        """Yield ``(suffix, labels, extra_labels, value)`` for each time series to expose."""
+
+
+class Counter(Metric):
+    """Monotonically increasing value, e.g. resolutions by outcome."""
+
+    type = "counter"
+    suffix = "_total"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._shards = _ThreadShards()
+
+    def inc(self, amount=1, labels=()):
+        shard = self._shards.get()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return sum(shard.get(labels, 0) for shard in self._shards.snapshots())
+
+    def samples(self):
+        totals = {}
+        for shard in self._shards.snapshots():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        for labels, value in totals.items():
+            yield "", labels, (), value
+
+
+class Gauge(Metric):
+    """Value that can go up and down, e.g. UTXO pool size."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def value(self, labels=()):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in values.items():
+            yield "", labels, (), value
+
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets, e.g. request latency."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._shards = _ThreadShards()
+
+    def observe(self, value, labels=()):
+        shard = self._shards.get()
+        state = shard.get(labels)
+        if state is None:
+            # [per-bucket counts..., +Inf count, sum]
+            state = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def count(self, labels=()):
+        return sum(sum(shard[labels][:-1]) for shard in self._shards.snapshots() if labels in shard)
+
+    def samples(self):
+        totals = {}
+        for shard in self._shards.snapshots():
+            for labels, state in shard.items():
+                merged = totals.setdefault(labels, [0] * len(state[:-1]) + [0.0])
+                for index, value in enumerate(state):
+                    merged[index] += value
+        for labels, state in totals.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state, strict=False):
+                cumulative += count
+                yield "_bucket", labels, (("le", format_value(bound)),), cumulative
+            cumulative += state[len(self.buckets)]
+            yield "_bucket", labels, (("le", "+Inf"),), cumulative
+            yield "_sum", labels, (), state[-1]
+            yield "_count", labels, (), cumulative
+
+
+class MetricsRegistry:
+    """Collection of metrics, exportable in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} already registered as {metric.type}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def expose(self):
+        """Render every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            name = metric.exposed_name
+            lines.append(f"# HELP {name} {escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for suffix, labels, extra, value in metric.samples():
+                pairs = list(zip(metric.labelnames, labels, strict=False)) + list(extra)
+                label_text = ",".join(f'{key}="{escape_label(val)}"' for key, val in pairs)
+                label_text = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{name}{suffix}{label_text} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+REGISTRY = MetricsRegistry()
+
+CACHE_REQUESTS = REGISTRY.counter(
+    "btcr2_cache_requests", "Cache lookups by cache and result (hit or miss)", ["cache", "result"]
+)
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(labels=(cache, "hit" if hit else "miss"))
+
+
+def start_metrics_server(port, addr="127.0.0.1", registry=REGISTRY):
+    """
+    Serve ``registry`` on ``http://addr:port/metrics`` from a daemon thread.
+
+    Returns the server; call ``shutdown()`` on it to stop serving.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics: " + format, *args)
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on http://%s:%d/metrics", addr, server.server_address[1])
+    return server
@@ -1,10 +1,28 @@
+# ``esplora_api`` may be a single base URL or a list of equivalent backends in order of
+# preference; the client fails over between them. ``rate_limit`` caps the request rate the
+# client sends to public instances.
+PUBLIC_RATE_LIMIT = {"rate": 10, "burst": 20}
+
 REGTEST = {"btc_network": "regtest", "esplora_api": "http://localhost:3000"}
 
-SIGNET = {"btc_network": "signet", "esplora_api": "https://mempool.space/signet/api"}
+SIGNET = {
+    "btc_network": "signet",
+    "esplora_api": "https://mempool.space/signet/api",
+    "rate_limit": PUBLIC_RATE_LIMIT,
+}
 
-MUTINY_NET = {"btc_network": "signet", "esplora_api": "https://mutinynet.com/api"}
+MUTINY_NET = {
+    "btc_network": "signet",
+    "esplora_api": "https://mutinynet.com/api",
+    "rate_limit": PUBLIC_RATE_LIMIT,
+}
 
-BITCOIN = {"btc_network": "mainnet", "esplora_api": "https://mempool.space/api"}
+BITCOIN = {
+    "btc_network": "mainnet",
+    "esplora_api": ["https://mempool.space/api", "https://blockstream.info/api"],
+    "hedge_percentile": 95,
+    "rate_limit": PUBLIC_RATE_LIMIT,
+}
 
 DEFAULT_NETWORK_DEFINITIONS = {
     "regtest": REGTEST,
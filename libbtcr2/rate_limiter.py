@@ -0,0 +1,95 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from .constants import INTERACTIVE_PRIORITY
+
+logger = logging.getLogger(__name__)
+
+# Priority class of the Esplora requests issued from the current context. Lower values are
+# served first when requests queue on a rate limiter.
+request_priority = contextvars.ContextVar("request_priority", default=INTERACTIVE_PRIORITY)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter with priority queuing.
+
+    Tokens accrue at ``rate`` per second up to ``burst``. Callers that have to wait are served
+    in priority order (then arrival order), so interactive requests overtake queued background
+    requests. ``pause`` stops all issuance until a point in time, e.g. to honor Retry-After.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("Rate must be greater than 0")
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.updated_at = clock()
+        self.paused_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config: dict | None) -> "TokenBucket | None":
+        """Build a limiter from a network definition ``rate_limit`` entry, if present."""
+        if not config:
+            return None
+        return cls(config["rate"], config.get("burst"))
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def acquire(self, priority: int = INTERACTIVE_PRIORITY, timeout: float | None = None) -> bool:
+        """
+        Take one token, blocking until one is available to this caller.
+
+        Returns False if ``timeout`` seconds elapse first.
+        """
+        entry = (priority, next(self._sequence))
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._condition:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = self.clock()
+                    self._refill(now)
+                    is_next = self._waiters[0] == entry
+                    if is_next and now >= self.paused_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+
+                    if not is_next:
+                        wait = None
+                    elif now < self.paused_until:
+                        wait = self.paused_until - now
+                    else:
+                        wait = (1 - self.tokens) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            return False
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    def pause(self, seconds: float):
+        """Issue no tokens for ``seconds``, e.g. after a 429 with a Retry-After header."""
+        with self._condition:
+            until = self.clock() + seconds
+            if until > self.paused_until:
+                logger.info("Rate limiter paused for %.1fs", seconds)
+                self.paused_until = until
+            self._condition.notify_all()
@@ -0,0 +1,68 @@
+import time
+
+from .deadline import request_deadline
+from .error import DeadlineExceededError
+from .instrumentation import NULL_PROFILE
+from .sidecar import SidecarIndex
+
+
+class ResolutionContext:
+    """
+    State for a single DID resolution.
+
+    A resolver instance is shared between concurrent resolutions, so everything specific to
+    one ``resolve`` call (requested version, sidecar data, traversal progress, test vector
+    folders) lives here and is passed down the traversal rather than stored on the resolver.
+    """
+
+    def __init__(self, identifier, network, resolution_options=None, log_folder=None):
+        self.identifier = identifier
+        self.network = network
+        self.resolution_options = resolution_options or {}
+        self.request_version_id = None
+        self.version_time = None
+        # Highest block height that can be at or before version_time, when known
+        self.height_bound = None
+        # SidecarIndex of the update payloads supplied in sidecarData
+        self.sidecar = SidecarIndex()
+        # targetVersionId -> sha256 of the canonical update payload, for every applied update
+        self.update_hashes = {}
+        self.traversal_steps = 0
+        # Traversal progress, reported if the resolution runs out of time
+        self.version_id = 1
+        self.block_height = 0
+        self.started = time.monotonic()
+        # time.monotonic() deadline from the ``timeout`` resolution option
+        self.deadline = None
+        # ResolutionProfile when the resolution is being profiled
+        self.profile = NULL_PROFILE
+        # Test vector folders, only set when the resolver is logging
+        self.log_folder = log_folder
+        self.block_folder = None
+
+    def set_timeout(self, timeout):
+        """
+        Give the resolution ``timeout`` seconds, propagated to Esplora requests through the
+        current context. Returns the ``request_deadline`` token to reset it with.
+        """
+        self.deadline = self.started + timeout
+        return request_deadline.set(self.deadline)
+
+    def check_deadline(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceededError()
+
+    def progress(self):
+        """How far traversal got, for the timeout error in the resolution metadata."""
+        return {
+            "versionId": self.version_id,
+            "blockHeight": self.block_height,
+            "traversalSteps": self.traversal_steps,
+            "elapsedSeconds": time.monotonic() - self.started,
+        }
+
+    def enter_block(self, block_height):
+        """Point the test vector output at the folder for ``block_height``."""
+        if self.log_folder:
+            self.block_folder = f"{self.log_folder}/block{block_height}"
+        return self.block_folder
@@ -1,9 +1,13 @@
+import asyncio
 import copy
 import datetime
 import json
 import logging
-import os
+import threading
+import time
 import urllib
+from collections import OrderedDict
+from contextlib import aclosing
 
 import base58
 import jcs
@@ -17,23 +21,71 @@ from di_bip340.multikey import SchnorrSecp256k1Multikey
 from ipfs_cid import cid_sha256_wrap_digest
 from pydid.doc import DIDDocument
 
+from .block_index import BlockTimeIndex
+from .bundle_cache import CIDBundleCache
 from .constants import (
+    BACKGROUND_PRIORITY,
+    CID_AGGREGATE_BEACON_TYPE,
+    DEFAULT_RESOLVE_CONCURRENCY,
     EXTERNAL,
+    INTERACTIVE_PRIORITY,
     KEY,
-    OP_RETURN,
     PROOF_PURPOSE,
     SINGLETON_BEACON_TYPE,
+    SMT_AGGREGATE_BEACON_TYPE,
+    SMT_VERIFIER_CACHE_SIZE,
     ZCAP_CONTEXT,
 )
+from .deadline import request_deadline
 from .did import InvalidDidError, decode_identifier
 from .diddoc.builder import Btcr2DIDDocumentBuilder
 from .diddoc.doc import Btcr2Document, IntermediateBtcr2DIDDocument
+from .error import DeadlineExceededError
 from .esplora_client import EsploraClient
+from .instrumentation import (
+    CANONICALIZE,
+    CAS_RETRIEVAL,
+    ESPLORA,
+    JSON_PATCH,
+    NULL_PROFILE,
+    SIGNAL_PROCESSING,
+    TX_PARSE,
+    VERIFY_PROOF,
+    ResolutionProfile,
+    current_profile,
+)
+from .metrics import DEFAULT_COUNT_BUCKETS, REGISTRY
 from .network_config import DEFAULT_NETWORK_DEFINITIONS
-from .service import BeaconTypeNames
+from .rate_limiter import request_priority
+from .resolution_context import ResolutionContext
+from .sidecar import SidecarIndex, signal_hash_from_script, signal_hash_from_tx
+from .signal_pipeline import SignalPipeline, beacon_key
+from .singleflight import AsyncSingleFlight
+from .smt import SMTVerifier
+from .tracing import start_span
+from .vector_writer import VectorWriter
+from .version_history import VersionHistory
 
 logger = logging.getLogger(__name__)
 
+PATCH_OPERATIONS = {"add", "remove", "replace", "move", "copy", "test"}
+
+RESOLUTIONS = REGISTRY.counter(
+    "btcr2_resolutions", "DID resolutions by network and outcome", ["network", "outcome"]
+)
+RESOLUTION_DURATION = REGISTRY.histogram(
+    "btcr2_resolution_duration_seconds", "DID resolution latency", ["network"]
+)
+TRAVERSAL_DEPTH = REGISTRY.histogram(
+    "btcr2_traversal_depth",
+    "Blocks with beacon signals traversed per resolution",
+    ["network"],
+    buckets=DEFAULT_COUNT_BUCKETS,
+)
+SIGNALS_PROCESSED = REGISTRY.counter(
+    "btcr2_signals_processed", "Beacon signals processed", ["network", "beacon_type"]
+)
+
 
 class Btcr2Resolver:
     def __init__(
@@ -41,22 +93,96 @@ class Btcr2Resolver:
         networkDefinitions=DEFAULT_NETWORK_DEFINITIONS,
         logging=False,
         log_folder="TestVectors",
+        compress_vectors=False,
+        hooks=None,
+        tracer=None,
+        content_store=None,
     ):
         self.logging = logging
+        # ResolutionHooks receiving per-phase timings of every resolution
+        self.hooks = list(hooks or [])
+        # OpenTelemetry-compatible tracer; falls back to the global tracer (no-op by default)
+        self.tracer = tracer
+        # ContentStore for initial documents and update payloads not given as sidecar data
+        self.content_store = content_store
         self.log_base_folder = log_folder
+        # Test vectors are written by a background thread so capture stays off the hot path
+        self.vector_writer = VectorWriter(compress=compress_vectors) if logging else None
         self.networks = self.configure_networks(networkDefinitions)
+        self._inflight_resolutions = AsyncSingleFlight()
+        # SMT root -> SMTVerifier, so proofs against a root seen before reuse its verified nodes
+        self._smt_verifiers = OrderedDict()
+        self._smt_lock = threading.Lock()
+        # Parsed CID aggregate beacon bundles, shared by every DID announced in them
+        self.bundle_cache = CIDBundleCache()
+
+    def flush_test_vectors(self):
+        """Block until all captured test vectors have been written to disk."""
+        if self.vector_writer:
+            self.vector_writer.flush()
 
     def configure_networks(self, networkDefinitions):
         networks = {}
         for network, networkDefinition in networkDefinitions.items():
+            esplora_client = EsploraClient.from_network_definition(
+                networkDefinition, tracer=self.tracer
+            )
             definition = {
                 "btc_network": networkDefinition.get("btc_network"),
-                "esplora_client": EsploraClient(networkDefinition.get("esplora_api")),
+                "esplora_client": esplora_client,
+                "block_index": BlockTimeIndex(esplora_client),
             }
             networks[network] = definition
         return networks
 
-    async def resolve(self, identifier, resolution_options=None):
+    async def resolve(self, identifier, resolution_options=None, priority=INTERACTIVE_PRIORITY):
+        """
+        Resolve a DID.
+
+        Concurrent calls for the same identifier, resolution options and priority share a
+        single traversal; each caller receives its own copy of the resolution result.
+
+        The ``timeout`` resolution option bounds the resolution to that many seconds,
+        including every Esplora request. A resolution that runs out of time returns no
+        document and a ``resolutionTimeout`` error in ``didResolutionMetadata`` that reports
+        how far traversal got.
+        """
+        resolution_options = resolution_options or {}
+        key = (identifier, options_digest(resolution_options), priority)
+        resolution_result = await self._inflight_resolutions.do(
+            key, self._resolve_with_priority, identifier, resolution_options, priority
+        )
+        return copy.deepcopy(resolution_result)
+
+    async def _resolve_with_priority(self, identifier, resolution_options, priority):
+        token = request_priority.set(priority)
+        try:
+            return await self._resolve(identifier, resolution_options)
+        finally:
+            request_priority.reset(token)
+
+    async def resolve_many(
+        self,
+        identifiers,
+        resolution_options=None,
+        priority=BACKGROUND_PRIORITY,
+        concurrency=DEFAULT_RESOLVE_CONCURRENCY,
+    ):
+        """
+        Resolve several DIDs concurrently, returning results in the order of ``identifiers``.
+
+        Requests are issued at background priority by default, so rate-limited Esplora
+        traffic from interactive ``resolve`` calls is served first.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve_one(identifier):
+            async with semaphore:
+                return await self.resolve(identifier, resolution_options, priority)
+
+        return await asyncio.gather(*(resolve_one(identifier) for identifier in identifiers))
+
+    async def _resolve(self, identifier, resolution_options):
 
         id_type, version, network, genesis_bytes = decode_identifier(identifier)
 
@@ -65,42 +191,191 @@ class Btcr2Resolver:
 
         logger.info("ID Components: %s %s %s %s", id_type, version, network, genesis_bytes.hex())
 
+        log_folder = None
         if self.logging:
             did_path = identifier.split(":")[2]
-            self.log_folder = f"{self.log_base_folder}/{network}/{did_path}"
-            if not os.path.exists(self.log_folder):
-                os.makedirs(self.log_folder)
-
-        if id_type == KEY:
-            initial_did_document = self.resolve_deterministic(
-                identifier, genesis_bytes, version, network
-            )
-        elif id_type == EXTERNAL:
-            initial_did_document = await self.resolve_external(
-                identifier, genesis_bytes, version, network, resolution_options
-            )
-
-        else:
-            raise Exception("Invalid HRP")
+            log_folder = f"{self.log_base_folder}/{network}/{did_path}"
+
+        context = ResolutionContext(identifier, network, resolution_options, log_folder)
+        if resolution_options.get("profile") or self.hooks:
+            context.profile = ResolutionProfile(identifier, self.hooks)
+            current_profile.set(context.profile)
+        timeout = resolution_options.get("timeout")
+        if timeout is not None:
+            context.set_timeout(timeout)
+
+        started = time.perf_counter()
+        outcome = "error"
+        span_attributes = {"btcr2.did": identifier, "btcr2.network": str(network)}
+        try:
+            with start_span("btcr2.resolve", span_attributes, self.tracer) as span:
+                resolution = self._resolve_in_context(context, id_type, version, genesis_bytes)
+                if timeout is not None:
+                    # Cancels the traversal at the deadline even while it waits on Esplora
+                    resolution = asyncio.wait_for(resolution, timeout)
+                resolution_result = await resolution
+                span.set_attribute(
+                    "btcr2.version_id", resolution_result["didDocumentMetadata"]["version"]
+                )
+            outcome = "success"
+            return resolution_result
+        except (asyncio.TimeoutError, DeadlineExceededError):
+            outcome = "timeout"
+            logger.warning("Resolution of %s timed out after %ss", identifier, timeout)
+            return self.timeout_result(context)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            RESOLUTIONS.inc(labels=(network, outcome))
+            RESOLUTION_DURATION.observe(time.perf_counter() - started, labels=(network,))
+            TRAVERSAL_DEPTH.observe(context.traversal_steps, labels=(network,))
+
+    async def _resolve_in_context(self, context, id_type, version, genesis_bytes):
+        network = context.network
+        resolution_options = context.resolution_options
+
+        initial_did_document = await self.resolve_initial_document(
+            context, id_type, version, genesis_bytes
+        )
 
         # TODO: Process Beacon Signals
         logger.info("Initial DID document")
         logger.debug("%s", json.dumps(initial_did_document.serialize(), indent=2))
         target_document, version_id = await self.resolve_target_document(
-            initial_did_document, resolution_options, network
+            initial_did_document, context
         )
 
         logger.info("Target DID document")
         logger.debug("%s", target_document)
 
+        context.profile.finish()
+        resolution_metadata = {}
+        if resolution_options.get("profile"):
+            resolution_metadata["profile"] = context.profile.serialize()
+
         resolution_result = {
             "didDocument": target_document.serialize(),
-            "didResolutionMetadata": {},
+            "didResolutionMetadata": resolution_metadata,
             "didDocumentMetadata": {"network": network, "version": version_id},
         }
 
         return resolution_result
 
+    async def resolve_initial_document(self, context, id_type, version, genesis_bytes):
+        identifier = context.identifier
+        network = context.network
+        if id_type == KEY:
+            with start_span("btcr2.resolve_deterministic", tracer=self.tracer):
+                return self.resolve_deterministic(identifier, genesis_bytes, version, network)
+        elif id_type == EXTERNAL:
+            with start_span("btcr2.resolve_external", tracer=self.tracer):
+                return await self.resolve_external(
+                    identifier, genesis_bytes, version, network, context.resolution_options
+                )
+        raise Exception("Invalid HRP")
+
+    def _new_context(self, identifier, resolution_options):
+        id_type, version, network, genesis_bytes = decode_identifier(identifier)
+
+        if not self.networks.get(network):
+            raise Exception("Unsupported Network")
+
+        context = ResolutionContext(identifier, network, resolution_options)
+        return context, id_type, version, genesis_bytes
+
+    async def iter_versions(self, identifier, resolution_options=None):
+        """
+        Stream the versions of a DID, up to ``versionId`` / ``versionTime`` when given.
+
+        Yields version 1, the initial document, then each update as soon as it is verified:
+        dicts with ``versionId``, ``blockHeight``, ``blockTime``, ``update``, ``updateHash``
+        and the resulting ``didDocument``. Past versions are not retained, so arbitrarily
+        long histories are streamed in constant memory (apart from one update hash per
+        version, kept to confirm re-announced updates).
+
+        Stopping early should close the generator, e.g. with ``contextlib.aclosing``, so
+        that signal prefetching is cancelled promptly.
+        """
+        resolution_options = resolution_options or {}
+        context, id_type, version, genesis_bytes = self._new_context(identifier, resolution_options)
+        # The generator runs in its consumer's context, so the deadline set there is removed
+        # once the generator finishes
+        timeout = resolution_options.get("timeout")
+        token = context.set_timeout(timeout) if timeout is not None else None
+        try:
+            initial_document = await self.resolve_initial_document(
+                context, id_type, version, genesis_bytes
+            )
+            yield {
+                "versionId": 1,
+                "blockHeight": None,
+                "blockTime": None,
+                "update": None,
+                "updateHash": None,
+                "didDocument": initial_document.model_copy(deep=True),
+            }
+
+            await self.prepare_traversal(context)
+            if context.request_version_id == 1:
+                return
+            async with aclosing(
+                self.traverse_versions(initial_document.model_copy(), 0, 1, context)
+            ) as versions:
+                async for did_version in versions:
+                    yield did_version
+        finally:
+            if token is not None:
+                request_deadline.reset(token)
+
+    async def resolve_history(self, identifier, resolution_options=None):
+        """
+        Traverse the whole history of a DID once and index every version.
+
+        Returns a ``VersionHistory`` whose ``resolve(version_id=..., version_time=...)``
+        answers historical queries without traversing again. ``versionId`` and
+        ``versionTime`` resolution options are ignored; ``sidecarData`` and ``timeout``
+        apply as for ``resolve``.
+        """
+        resolution_options = {
+            key: value
+            for key, value in (resolution_options or {}).items()
+            if key not in ("versionId", "versionTime")
+        }
+        network = decode_identifier(identifier)[2]
+        history = None
+        with start_span("btcr2.resolve_history", {"btcr2.did": identifier}, self.tracer):
+            async with aclosing(self.iter_versions(identifier, resolution_options)) as versions:
+                async for did_version in versions:
+                    if history is None:
+                        history = VersionHistory(identifier, network, did_version["didDocument"])
+                        continue
+                    history.append(
+                        did_version["versionId"],
+                        did_version["blockHeight"],
+                        did_version["blockTime"],
+                        did_version["update"],
+                        did_version["updateHash"],
+                        did_version["didDocument"],
+                    )
+        logger.info("Indexed %d versions of %s", len(history), identifier)
+        return history
+
+    def timeout_result(self, context):
+        context.profile.finish()
+        resolution_metadata = {
+            "error": "resolutionTimeout",
+            "errorMessage": timeout_message(context.resolution_options.get("timeout")),
+            "progress": context.progress(),
+        }
+        if context.resolution_options.get("profile"):
+            resolution_metadata["profile"] = context.profile.serialize()
+        return {
+            "didDocument": None,
+            "didResolutionMetadata": resolution_metadata,
+            "didDocumentMetadata": {"network": context.network},
+        }
+
     def resolve_deterministic(self, btcr2_identifier, key_bytes, version, network):
         logger.debug("Resolving deterministic DID: %s", btcr2_identifier)
         pubkey = S256Point.parse_sec(key_bytes)
@@ -130,7 +405,9 @@ class Btcr2Resolver:
                 btcr2_identifier, genesis_bytes, version, network, initial_document
             )
         else:
-            initial_document = self.cas_retrieval(btcr2_identifier, genesis_bytes, version, network)
+            initial_document = await self.cas_retrieval(
+                btcr2_identifier, genesis_bytes, version, network
+            )
 
         # TODO: validate initial document
 
@@ -157,13 +434,43 @@ class Btcr2Resolver:
         return initial_document
 
     async def cas_retrieval(self, btcr2_identifier, genesis_bytes, version, network):
-        cid_sha256_wrap_digest(genesis_bytes)
-        # TODO: Attempt to fetch content for CID from IPFS
-        raise NotImplementedError
+        """
+        Fetch the intermediate document committed to by ``genesis_bytes`` from the content
+        store and turn it into the initial DID document.
+        """
+        cid = cid_sha256_wrap_digest(genesis_bytes)
+        if self.content_store is None:
+            raise Exception(f"No content store to retrieve initial document {cid}")
+        logger.info("Retrieving initial document %s", cid)
+        intermediate_json = await asyncio.to_thread(self.content_store.get_json, genesis_bytes)
+        if intermediate_json is None:
+            raise Exception(f"Initial document {cid} not found")
+        intermediate_doc = IntermediateBtcr2DIDDocument.deserialize(intermediate_json)
+        return intermediate_doc.to_did_document(btcr2_identifier)
 
     async def resolve_target_document(
-        self, initial_document: DIDDocument, resolution_options, network
+        self, initial_document: DIDDocument, context: ResolutionContext
     ):
+        await self.prepare_traversal(context)
+
+        current_version_id = 1
+
+        if current_version_id == context.request_version_id:
+            return initial_document, current_version_id
+
+        contemporary_blockheight = 0
+
+        contemporary_document = initial_document.model_copy()
+
+        target_document, current_version_id = await self.traverse_blockchain_history(
+            contemporary_document, contemporary_blockheight, current_version_id, context
+        )
+
+        return target_document, current_version_id
+
+    async def prepare_traversal(self, context: ResolutionContext):
+        """Set the traversal target and sidecar data on ``context`` from its options."""
+        resolution_options = context.resolution_options
         request_version_id = resolution_options.get("versionId")
         version_time = resolution_options.get("versionTime")
         logger.debug(
@@ -177,257 +484,480 @@ class Btcr2Resolver:
 
         if not request_version_id and not version_time:
             version_time = datetime.datetime.now().timestamp()
+        elif version_time:
+            # Blocks above this height are too late to matter, so they are never fetched
+            block_index = self.networks[context.network]["block_index"]
+            with context.profile.phase(ESPLORA):
+                context.height_bound = await asyncio.to_thread(
+                    block_index.height_bound, version_time
+                )
 
-        sidecar_data = resolution_options.get("sidecarData")
-
-        signals_metadata = None
-        if sidecar_data:
-            signals_metadata = sidecar_data.get("signalsMetadata")
-
-        current_version_id = 1
-
-        if current_version_id == request_version_id:
-            return initial_document, current_version_id
-
-        update_hash_history = []
-
-        contemporary_blockheight = 0
-
-        contemporary_document = initial_document.model_copy()
-
-        target_document, current_version_id = await self.traverse_blockchain_history(
-            contemporary_document,
-            contemporary_blockheight,
-            current_version_id,
-            request_version_id,
-            version_time,
-            update_hash_history,
-            signals_metadata,
-            network,
-        )
+        # Supplied updates are indexed and checked to chain together before any signal is
+        # fetched, so their signals can be matched by hash without downloading them.
+        context.sidecar = SidecarIndex(resolution_options.get("sidecarData"))
+        context.sidecar.check_chain()
 
-        return target_document, current_version_id
+        context.request_version_id = request_version_id
+        context.version_time = version_time
 
     async def traverse_blockchain_history(
         self,
         contemporary_document: Btcr2Document,
         contemporary_blockheight,
         current_version_id,
-        request_version_id,
-        target_time,
-        update_hash_history,
-        signals_metadata,
-        network,
+        context: ResolutionContext,
     ):
-        contemporary_hash = contemporary_document.model_copy(deep=True).canonicalize()
-        beacons = []
-        for service in contemporary_document.service:
-            # print("SERVICETYPE", service.type, type(service))
-            if service.type in BeaconTypeNames:
-                beacons.append(service)
-
-        next_signals = await self.find_next_signals(beacons, contemporary_blockheight, network)
-        logger.debug("Next Signals: %s", next_signals)
-        if len(next_signals) == 0:
-            return contemporary_document, current_version_id
-
-        # print("Next Signals", next_signals[0]['status']["block_time"], target_time)
-        if next_signals[0]["block_time"] > target_time:
-            return contemporary_document, current_version_id
-
-        contemporary_blockheight = next_signals[0]["block_height"]
-        logger.debug("Block height: %s, target time: %s", contemporary_blockheight, target_time)
-        # signals = next_signals["signals"]
-
-        updates = self.process_beacon_signals(next_signals, signals_metadata)
-
-        logger.debug("Updates: %s", updates)
-
-        if self.logging and len(updates) != 0:
-            self.block_folder = f"{self.log_folder}/block{contemporary_blockheight}"
-            if not os.path.exists(self.block_folder):
-                os.makedirs(self.block_folder)
-            # next_signals_path = f"{block_folder}/next_signals.json"
-
-            # with open(next_signals_path, "w") as f:
-            #     print(next_signals)
-            #     serialized_signals = copy.deepcopy(next_signals)
-            #     for index, tx in enumerate(serialized_signals["signals"]):
-            #         serialized_signals["signals"][index] = tx.serialize().hex()
-            #     json.dump(serialized_signals, f, indent=2)
-
-            updates_path = f"{self.block_folder}/updates.json"
-
-            with open(updates_path, "w") as f:
-                json.dump(updates, f, indent=2)
-
-        updates.sort(key=lambda update: update["targetVersionId"])
-
-        for update in updates:
-            target_version_id = update["targetVersionId"]
-            if target_version_id <= current_version_id:
-                self.confirm_duplicate_update(update, update_hash_history)
-            elif target_version_id == current_version_id + 1:
-                logger.debug(
-                    "Source hash: %s, contemporary hash: %s",
-                    update["sourceHash"],
-                    bytes_to_str(base58.b58encode(contemporary_hash)),
-                )
-                if update["sourceHash"] != bytes_to_str(base58.b58encode(contemporary_hash)):
-                    raise Exception("Late Publishing")
-                logger.info("Apply DID Update: %s", update)
-                contemporary_document = self.apply_did_update(
-                    contemporary_document, update
-                ).model_copy(deep=True)
-                if self.logging:
-                    contemporary_path = f"{self.block_folder}/contemporaryDidDocument.json"
-                    with open(contemporary_path, "w") as f:
-                        json.dump(contemporary_document.serialize(), f, indent=2)
-
-                current_version_id += 1
-                updateHash = sha256(jcs.canonicalize(update))
-                update_hash_history.append(updateHash)
-                contemporary_hash = bytes_to_str(
-                    base58.b58encode(contemporary_document.canonicalize())
-                )
-                if current_version_id == request_version_id:
-                    logger.info("Found document for target version: %s", contemporary_document)
-                    return contemporary_document, current_version_id
+        """
+        Walk the beacon signals of the DID from ``contemporary_blockheight``, applying updates
+        until the requested version or time is reached or no signals remain.
+        """
+        async with aclosing(
+            self.traverse_versions(
+                contemporary_document, contemporary_blockheight, current_version_id, context
+            )
+        ) as versions:
+            async for version in versions:
+                contemporary_document = version["didDocument"]
+                current_version_id = version["versionId"]
+        return contemporary_document, current_version_id
 
-            elif target_version_id > current_version_id + 1:
+    async def traverse_versions(
+        self,
+        contemporary_document: Btcr2Document,
+        contemporary_blockheight,
+        current_version_id,
+        context: ResolutionContext,
+    ):
+        """
+        Async generator over the versions applied while walking the beacon signals of the
+        DID, stopping at the requested version or time.
+
+        Each version is a dict with ``versionId``, ``blockHeight``, ``blockTime``, ``update``,
+        ``updateHash`` and the resulting ``didDocument``, yielded as soon as the update is
+        verified. Signals are prefetched by a ``SignalPipeline`` while updates are verified,
+        and proof verification runs in a worker thread, so network I/O overlaps with
+        verification. Close the generator (e.g. with ``contextlib.aclosing``) when stopping
+        early, to cancel prefetching.
+        """
+        request_version_id = context.request_version_id
+        target_time = context.version_time
+        update_hashes = context.update_hashes
+        profile = context.profile
+        pipeline = None
+        try:
+            while True:
+                beacons = contemporary_document.beacon_services()
+                if pipeline is None or pipeline.key != beacon_key(beacons):
+                    if pipeline is not None:
+                        logger.debug("Beacons changed, restarting signal pipeline")
+                        await pipeline.close()
+                    pipeline = SignalPipeline(self, beacons, contemporary_blockheight, context)
+
+                context.check_deadline()
+                context.traversal_steps += 1
+                profile.count("traversalSteps")
+                context.block_height = contemporary_blockheight
+                with profile.phase(CANONICALIZE):
+                    contemporary_hash = contemporary_document.model_copy(deep=True).canonicalize()
+
+                span_attributes = {
+                    "btcr2.block_height": contemporary_blockheight,
+                    "btcr2.beacons": len(beacons),
+                }
+                with start_span("btcr2.find_next_signals", span_attributes, self.tracer) as span:
+                    next_signals = await pipeline.next_signals()
+                    span.set_attribute("btcr2.signals", len(next_signals))
+                logger.debug("Next Signals: %s", next_signals)
+                if len(next_signals) == 0:
+                    return
+
+                block_time = next_signals[0]["block_time"]
+                if target_time is not None and block_time > target_time:
+                    return
+
+                contemporary_blockheight = next_signals[0]["block_height"]
+                context.block_height = contemporary_blockheight
                 logger.debug(
-                    "target_version_id: %s, current_version_id: %s",
-                    target_version_id,
-                    current_version_id,
+                    "Block height: %s, target time: %s", contemporary_blockheight, target_time
                 )
-                raise Exception(f"Late publishing {target_version_id} {current_version_id}")
 
-        logger.debug("Tracking: %s %s", contemporary_blockheight, target_time)
-        if contemporary_blockheight == target_time:
-            logger.info("Got to target: %s", contemporary_blockheight)
-            return contemporary_document
-
-        contemporary_blockheight += 1
-
-        target_document, current_version_id = await self.traverse_blockchain_history(
-            contemporary_document,
-            contemporary_blockheight,
-            current_version_id,
-            request_version_id,
-            target_time,
-            update_hash_history,
-            signals_metadata,
-            network,
+                profile.count("signals", len(next_signals))
+                for signal in next_signals:
+                    SIGNALS_PROCESSED.inc(labels=(context.network, signal["beaconType"]))
+                with profile.phase(SIGNAL_PROCESSING):
+                    updates = self.process_beacon_signals(
+                        next_signals, context.sidecar, context.identifier
+                    )
+
+                logger.debug("Updates: %s", updates)
+
+                if self.logging and len(updates) != 0:
+                    block_folder = context.enter_block(contemporary_blockheight)
+                    self.vector_writer.write_json(
+                        f"{block_folder}/updates.json", [update for update, _ in updates]
+                    )
+
+                updates.sort(key=lambda signal_update: signal_update[0]["targetVersionId"])
+
+                # Cheap checks (version ordering, duplicate hash, source hash) come before
+                # applying an update, and apply_did_update verifies the proof last.
+                for update, update_hash in updates:
+                    target_version_id = update["targetVersionId"]
+                    if target_version_id <= current_version_id:
+                        self.confirm_duplicate_update(update, update_hashes, update_hash)
+                    elif target_version_id == current_version_id + 1:
+                        source_hash = bytes_to_str(base58.b58encode(contemporary_hash))
+                        logger.debug(
+                            "Source hash: %s, contemporary hash: %s",
+                            update["sourceHash"],
+                            source_hash,
+                        )
+                        if update["sourceHash"] != source_hash:
+                            raise Exception("Late Publishing")
+                        logger.info("Apply DID Update: %s", update)
+                        # Verification is CPU bound; keep the event loop free for the pipeline
+                        contemporary_document = await asyncio.to_thread(
+                            self.apply_did_update, contemporary_document, update, context
+                        )
+                        contemporary_document = contemporary_document.model_copy(deep=True)
+                        if self.logging:
+                            self.vector_writer.write_json(
+                                f"{context.block_folder}/contemporaryDidDocument.json",
+                                contemporary_document.serialize(),
+                            )
+
+                        current_version_id += 1
+                        context.version_id = current_version_id
+                        profile.count("updatesApplied")
+                        update_hashes[target_version_id] = update_hash
+                        with profile.phase(CANONICALIZE):
+                            contemporary_hash = contemporary_document.canonicalize()
+
+                        yield {
+                            "versionId": current_version_id,
+                            "blockHeight": contemporary_blockheight,
+                            "blockTime": block_time,
+                            "update": update,
+                            "updateHash": update_hash,
+                            # The consumer may keep or modify its version; the walk goes on
+                            # from this one
+                            "didDocument": contemporary_document.model_copy(deep=True),
+                        }
+
+                        if current_version_id == request_version_id:
+                            logger.info(
+                                "Found document for target version: %s", contemporary_document
+                            )
+                            return
+
+                    elif target_version_id > current_version_id + 1:
+                        logger.debug(
+                            "target_version_id: %s, current_version_id: %s",
+                            target_version_id,
+                            current_version_id,
+                        )
+                        raise Exception(f"Late publishing {target_version_id} {current_version_id}")
+
+                contemporary_blockheight += 1
+        finally:
+            if pipeline is not None:
+                await pipeline.close()
+
+    async def find_next_signals(
+        self,
+        beacons,
+        contemporary_blockheight,
+        network,
+        profile=NULL_PROFILE,
+        max_height=None,
+        sidecar=None,
+        identifier=None,
+    ):
+        """Signals of the earliest block at or after ``contemporary_blockheight``."""
+        blocks = await self.fetch_candidate_blocks(
+            beacons, contemporary_blockheight, network, profile, max_height
         )
+        if not blocks:
+            return []
+        signals = await self.parse_block_signals(blocks[0], network, profile, sidecar, identifier)
+        logger.debug("Found %d signals at earliest block height", len(signals))
+        return signals
 
-        return target_document, current_version_id
-
-    async def find_next_signals(self, beacons, contemporary_blockheight, network):
-        signals = []
+    async def fetch_candidate_blocks(
+        self, beacons, contemporary_blockheight, network, profile=NULL_PROFILE, max_height=None
+    ):
+        """
+        List the beacon addresses' transactions, concurrently, and group the candidate
+        signals (confirmed transactions spending from a beacon address) by block, up to
+        ``max_height`` when given.
+
+        Returns blocks in height order, each a dict with ``block_height``, ``block_time`` and
+        ``candidates``, a list of ``(beacon, tx_data)`` pairs.
+        """
         esplora_client = self.networks[network]["esplora_client"]
         logger.debug(
             "Scanning %d beacons from block height %s", len(beacons), contemporary_blockheight
         )
-        for beacon in beacons:
+
+        async def beacon_transactions(beacon):
             address = beacon.address()
             logger.debug("Checking beacon %s at address %s", beacon.id, address)
-            txs = esplora_client.get_address_transactions(address)
+            with profile.phase(ESPLORA, beacon.id):
+                txs = await asyncio.to_thread(esplora_client.get_address_transactions, address)
+            return beacon, address, txs
+
+        blocks = {}
+        results = await asyncio.gather(*(beacon_transactions(beacon) for beacon in beacons))
+        for beacon, address, txs in results:
             for tx_data in txs:
                 # Only care about bitcoin transactions that have been accepted into the chain.
 
                 # Skip transactions that haven't been confirmed yet or are from earlier blocks
                 if "status" not in tx_data or "block_height" not in tx_data["status"]:
                     continue
-                if tx_data["status"]["block_height"] < contemporary_blockheight:
+                block_height = tx_data["status"]["block_height"]
+                if block_height < contemporary_blockheight:
+                    continue
+                if max_height is not None and block_height > max_height:
                     continue
 
                 if any(vin["prevout"]["scriptpubkey_address"] == address for vin in tx_data["vin"]):
-                    tx_hex = esplora_client.get_transaction_hex(tx_data["txid"])
-                    tx = Tx.parse_hex(tx_hex)
-                    signal = {
-                        "beaconId": beacon.id,
-                        "beaconType": beacon.type,
-                        "tx": tx,
-                        "block_height": tx_data["status"]["block_height"],
-                        "block_time": tx_data["status"]["block_time"],
-                    }
-                    signals.append(signal)
-
-        # Sort signals by block height
-        signals.sort(key=lambda signal: signal["block_height"])
-
-        # Only keep signals from the earliest block height found
-        if signals:
-            min_height = signals[0]["block_height"]
-            signals = [signal for signal in signals if signal["block_height"] == min_height]
+                    block = blocks.setdefault(
+                        block_height,
+                        {
+                            "block_height": block_height,
+                            "block_time": tx_data["status"]["block_time"],
+                            "candidates": [],
+                        },
+                    )
+                    block["candidates"].append((beacon, tx_data))
+
+        return [blocks[height] for height in sorted(blocks)]
+
+    async def parse_block_signals(
+        self, block, network, profile=NULL_PROFILE, sidecar=None, identifier=None
+    ):
+        """
+        Turn one candidate block into beacon signals for ``identifier``, each carrying the
+        ``txid`` and the ``signalHash`` its last output commits to.
+
+        A singleton beacon transaction whose commitment (read from the Esplora transaction
+        listing) matches an update supplied in ``sidecar``, an SMT aggregate beacon
+        transaction with an SMT proof in ``sidecar``, or a CID aggregate beacon transaction
+        whose bundle is supplied or already cached, needs nothing more; other transactions
+        are fetched and parsed. The bundle of a CID aggregate signal is attached as
+        ``bundle`` (DID -> update hash), and an update payload not supplied in ``sidecar`` is
+        then fetched from the content store as ``updatePayload``.
+        """
+        esplora_client = self.networks[network]["esplora_client"]
 
-        logger.debug("Found %d signals at earliest block height", len(signals))
-        return signals
+        async def parse_signal(beacon, tx_data):
+            signal = {
+                "beaconId": beacon.id,
+                "beaconType": beacon.type,
+                "txid": tx_data["txid"],
+                "tx": None,
+                "signalHash": None,
+                "block_height": block["block_height"],
+                "block_time": block["block_time"],
+            }
+            smt_proof = sidecar.smt_proof(tx_data["txid"]) if sidecar is not None else None
+            if sidecar is not None:
+                vout = tx_data.get("vout") or [{}]
+                signal_hash = signal_hash_from_script(vout[-1].get("scriptpubkey", ""))
+                if signal_hash is not None and (
+                    (beacon.type == SINGLETON_BEACON_TYPE and sidecar.update(signal_hash))
+                    or (beacon.type == SMT_AGGREGATE_BEACON_TYPE and smt_proof is not None)
+                    or (
+                        beacon.type == CID_AGGREGATE_BEACON_TYPE
+                        and (sidecar.bundle(signal_hash) or signal_hash in self.bundle_cache)
+                    )
+                ):
+                    signal["signalHash"] = signal_hash
+
+            if signal["signalHash"] is None:
+                with profile.phase(ESPLORA, beacon.id):
+                    tx_hex = await asyncio.to_thread(
+                        esplora_client.get_transaction_hex, tx_data["txid"]
+                    )
+                with profile.phase(TX_PARSE, beacon.id):
+                    tx = Tx.parse_hex(tx_hex)
+                signal["tx"] = tx
+                signal["signalHash"] = signal_hash_from_tx(tx)
+
+            # Hash of the update payload the signal announces, when known before verification
+            payload_hash = None
+            if beacon.type == SINGLETON_BEACON_TYPE:
+                payload_hash = signal["signalHash"]
+            elif beacon.type == SMT_AGGREGATE_BEACON_TYPE and smt_proof:
+                update_id = smt_proof.get("updateId")
+                payload_hash = bytes.fromhex(update_id) if update_id else None
+            elif beacon.type == CID_AGGREGATE_BEACON_TYPE and signal["signalHash"] is not None:
+                signal["bundle"] = await self.cid_bundle(
+                    signal["signalHash"], sidecar, profile, beacon.id
+                )
+                payload_hash = signal["bundle"].get(identifier)
+            if (
+                self.content_store is not None
+                and payload_hash is not None
+                and not (sidecar is not None and sidecar.update(payload_hash))
+            ):
+                with profile.phase(CAS_RETRIEVAL, beacon.id):
+                    signal["updatePayload"] = await asyncio.to_thread(
+                        self.content_store.get_json, payload_hash
+                    )
+            return signal
+
+        return list(
+            await asyncio.gather(
+                *(parse_signal(beacon, tx_data) for beacon, tx_data in block["candidates"])
+            )
+        )
 
-    def process_beacon_signals(self, signals, signals_metadata):
+    async def cid_bundle(self, bundle_hash, sidecar=None, profile=NULL_PROFILE, beacon_id=None):
+        """Index of the CID aggregate bundle hashing to ``bundle_hash``, fetched at most once."""
+
+        async def fetch(bundle_hash):
+            bundle = sidecar.bundle(bundle_hash) if sidecar is not None else None
+            if bundle is None and self.content_store is not None:
+                with profile.phase(CAS_RETRIEVAL, beacon_id):
+                    bundle = await asyncio.to_thread(self.content_store.get_json, bundle_hash)
+            if bundle is None:
+                raise Exception(f"Aggregate bundle {cid_sha256_wrap_digest(bundle_hash)} not found")
+            return bundle
+
+        return await self.bundle_cache.get(bundle_hash, fetch)
+
+    def process_beacon_signals(self, signals, sidecar=None, identifier=None):
+        """
+        Extract the DID update payloads announced by ``signals`` for ``identifier``.
+
+        Returns ``(update, update_hash)`` pairs, where ``update_hash`` is the announced hash
+        the payload was checked against, so it never has to be recomputed.
+        """
+        if sidecar is None:
+            sidecar = SidecarIndex()
         updates = []
 
         for signal in signals:
             type = signal["beaconType"]
-            signal_tx = signal["tx"]
-            signal_id = signal_tx.id()
-            signal_sidecar_data = signals_metadata.get(signal_id)
             did_update_payload = None
             if type == SINGLETON_BEACON_TYPE:
-                logger.debug("Signal ID: %s", signal_id)
-                did_update_payload = self.process_singleton_beacon_signal(
-                    signal_tx, signal_sidecar_data
+                logger.debug("Signal ID: %s", signal["txid"])
+                did_update_payload, update_hash = self.process_singleton_beacon_signal(
+                    signal, sidecar
+                )
+            elif type == SMT_AGGREGATE_BEACON_TYPE:
+                logger.debug("SMT signal ID: %s", signal["txid"])
+                did_update_payload, update_hash = self.process_smt_beacon_signal(
+                    signal, sidecar, identifier
+                )
+            elif type == CID_AGGREGATE_BEACON_TYPE:
+                logger.debug("CID aggregate signal ID: %s", signal["txid"])
+                did_update_payload, update_hash = self.process_cid_beacon_signal(
+                    signal, sidecar, identifier
                 )
 
             if did_update_payload:
-                updates.append(did_update_payload)
+                check_update_shape(did_update_payload)
+                updates.append((did_update_payload, update_hash))
 
         return updates
 
-    def process_singleton_beacon_signal(self, tx: Tx, signal_sidecar_data):
-        tx_out = tx.tx_outs[len(tx.tx_outs) - 1]
-        did_update_payload = None
-        logger.debug("TX OUT: %s", tx_out.script_pubkey.commands[1])
-        if (
-            tx_out.script_pubkey.commands[0] != OP_RETURN
-            and len(tx_out.script_pubkey.commands[1]) != 32
-        ):
-            logger.warning("Not a beacon signal")
-            return did_update_payload
+    def process_singleton_beacon_signal(self, signal, sidecar):
+        hash_bytes = signal["signalHash"]
+        if hash_bytes is None:
+            logger.warning("Not a beacon signal: %s", signal["txid"])
+            return None, None
 
-        hash_bytes = tx_out.script_pubkey.commands[1]
         logger.debug("Beacon signal hash: %s", hash_bytes.hex())
 
-        if signal_sidecar_data:
-            did_update_payload = signal_sidecar_data.get("updatePayload")
-
-            if not did_update_payload:
-                raise Exception("InvalidSidecarData")
-
-            update_hash_bytes = sha256(jcs.canonicalize(did_update_payload))
-
-            if update_hash_bytes != hash_bytes:
-                raise Exception("InvalidSidecarData")
-
-            return did_update_payload
-        else:
-            cid_sha256_wrap_digest(hash_bytes)
-            # TODO: Fetch payload from IPFS
-            raise Exception("Not implemented")
-
-    def confirm_duplicate_update(self, update, update_hash_history):
-
-        update_hash = sha256(jcs.canonicalize(update))
-        # Note: version starts at 1, index starts at 0
-        update_hash_index = update["targetVersionId"] - 2
-        historical_update_hash = update_hash_history[update_hash_index]
-        if historical_update_hash != update_hash:
+        # Sidecar data first, then the payload fetched from the content store with the signal
+        did_update_payload = sidecar.update(hash_bytes) or signal.get("updatePayload")
+        if did_update_payload is None:
+            raise Exception(f"Update payload {cid_sha256_wrap_digest(hash_bytes)} not found")
+        return did_update_payload, hash_bytes
+
+    def process_smt_beacon_signal(self, signal, sidecar, identifier):
+        """
+        Verify the sidecar SMT proof for ``identifier`` against the root committed to by an
+        SMT aggregate beacon signal, returning the update it includes, if any.
+        """
+        root = signal["signalHash"]
+        if root is None:
+            logger.warning("Not a beacon signal: %s", signal["txid"])
+            return None, None
+
+        proof = sidecar.smt_proof(signal["txid"])
+        if proof is None:
+            raise Exception(f"SMT proof for {identifier} in {signal['txid']} not found")
+
+        with start_span("btcr2.verify_smt_proof", {"btcr2.txid": signal["txid"]}, self.tracer):
+            update_hash = self.smt_verifier(root).verify(identifier, proof)
+        if update_hash is None:
+            # Non-inclusion: the aggregated signal carries no update for this DID
+            return None, None
+
+        did_update_payload = sidecar.update(update_hash) or signal.get("updatePayload")
+        if did_update_payload is None:
+            raise Exception(f"Update payload {cid_sha256_wrap_digest(update_hash)} not found")
+        return did_update_payload, update_hash
+
+    def process_cid_beacon_signal(self, signal, sidecar, identifier):
+        """The update a CID aggregate beacon signal's bundle announces for ``identifier``."""
+        bundle = signal.get("bundle")
+        if bundle is None:
+            logger.warning("Not a beacon signal: %s", signal["txid"])
+            return None, None
+
+        update_hash = bundle.get(identifier)
+        if update_hash is None:
+            return None, None
+
+        did_update_payload = sidecar.update(update_hash) or signal.get("updatePayload")
+        if did_update_payload is None:
+            raise Exception(f"Update payload {cid_sha256_wrap_digest(update_hash)} not found")
+        return did_update_payload, update_hash
+
+    def smt_verifier(self, root):
+        """The shared ``SMTVerifier`` for ``root``, kept for the most recently used roots."""
+        with self._smt_lock:
+            verifier = self._smt_verifiers.get(root)
+            if verifier is None:
+                verifier = self._smt_verifiers[root] = SMTVerifier(root)
+                if len(self._smt_verifiers) > SMT_VERIFIER_CACHE_SIZE:
+                    self._smt_verifiers.popitem(last=False)
+            else:
+                self._smt_verifiers.move_to_end(root)
+            return verifier
+
+    def confirm_duplicate_update(self, update, update_hashes, update_hash=None):
+        """
+        Check that a re-announced update matches the update applied for its version.
+
+        ``update_hashes`` maps targetVersionId to the hash of the applied update; pass the
+        announced ``update_hash`` when known to skip hashing ``update`` again.
+        """
+        if update_hash is None:
+            update_hash = sha256(jcs.canonicalize(update))
+        if update_hashes.get(update["targetVersionId"]) != update_hash:
             raise Exception("Late Publishing Error")
-        return
 
-    def apply_did_update(self, contemporary_document, update):
-        # Retrieve the verification method used to secure the proof from the
-        # contemporary DID document
+    def apply_did_update(self, contemporary_document, update, context=None):
+        span_attributes = {"btcr2.target_version_id": update.get("targetVersionId")}
+        with start_span("btcr2.apply_did_update", span_attributes, self.tracer):
+            return self._apply_did_update(contemporary_document, update, context)
+
+    def _apply_did_update(self, contemporary_document, update, context):
+        """
+        Apply ``update`` to ``contemporary_document``.
+
+        Checks run cheapest first, so a malformed or mismatched update is rejected before
+        any elliptic curve math: payload shape, capability controller, verification method,
+        then the patch result against ``targetHash``, and the Schnorr proof last.
+        """
+        profile = context.profile if context else NULL_PROFILE
+        check_update_shape(update)
         capability_id = update["proof"]["capability"]
         document_to_update = contemporary_document.model_copy(deep=True)
 
@@ -436,6 +966,8 @@ class Btcr2Resolver:
         if root_capability["controller"] != document_to_update.id:
             raise Exception("Invalid Capability Invocation")
 
+        # Retrieve the verification method used to secure the proof from the
+        # contemporary DID document
         proof_vm_id = update["proof"]["verificationMethod"]
         btcr2_identifier = document_to_update.id
         verification_method = None
@@ -448,60 +980,67 @@ class Btcr2Resolver:
                 verification_method = vm.serialize()
         if verification_method is None:
             raise Exception("Invalid Proof on Update Payload")
-        multikey = SchnorrSecp256k1Multikey.from_verification_method(verification_method)
 
-        # Instantiate a schnorr-secp256k1-2025 cryptosuite instance.
-        cryptosuite = Bip340JcsCryptoSuite(multikey)
-        di_proof = DataIntegrityProof(cryptosuite=cryptosuite)
-
-        mediaType = "application/json"
+        with profile.phase(JSON_PATCH), start_span("btcr2.json_patch", tracer=self.tracer):
+            target_did_document = copy.deepcopy(document_to_update.serialize())
 
-        expected_proof_purpose = PROOF_PURPOSE
+            update_patch = update["patch"]
 
-        update_bytes = json.dumps(update)
+            patch = jsonpatch.JsonPatch(update_patch)
 
-        if self.logging:
-            canonical_update = jcs.canonicalize(update)
-            update_hash = sha256(canonical_update)
+            target_did_document = patch.apply(target_did_document)
 
-            with open(f"{self.block_folder}/canonical_document.txt", "w") as f:
-                f.write(bytes_to_str(canonical_update))
+        with profile.phase(CANONICALIZE), start_span("btcr2.hash", tracer=self.tracer):
+            target_hash = bytes_to_str(
+                base58.b58encode(sha256(jcs.canonicalize(target_did_document)))
+            )
 
-            with open(f"{self.block_folder}/update_hash_hex.txt", "w") as f:
-                f.write(update_hash.hex())
+        logger.debug("Target hash check: %s %s", update["targetHash"], target_hash)
+        if target_hash != update["targetHash"]:
+            raise Exception("LatePublishingError")
 
-        verificationResult = di_proof.verify_proof(
-            mediaType, update_bytes, expected_proof_purpose, None, None
-        )
-        logger.debug("Proof verification result: %s", verificationResult)
+        with profile.phase(CANONICALIZE), start_span("btcr2.hash", tracer=self.tracer):
+            target_doc = Btcr2Document.model_validate(target_did_document)
 
-        if not verificationResult["verified"]:
-            raise Exception("invalidUpdateProof")
+            serialzied_doc = target_doc.serialize()
 
-        target_did_document = copy.deepcopy(document_to_update.serialize())
+            compare_dictionaries(serialzied_doc, target_did_document)
 
-        update_patch = update["patch"]
+            test_hash = bytes_to_str(base58.b58encode(target_doc.canonicalize()))
 
-        patch = jsonpatch.JsonPatch(update_patch)
+        if target_hash != test_hash:
+            raise Exception("LatePublishingError")
 
-        target_did_document = patch.apply(target_did_document)
+        multikey = SchnorrSecp256k1Multikey.from_verification_method(verification_method)
 
-        target_hash = bytes_to_str(base58.b58encode(sha256(jcs.canonicalize(target_did_document))))
+        # Instantiate a schnorr-secp256k1-2025 cryptosuite instance.
+        cryptosuite = Bip340JcsCryptoSuite(multikey)
+        di_proof = DataIntegrityProof(cryptosuite=cryptosuite)
 
-        target_doc = Btcr2Document.model_validate(target_did_document)
+        mediaType = "application/json"
 
-        serialzied_doc = target_doc.serialize()
+        expected_proof_purpose = PROOF_PURPOSE
 
-        compare_dictionaries(serialzied_doc, target_did_document)
+        update_bytes = json.dumps(update)
 
-        test_hash = bytes_to_str(base58.b58encode(target_doc.canonicalize()))
+        if self.logging and context and context.block_folder:
+            self.vector_writer.write_text(
+                f"{context.block_folder}/canonical_document.txt",
+                lambda: bytes_to_str(jcs.canonicalize(update)),
+            )
+            self.vector_writer.write_text(
+                f"{context.block_folder}/update_hash_hex.txt",
+                lambda: sha256(jcs.canonicalize(update)).hex(),
+            )
 
-        logger.debug("Target hash check: %s %s", update["targetHash"], target_hash)
-        if target_hash != update["targetHash"]:
-            raise Exception("LatePublishingError")
+        with profile.phase(VERIFY_PROOF), start_span("btcr2.verify_proof", tracer=self.tracer):
+            verificationResult = di_proof.verify_proof(
+                mediaType, update_bytes, expected_proof_purpose, None, None
+            )
+        logger.debug("Proof verification result: %s", verificationResult)
 
-        if target_hash != test_hash:
-            raise Exception("LatePublishingError")
+        if not verificationResult["verified"]:
+            raise Exception("invalidUpdateProof")
 
         return Btcr2Document.deserialize(target_did_document)
 
@@ -522,6 +1061,46 @@ class Btcr2Resolver:
         }
 
 
+def check_update_shape(update):
+    """Reject an update payload that is not structurally a DID update, before any crypto."""
+    if not isinstance(update, dict):
+        raise Exception("InvalidUpdate")
+    proof = update.get("proof")
+    patch = update.get("patch")
+    target_version_id = update.get("targetVersionId")
+    if (
+        not isinstance(target_version_id, int)
+        or isinstance(target_version_id, bool)
+        or target_version_id < 2
+        or not isinstance(update.get("sourceHash"), str)
+        or not isinstance(update.get("targetHash"), str)
+        or not isinstance(proof, dict)
+        or not isinstance(proof.get("capability"), str)
+        or not isinstance(proof.get("verificationMethod"), str)
+        or not isinstance(patch, list)
+    ):
+        raise Exception("InvalidUpdate")
+    for operation in patch:
+        if (
+            not isinstance(operation, dict)
+            or operation.get("op") not in PATCH_OPERATIONS
+            or not isinstance(operation.get("path"), str)
+        ):
+            raise Exception("InvalidUpdate")
+
+
+def timeout_message(timeout):
+    if timeout is None:
+        # The deadline came from the caller's context rather than the resolution options
+        return "Resolution exceeded the request deadline"
+    return f"Resolution exceeded its timeout of {timeout}s"
+
+
+def options_digest(resolution_options):
+    """Digest of the resolution options, used to recognise identical resolution requests."""
+    return sha256(jcs.canonicalize(resolution_options)).hex()
+
+
 def compare_dictionaries(dict1, dict2):
     if len(dict1) != len(dict2):
         return False
@@ -0,0 +1,91 @@
+import logging
+
+import jcs
+from buidl.helper import sha256
+
+from .constants import OP_RETURN
+
+logger = logging.getLogger(__name__)
+
+
+class SidecarIndex:
+    """
+    Update payloads supplied in a resolution's ``sidecarData``, indexed up front.
+
+    Payloads from ``signalsMetadata`` are hashed once (SHA-256 of their JCS canonical form)
+    and indexed by hash and by ``targetVersionId``, so a beacon signal is matched to its
+    payload by the hash it commits to, and the supplied updates can be checked to form a
+    single chain before anything is fetched from the network. SMT aggregate beacon proofs
+    (``smtProof``) are indexed by the txid of the signal they are for, and CID aggregate
+    beacon bundles (``aggregateBundle``) by the hash of their JCS canonical form.
+    """
+
+    def __init__(self, sidecar_data=None):
+        self.by_hash = {}
+        self.by_version = {}
+        # txid -> SMT proof for the resolved DID
+        self.smt_proofs = {}
+        # bundle hash -> CID aggregate beacon bundle
+        self.bundles = {}
+        signals_metadata = (sidecar_data or {}).get("signalsMetadata") or {}
+        for txid, metadata in signals_metadata.items():
+            if metadata.get("smtProof") is not None:
+                self.smt_proofs[txid] = metadata["smtProof"]
+            if metadata.get("aggregateBundle") is not None:
+                bundle = metadata["aggregateBundle"]
+                self.bundles[sha256(jcs.canonicalize(bundle))] = bundle
+            payload = metadata.get("updatePayload")
+            if payload is None:
+                continue
+            self.add_update(payload)
+
+    def __len__(self):
+        return len(self.by_hash)
+
+    def add_update(self, payload):
+        if not isinstance(payload, dict):
+            raise Exception("InvalidSidecarData")
+        update_hash = sha256(jcs.canonicalize(payload))
+        version_id = payload.get("targetVersionId")
+        existing = self.by_version.get(version_id)
+        if existing is not None and existing is not payload and existing != payload:
+            # Two different updates for one version can never both be applied
+            raise Exception("InvalidSidecarData")
+        self.by_hash[update_hash] = payload
+        self.by_version[version_id] = payload
+        return update_hash
+
+    def update(self, update_hash):
+        """The supplied payload hashing to ``update_hash``, if any."""
+        return self.by_hash.get(update_hash)
+
+    def bundle(self, bundle_hash):
+        return self.bundles.get(bundle_hash)
+
+    def smt_proof(self, txid):
+        return self.smt_proofs.get(txid)
+
+    def check_chain(self):
+        """
+        Check that consecutive supplied updates chain together, i.e. each update's
+        ``sourceHash`` is the ``targetHash`` of the update for the previous version.
+        """
+        for version_id, payload in self.by_version.items():
+            previous = self.by_version.get(version_id - 1) if isinstance(version_id, int) else None
+            if previous is not None and payload.get("sourceHash") != previous.get("targetHash"):
+                raise Exception("InvalidSidecarData")
+
+
+def signal_hash_from_script(script_pubkey_hex):
+    """The 32 bytes committed to by an ``OP_RETURN <32 bytes>`` output script, or None."""
+    if len(script_pubkey_hex) == 68 and script_pubkey_hex.startswith(f"{OP_RETURN:02x}20"):
+        return bytes.fromhex(script_pubkey_hex[4:])
+    return None
+
+
+def signal_hash_from_tx(tx):
+    """The hash a beacon signal transaction commits to in its last output, or None."""
+    commands = tx.tx_outs[-1].script_pubkey.commands
+    if len(commands) != 2 or commands[0] != OP_RETURN or len(commands[1]) != 32:
+        return None
+    return commands[1]
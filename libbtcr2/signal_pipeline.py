@@ -0,0 +1,94 @@
+import asyncio
+import logging
+
+from .constants import DEFAULT_PIPELINE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+def beacon_key(beacons):
+    """Identity of a beacon set; the pipeline is only valid while it stays the same."""
+    return tuple((beacon.id, beacon.type, beacon.address()) for beacon in beacons)
+
+
+class SignalPipeline:
+    """
+    Speculatively fetch and parse beacon signals ahead of the traversal.
+
+    Two background stages feed the traversal, which verifies and applies updates:
+
+    - fetch: list the transactions of every beacon address and group the candidate signals
+      by block height, from ``start_height`` up to the context's ``height_bound``;
+    - parse: fetch and parse the raw transactions of each block's candidates.
+
+    Stages are connected by queues bounded to ``depth`` blocks, so prefetching runs at most
+    that far ahead of verification. The prefetched signals were found with the beacon set of
+    the document at ``start_height``; when an update changes that set the traversal must
+    ``close`` the pipeline and start a new one.
+    """
+
+    def __init__(self, resolver, beacons, start_height, context, depth=DEFAULT_PIPELINE_DEPTH):
+        self.resolver = resolver
+        self.beacons = beacons
+        self.key = beacon_key(beacons)
+        self.start_height = start_height
+        self.context = context
+        self._candidates = asyncio.Queue(depth)
+        self._signals = asyncio.Queue(depth)
+        self._tasks = [
+            asyncio.create_task(self._fetch_stage()),
+            asyncio.create_task(self._parse_stage()),
+        ]
+
+    async def _fetch_stage(self):
+        try:
+            blocks = await self.resolver.fetch_candidate_blocks(
+                self.beacons,
+                self.start_height,
+                self.context.network,
+                self.context.profile,
+                self.context.height_bound,
+            )
+            for block in blocks:
+                await self._candidates.put(block)
+            await self._candidates.put(_DONE)
+        except Exception as e:
+            await self._candidates.put(e)
+
+    async def _parse_stage(self):
+        try:
+            while True:
+                block = await self._candidates.get()
+                if block is _DONE or isinstance(block, Exception):
+                    await self._signals.put(block)
+                    return
+                signals = await self.resolver.parse_block_signals(
+                    block,
+                    self.context.network,
+                    self.context.profile,
+                    self.context.sidecar,
+                    self.context.identifier,
+                )
+                await self._signals.put(signals)
+        except Exception as e:
+            await self._signals.put(e)
+
+    async def next_signals(self):
+        """Signals of the next block with beacon signals, or an empty list when none remain."""
+        signals = await self._signals.get()
+        if signals is _DONE:
+            # Keep answering "no more signals" if asked again
+            self._signals.put_nowait(_DONE)
+            return []
+        if isinstance(signals, Exception):
+            raise signals
+        return signals
+
+    async def close(self):
+        """Cancel any prefetching still in progress."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,534 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from buidl.tx import Tx, TxIn
+
+from .broadcast_manager import BROADCAST, CONFIRMED, FAILED, QUEUED, BroadcastManager
+from .constants import (
+    CHAIN_CLAIM_INTERVAL,
+    DEFAULT_CONF_TARGET,
+    DEFAULT_CONFIRMATION_POLL_INTERVAL,
+    DEFAULT_SIGNAL_LANES,
+    DUST_LIMIT,
+    MEMPOOL_ANCESTOR_LIMIT,
+)
+from .metrics import REGISTRY
+from .utxo_pool import outpoint
+
+logger = logging.getLogger(__name__)
+
+# Signed and saved, not yet broadcast; the other statuses are those of BroadcastManager
+SIGNED = "signed"
+
+SIGNALS_IN_FLIGHT = REGISTRY.gauge(
+    "btcr2_beacon_signals_in_flight",
+    "Beacon signals queued or awaiting confirmation, by signal lane and status",
+    ["beacon", "lane", "status"],
+)
+
+
+class BeaconSignalQueue:
+    """
+    Publish a beacon's signals in order, each spending the unconfirmed change of the last.
+
+    Commitments are queued with ``enqueue`` and published by ``publish`` while the chain of
+    unconfirmed signals stays within the mempool ancestor limit; beyond it, signals wait for
+    ``poll_confirmations`` to see earlier ones confirmed. Every signal is signed and saved
+    before it is broadcast (write-ahead), so with a ``state_path`` a restarted queue
+    re-broadcasts the exact transactions it had in flight rather than double-spending its
+    own chain. ``start`` runs publishing and confirmation polling in the background.
+
+    Signals are broadcast and followed to confirmation by a ``BroadcastManager``, shared by
+    the lanes of a ``BeaconSignalScheduler``, which finds confirmations by scanning each new
+    block once. The queue is the manager's replacer: the last signal of the chain, whose
+    change nothing spends yet, is fee bumped when stuck and the chain continues from the
+    replacement's change.
+
+    Each signal is a record dict with ``id``, ``commitment``, ``status`` (queued, signed,
+    broadcast, confirmed, or failed when dropped before it was signed), ``txid`` and
+    ``blockHeight``; confirmation is reported through
+    ``wait_for_confirmation`` and the optional ``on_confirmed(record)`` callback.
+    """
+
+    def __init__(
+        self,
+        beacon_manager,
+        state_path=None,
+        ancestor_limit=MEMPOOL_ANCESTOR_LIMIT,
+        poll_interval=DEFAULT_CONFIRMATION_POLL_INTERVAL,
+        on_confirmed=None,
+        conf_target=DEFAULT_CONF_TARGET,
+        lane=0,
+        broadcast_manager=None,
+    ):
+        self.beacon_manager = beacon_manager
+        # Index among the lanes of a BeaconSignalScheduler, which share the beacon
+        self.lane = lane
+        self.esplora_client = beacon_manager.esplora_client
+        if broadcast_manager is None:
+            broadcast_manager = BroadcastManager(
+                self.esplora_client, network=beacon_manager.network, target_blocks=conf_target
+            )
+        self.broadcast_manager = broadcast_manager
+        self.state_path = state_path
+        self.ancestor_limit = ancestor_limit
+        self.poll_interval = poll_interval
+        self.on_confirmed = on_confirmed
+        self.conf_target = conf_target
+        # id -> record, in publication order; confirmed records are dropped once reported
+        self.signals = OrderedDict()
+        # Change output of the last signed signal, spent by the next one
+        self.chain_tip = None
+        self._next_id = 1
+        # id -> PendingTransaction of the signals submitted to the broadcast manager
+        self._pending = {}
+        # Set while a signal spending the chain tip is signed or the last one replaced, so
+        # that neither spends change the other is about to replace
+        self._chain_busy = False
+        self._chain_lock = threading.Lock()
+        self._waiters = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._wakeup = None
+        self._load_state()
+
+    def _count(self, status):
+        return sum(1 for record in self.signals.values() if record["status"] == status)
+
+    @property
+    def in_flight(self):
+        """Signed signals not yet confirmed, i.e. the unconfirmed ancestors of the next one."""
+        return sum(1 for record in self.signals.values() if record["status"] in (SIGNED, BROADCAST))
+
+    def enqueue(self, commitment_bytes):
+        """Queue a 32-byte commitment and return its signal record."""
+        record = {
+            "id": self._next_id,
+            "commitment": commitment_bytes.hex(),
+            "status": QUEUED,
+            "txid": None,
+            "tx": None,
+            "inputValue": None,
+            "blockHeight": None,
+        }
+        self._next_id += 1
+        self.signals[record["id"]] = record
+        self._save_state()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return record
+
+    async def announce(self, commitment_bytes):
+        """
+        Queue a commitment, publish it as soon as the chain allows and return its txid.
+
+        Without a background task (see ``start``) nothing would publish the signal later, so
+        one that cannot be signed yet is dropped from the queue and an exception raised. A
+        signal already signed is never dropped, as it may have reached the network; its
+        broadcast is retried until it succeeds. A signal that fails to sign is dropped either
+        way.
+        """
+        record = self.enqueue(commitment_bytes)
+        try:
+            await self.publish()
+            while record["status"] == QUEUED or record["status"] == SIGNED:
+                if self._task is not None:
+                    await asyncio.sleep(min(self.poll_interval, 1))
+                    continue
+                async with self._lock:
+                    if record["status"] == QUEUED:
+                        error = Exception(
+                            f"Signal {record['id']} not broadcast, beacon chain is full"
+                        )
+                        self._drop(record, error)
+                        raise error
+                await asyncio.sleep(self.poll_interval)
+                await self.publish()
+        except Exception as e:
+            # Publishing failed on an earlier signal, leaving this one queued
+            if self._task is None and record["status"] == QUEUED:
+                async with self._lock:
+                    if record["status"] == QUEUED:
+                        self._drop(record, e)
+            raise
+        if record["status"] == FAILED:
+            raise Exception(f"Signal {record['id']} not broadcast: {record['error']}")
+        return record["txid"]
+
+    async def publish(self):
+        """
+        Sign queued signals, in order, until the ancestor limit is reached, and broadcast
+        the signed ones through the broadcast manager. Returns the number broadcast.
+        """
+        async with self._lock:
+            for record in list(self.signals.values()):
+                if record["status"] == QUEUED:
+                    if self.in_flight >= self.ancestor_limit:
+                        logger.debug("Beacon %s at ancestor limit", self.beacon_manager.beacon_id)
+                        break
+                    while not self._claim_chain():
+                        # The last signal is being replaced; sign on top of the replacement
+                        await asyncio.sleep(CHAIN_CLAIM_INTERVAL)
+                    try:
+                        signed_tx = await asyncio.to_thread(self._sign, record)
+                        self._spend(signed_tx)
+                    except Exception as e:
+                        # Never signed, so never broadcast: dropped rather than left queued
+                        self._drop(record, e)
+                        raise
+                    finally:
+                        self._release_chain()
+                    record["tx"] = signed_tx.serialize().hex()
+                    record["txid"] = signed_tx.id()
+                    record["inputValue"] = signed_tx.tx_ins[0].value()
+                    record["status"] = SIGNED
+                    # Saved before broadcasting, so a crash can never lead to a conflicting signal
+                    self._save_state()
+                if record["id"] not in self._pending and record["status"] in (SIGNED, BROADCAST):
+                    # Also signals broadcast before a restart, to follow them to confirmation
+                    self._pending[record["id"]] = self.broadcast_manager.submit(
+                        self._signal_tx(record),
+                        kind="beacon_signal",
+                        replacer=self,
+                        on_replaced=self._replaced,
+                    )
+
+            await self.broadcast_manager.process()
+            broadcast = 0
+            for record in self.signals.values():
+                pending = self._pending.get(record["id"])
+                if pending is None:
+                    continue
+                if pending.status == FAILED:
+                    # A signal already signed is retried, as it may have reached the network
+                    del self._pending[record["id"]]
+                elif record["status"] == SIGNED and pending.status != QUEUED:
+                    record["status"] = BROADCAST
+                    logger.info(
+                        "Beacon signal %d broadcast with txid %s", record["id"], record["txid"]
+                    )
+                    broadcast += 1
+            if broadcast:
+                self._save_state()
+            self._report_gauges()
+            return broadcast
+
+    # Signing runs in a worker thread. It leaves the queue's state alone, so that it is only
+    # changed, and saved, on the event loop thread.
+
+    def _sign(self, record):
+        """
+        Sign ``record``'s signal, spending the chain tip or, when there is none large enough,
+        a UTXO reserved from the pool (released again if signing fails).
+        """
+        fee_rate = self.beacon_manager.fee_rate(self.conf_target)
+        min_value = self.beacon_manager.signal_fee(fee_rate) + DUST_LIMIT
+        tx_in = self.chain_tip
+        if tx_in is None or tx_in.value() < min_value:
+            # Lanes of a BeaconSignalScheduler reserve from the same pool, which is thread safe
+            tx_in = self.beacon_manager.reserve_utxo(min_value)
+
+        commitment = bytes.fromhex(record["commitment"])
+        try:
+            pending_signal = self.beacon_manager.construct_beacon_signal(
+                commitment, tx_in, self.conf_target
+            )
+            return self.beacon_manager.sign_beacon_signal(pending_signal)
+        except Exception:
+            if tx_in is not self.chain_tip:
+                self.beacon_manager.utxos.release([outpoint(tx_in)])
+            raise
+
+    def _spend(self, signed_tx):
+        """Make a newly signed signal's change the chain tip."""
+        utxos = self.beacon_manager.utxos
+        spent = outpoint(signed_tx.tx_ins[0])
+        if self.chain_tip is not None and outpoint(self.chain_tip) != spent:
+            # The chain's change no longer covers a signal; leave it to the pool
+            utxos.add(self.chain_tip, confirmed=False)
+        utxos.remove(spent)
+        self.chain_tip = self.beacon_manager.change_tx_in(signed_tx)
+        # Spent by this queue only, even once Esplora lists it
+        utxos.remove(outpoint(self.chain_tip))
+
+    def _drop(self, record, error):
+        """Remove a signal that will not be broadcast and fail whoever waits for it."""
+        logger.warning("Dropping beacon signal %d: %s", record["id"], error)
+        del self.signals[record["id"]]
+        record["status"] = FAILED
+        record["error"] = str(error)
+        self._save_state()
+        self._report_gauges()
+        waiter = self._waiters.pop(record["id"], None)
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(error)
+
+    def _signal_tx(self, record):
+        """``record``'s signed signal, with the value of its input to fee bump it."""
+        tx = Tx.parse_hex(record["tx"])
+        tx.tx_ins[0]._script_pubkey = self.beacon_manager.script_pubkey
+        tx.tx_ins[0]._value = record["inputValue"]
+        return tx
+
+    def _claim_chain(self):
+        with self._chain_lock:
+            if self._chain_busy:
+                return False
+            self._chain_busy = True
+            return True
+
+    def _release_chain(self):
+        with self._chain_lock:
+            self._chain_busy = False
+
+    # The broadcast manager's replacer. These run in its worker threads, except for
+    # _replaced, which it calls on the event loop thread.
+
+    def finish_broadcast(self, signed_signal, broadcast):
+        """The queue's signals spend the chain tip, not UTXOs reserved from the pool."""
+
+    def build_replacement(self, signed_signal, fee_rate):
+        """
+        A fee-bumped replacement for the last signal of the chain, or None for a signal
+        whose change is spent by a later one, as replacing it would evict the descendants.
+        """
+        change = outpoint(self.beacon_manager.change_tx_in(signed_signal))
+        if not self._claim_chain():
+            return None
+        try:
+            if self.chain_tip is None or outpoint(self.chain_tip) != change:
+                logger.debug(
+                    "Change of %s spent by the next signal, not replacing", signed_signal.id()
+                )
+                replacement = None
+            else:
+                replacement = self.beacon_manager.replacement_signal(signed_signal, fee_rate)
+        except Exception:
+            self._release_chain()
+            raise
+        if replacement is None:
+            self._release_chain()
+        return replacement
+
+    def finish_replacement(self, signed_signal, replacement, broadcast):
+        # Once broadcast, the chain is released by _replaced, after moving its tip
+        if not broadcast:
+            self._release_chain()
+
+    def _replaced(self, pending, old_txid):
+        """Continue the chain from the replacement's change, and save it in place of the signal."""
+        try:
+            for record in self.signals.values():
+                if self._pending.get(record["id"]) is pending:
+                    record["tx"] = pending.tx.serialize().hex()
+                    record["txid"] = pending.txid
+                    logger.info(
+                        "Beacon signal %d replaced with txid %s", record["id"], pending.txid
+                    )
+            self.chain_tip = self.beacon_manager.change_tx_in(pending.tx)
+            self._save_state()
+        finally:
+            self._release_chain()
+
+    async def poll_confirmations(self):
+        """Look for broadcast signals in new blocks, and report those confirmed."""
+        await self.broadcast_manager.process()
+        confirmed = []
+        async with self._lock:
+            for record in list(self.signals.values()):
+                pending = self._pending.get(record["id"])
+                if record["status"] != BROADCAST or pending is None:
+                    continue
+                if pending.status != CONFIRMED:
+                    continue
+                if pending.txid != record["txid"]:
+                    logger.warning(
+                        "Beacon signal %d confirmed as %s, not its replacement %s",
+                        record["id"],
+                        pending.txid,
+                        record["txid"],
+                    )
+                record["status"] = CONFIRMED
+                record["txid"] = pending.txid
+                record["blockHeight"] = pending.block_height
+                confirmed.append(record)
+            for record in confirmed:
+                del self.signals[record["id"]]
+                del self._pending[record["id"]]
+            if confirmed:
+                self._save_state()
+            self._report_gauges()
+
+        for record in confirmed:
+            logger.info("Beacon signal %s confirmed at %s", record["txid"], record["blockHeight"])
+            waiter = self._waiters.pop(record["id"], None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(record)
+            if self.on_confirmed is not None:
+                self.on_confirmed(record)
+        return confirmed
+
+    async def wait_for_confirmation(self, signal_id):
+        """Wait until the signal ``signal_id`` is confirmed and return its record."""
+        if signal_id not in self.signals:
+            raise Exception(f"Unknown or already confirmed signal {signal_id}")
+        waiter = self._waiters.get(signal_id)
+        if waiter is None:
+            waiter = self._waiters[signal_id] = asyncio.get_running_loop().create_future()
+        return await asyncio.shield(waiter)
+
+    def start(self):
+        """Publish and poll for confirmations in a background task until ``stop``."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+            self._wakeup = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.publish()
+                if self._count(BROADCAST):
+                    await self.poll_confirmations()
+            except Exception:
+                logger.exception("Beacon signal queue for %s", self.beacon_manager.beacon_id)
+            self._wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+
+    def _report_gauges(self):
+        labels = (str(self.beacon_manager.beacon_id), str(self.lane))
+        for status in (QUEUED, SIGNED, BROADCAST):
+            SIGNALS_IN_FLIGHT.set(self._count(status), labels=(*labels, status))
+
+    def _save_state(self):
+        if self.state_path is None:
+            return
+        tip = self.chain_tip
+        state = {
+            "nextId": self._next_id,
+            "chainTip": None
+            if tip is None
+            else {"txid": tip.prev_tx.hex(), "vout": tip.prev_index, "value": tip.value()},
+            "signals": list(self.signals.values()),
+        }
+        folder = os.path.dirname(os.path.abspath(self.state_path))
+        os.makedirs(folder, exist_ok=True)
+        # Write then rename, so a crash mid-write leaves the previous state intact
+        fd, temp_path = tempfile.mkstemp(dir=folder)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.state_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _load_state(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as f:
+            state = json.load(f)
+        self._next_id = state["nextId"]
+        self.signals = OrderedDict((record["id"], record) for record in state["signals"])
+        tip = state.get("chainTip")
+        if tip is not None:
+            self.chain_tip = TxIn(prev_tx=bytes.fromhex(tip["txid"]), prev_index=tip["vout"])
+            self.chain_tip._script_pubkey = self.beacon_manager.script_pubkey
+            self.chain_tip._value = tip["value"]
+            # The chain tip is spent by this queue only
+            self.beacon_manager.utxos.remove(outpoint(self.chain_tip))
+        logger.info(
+            "Restored %d in-flight beacon signals for %s",
+            len(self.signals),
+            self.beacon_manager.beacon_id,
+        )
+
+
+class BeaconSignalScheduler:
+    """
+    Publish a beacon's signals over ``lanes`` independent UTXO chains.
+
+    Each lane is a ``BeaconSignalQueue`` whose first signal spends a different UTXO of the
+    beacon address, so concurrent announcements (for different DIDs, or rapid successive
+    updates) are signed and broadcast in parallel and each chain only carries its share of
+    the unconfirmed ancestors. ``prepare`` fans the beacon's balance out into one UTXO per
+    lane when there are not enough; its outputs start unconfirmed, so wait for the fan-out
+    to confirm before relying on the full ancestor limit of every lane.
+    """
+
+    def __init__(
+        self,
+        beacon_manager,
+        lanes=DEFAULT_SIGNAL_LANES,
+        state_folder=None,
+        broadcast_manager=None,
+        **queue_options,
+    ):
+        self.beacon_manager = beacon_manager
+        if broadcast_manager is None:
+            broadcast_manager = BroadcastManager(
+                beacon_manager.esplora_client,
+                network=beacon_manager.network,
+                target_blocks=queue_options.get("conf_target", DEFAULT_CONF_TARGET),
+            )
+        # One block scan finds the confirmations of every lane
+        self.broadcast_manager = broadcast_manager
+        self.lanes = [
+            BeaconSignalQueue(
+                beacon_manager,
+                os.path.join(state_folder, f"lane{index}.json") if state_folder else None,
+                lane=index,
+                broadcast_manager=broadcast_manager,
+                **queue_options,
+            )
+            for index in range(lanes)
+        ]
+
+    def prepare(self):
+        """
+        Fan out the beacon's balance if lanes without a chain lack a UTXO large enough to
+        start one with a signal.
+        """
+        idle_lanes = sum(1 for lane in self.lanes if lane.chain_tip is None)
+        if idle_lanes == 0:
+            return None
+        conf_target = self.lanes[0].conf_target
+        min_value = self.beacon_manager.signal_fee(self.beacon_manager.fee_rate(conf_target))
+        min_value += DUST_LIMIT
+        usable = sum(1 for value, _ in self.beacon_manager.utxos.candidates() if value >= min_value)
+        if usable >= idle_lanes:
+            return None
+        return self.beacon_manager.fan_out(idle_lanes, conf_target=conf_target, min_value=min_value)
+
+    def lane(self):
+        """The lane with the fewest signals waiting or unconfirmed."""
+        return min(self.lanes, key=lambda lane: len(lane.signals))
+
+    async def announce(self, commitment_bytes):
+        return await self.lane().announce(commitment_bytes)
+
+    def start(self):
+        for lane in self.lanes:
+            lane.start()
+
+    async def stop(self):
+        await asyncio.gather(*(lane.stop() for lane in self.lanes))
+
+    async def poll_confirmations(self):
+        results = await asyncio.gather(*(lane.poll_confirmations() for lane in self.lanes))
+        return [record for confirmed in results for record in confirmed]
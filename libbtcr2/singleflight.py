@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls that share a key into one execution (thread version).
+
+    The first caller for a key runs the function; callers arriving while it is in flight
+    block on the same result or exception instead of repeating the work.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            logger.debug("Joining in-flight call: %s", key)
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class _AsyncCall:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    Collapse concurrent coroutine calls that share a key into one task (asyncio version).
+
+    The shared task is shielded from the cancellation of any single caller and is only
+    cancelled once every caller waiting on it has been cancelled.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, coro_fn, *args, **kwargs):
+        call = self._calls.get(key)
+        if call is None:
+            call = _AsyncCall(asyncio.ensure_future(coro_fn(*args, **kwargs)))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _task: self._forget(key, call))
+        else:
+            logger.debug("Joining in-flight call: %s", key)
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                self._forget(key, call)
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def in_flight(self):
+        return len(self._calls)
@@ -0,0 +1,159 @@
+import hashlib
+import threading
+
+SMT_DEPTH = 256
+
+
+def hash_pair(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+def _empty_hashes():
+    # EMPTY_HASHES[h] is the hash of an empty subtree of height h
+    hashes = [bytes(32)]
+    for _ in range(SMT_DEPTH):
+        hashes.append(hash_pair(hashes[-1], hashes[-1]))
+    return hashes
+
+
+EMPTY_HASHES = _empty_hashes()
+
+
+def leaf_index(did):
+    """Position of a DID's leaf: the SHA-256 of the DID as a 256-bit integer."""
+    return int.from_bytes(hashlib.sha256(did.encode()).digest(), "big")
+
+
+def leaf_hash(nonce, update_hash=None):
+    """
+    Leaf value committing to ``update_hash`` (or to no update) for one DID.
+
+    The nonce keeps leaves of DIDs without an update indistinguishable from empty ones.
+    """
+    nonce_hash = hashlib.sha256(nonce).digest()
+    if update_hash is None:
+        return hashlib.sha256(nonce_hash).digest()
+    return hashlib.sha256(nonce_hash + update_hash).digest()
+
+
+class SparseMerkleTree:
+    """
+    Sparse Merkle tree of height 256 over DID leaves, used to build SMT aggregate beacons.
+
+    Leaves are keyed by ``leaf_index``; an internal node hashes its two children, and an
+    empty subtree of height ``h`` hashes to ``EMPTY_HASHES[h]``.
+    """
+
+    def __init__(self):
+        self.leaves = {}
+        self._nodes = None
+
+    def set(self, did, nonce, update_hash=None):
+        self.leaves[leaf_index(did)] = (nonce, update_hash)
+        self._nodes = None
+
+    def _build(self):
+        # (height, prefix) -> hash, for every non-empty node
+        nodes = {}
+        level = {index: leaf_hash(nonce, update) for index, (nonce, update) in self.leaves.items()}
+        for height in range(SMT_DEPTH):
+            empty = EMPTY_HASHES[height]
+            parents = {}
+            for prefix, value in level.items():
+                nodes[(height, prefix)] = value
+                parent = prefix >> 1
+                if parent not in parents:
+                    left = level.get(parent << 1, empty)
+                    right = level.get(parent << 1 | 1, empty)
+                    parents[parent] = hash_pair(left, right)
+            level = parents
+        nodes[(SMT_DEPTH, 0)] = level.get(0, EMPTY_HASHES[SMT_DEPTH])
+        self._nodes = nodes
+
+    def root(self):
+        if self._nodes is None:
+            self._build()
+        return self._nodes[(SMT_DEPTH, 0)]
+
+    def proof(self, did):
+        """
+        Inclusion proof for ``did``'s leaf, serialized for sidecar data.
+
+        ``collapsed`` is a 256-bit bitmap (bit ``h`` set when the sibling at height ``h`` is
+        an empty subtree) and ``hashes`` lists the other siblings from the leaf upwards.
+        """
+        if self._nodes is None:
+            self._build()
+        index = leaf_index(did)
+        collapsed = 0
+        hashes = []
+        for height in range(SMT_DEPTH):
+            sibling = self._nodes.get((height, (index >> height) ^ 1))
+            if sibling is None:
+                collapsed |= 1 << height
+            else:
+                hashes.append(sibling.hex())
+        proof = {"collapsed": f"{collapsed:064x}", "hashes": hashes}
+        if index in self.leaves:
+            nonce, update_hash = self.leaves[index]
+            proof["nonce"] = nonce.hex()
+            if update_hash is not None:
+                proof["updateId"] = update_hash.hex()
+        return proof
+
+
+class SMTVerifier:
+    """
+    Verifies proofs against one SMT root, memoizing nodes of proofs already verified.
+
+    Every node computed by a verified proof is remembered by its height, path prefix and the
+    two child hashes it was computed from. A later proof that reaches the same children at the
+    same position is valid without hashing further up the tree.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.verified = set()
+        self._lock = threading.Lock()
+
+    def verify(self, did, proof):
+        """
+        Check ``proof`` for ``did``; returns the update hash it commits to, or None when it
+        proves that ``did`` has no update. Raises on an invalid proof.
+        """
+        index = leaf_index(did)
+        update_hash = bytes.fromhex(proof["updateId"]) if proof.get("updateId") else None
+        if proof.get("nonce") is not None:
+            node = leaf_hash(bytes.fromhex(proof["nonce"]), update_hash)
+        elif update_hash is None:
+            node = EMPTY_HASHES[0]
+        else:
+            raise Exception("InvalidSMTProof")
+
+        collapsed = int(proof["collapsed"], 16)
+        hashes = iter(proof["hashes"])
+        path = []
+        try:
+            for height in range(SMT_DEPTH):
+                prefix = index >> height
+                if collapsed >> height & 1:
+                    sibling = EMPTY_HASHES[height]
+                else:
+                    sibling = bytes.fromhex(next(hashes))
+                children = (sibling, node) if prefix & 1 else (node, sibling)
+                key = (height + 1, prefix >> 1, *children)
+                with self._lock:
+                    known = key in self.verified
+                if known:
+                    break
+                path.append(key)
+                node = hash_pair(*children)
+            else:
+                if node != self.root:
+                    raise Exception("InvalidSMTProof")
+        except (StopIteration, ValueError, KeyError) as e:
+            raise Exception("InvalidSMTProof") from e
+
+        with self._lock:
+            self.verified.update(path)
+        return update_hash
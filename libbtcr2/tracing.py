@@ -0,0 +1,64 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class NoopSpan:
+    """Span that records nothing."""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def record_exception(self, exception, attributes=None):
+        pass
+
+    def is_recording(self):
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class NoopTracer:
+    """
+    Default tracer: hands out a shared no-op span, so tracing costs one call when disabled.
+
+    Any object with an OpenTelemetry-style ``start_as_current_span(name, attributes=...)``
+    method returning a span context manager can be used instead, including an OpenTelemetry
+    ``Tracer`` (``opentelemetry.trace.get_tracer("libbtcr2")``).
+    """
+
+    def start_as_current_span(self, name, attributes=None, **kwargs):
+        return NOOP_SPAN
+
+
+NOOP_TRACER = NoopTracer()
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Install the process-wide tracer used when a component is not given its own."""
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer or NOOP_TRACER
+
+
+def start_span(name, attributes=None, tracer=None):
+    """Start a span as a child of the current span, using ``tracer`` or the global tracer."""
+    return (tracer or _tracer or NOOP_TRACER).start_as_current_span(name, attributes=attributes)
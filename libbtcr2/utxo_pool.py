@@ -0,0 +1,206 @@
+import bisect
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONFIRMED = "confirmed"
+UNCONFIRMED = "unconfirmed"
+RESERVED = "reserved"
+
+
+def outpoint(tx_in):
+    """The ``(txid, vout)`` a ``TxIn`` spends."""
+    return (tx_in.prev_tx.hex(), tx_in.prev_index)
+
+
+class UTXOPool:
+    """
+    Unspent outputs of an address, indexed by outpoint and sorted by value.
+
+    A UTXO is confirmed, unconfirmed (e.g. the change of a transaction still in the mempool)
+    or reserved, i.e. selected as an input of a transaction being built or broadcast.
+    Reserved UTXOs are left out of selection until they are released, or dropped with
+    ``remove`` once the transaction spending them is broadcast. Removed outpoints are
+    remembered, so that ``replace`` does not add them back from an address listing that
+    predates their spending transaction. Confirmed and unconfirmed
+    UTXOs are kept in separate value-sorted indexes, so finding the smallest UTXO worth at
+    least some value is a bisection.
+    """
+
+    def __init__(self):
+        # outpoint -> TxIn, with the value and script pubkey set
+        self._utxos = {}
+        # outpoint -> CONFIRMED, UNCONFIRMED or RESERVED
+        self._states = {}
+        # Reserved outpoint -> state to restore on release
+        self._reserved = {}
+        # Sorted (value, outpoint) of the UTXOs available for selection, by state
+        self._indexes = {CONFIRMED: [], UNCONFIRMED: []}
+        # Outpoints removed as spent, or taken to be spent by the caller
+        self._spent = set()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._utxos)
+
+    def __contains__(self, key):
+        return key in self._utxos
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._utxos.values()))
+
+    def get(self, key):
+        return self._utxos.get(key)
+
+    def state(self, key):
+        return self._states.get(key)
+
+    def available(self, include_unconfirmed=True):
+        """Number of UTXOs that can be selected."""
+        with self._lock:
+            count = len(self._indexes[CONFIRMED])
+            return count + len(self._indexes[UNCONFIRMED]) if include_unconfirmed else count
+
+    def total_value(self, include_unconfirmed=True):
+        """Value of the UTXOs that can be selected."""
+        return sum(value for value, _ in self.candidates(include_unconfirmed))
+
+    def add(self, tx_in, confirmed=True):
+        key = outpoint(tx_in)
+        with self._lock:
+            # Handed back, e.g. a chain tip left unspent
+            self._spent.discard(key)
+            if key in self._utxos:
+                if confirmed and self._states[key] == UNCONFIRMED:
+                    self.mark_confirmed(key)
+                return key
+            state = CONFIRMED if confirmed else UNCONFIRMED
+            self._utxos[key] = tx_in
+            self._states[key] = state
+            bisect.insort(self._indexes[state], (tx_in.value(), key))
+        return key
+
+    def remove(self, key):
+        """
+        Stop tracking a UTXO once it is spent, or taken to be spent by the caller, and keep
+        ``replace`` from adding it back. Returns its ``TxIn``, or None if it was untracked.
+        """
+        with self._lock:
+            self._spent.add(key)
+            return self._drop(key)
+
+    def clear(self, keep_reserved=True):
+        with self._lock:
+            for key in list(self._utxos):
+                if not (keep_reserved and self._states[key] == RESERVED):
+                    self._drop(key)
+
+    def replace(self, utxos):
+        """
+        Track the ``(TxIn, confirmed)`` pairs of an address listing instead of the current
+        UTXOs, keeping reserved ones and leaving out removed ones. Removed outpoints that are
+        no longer listed have been seen spent and are forgotten.
+        """
+        with self._lock:
+            self._spent.intersection_update(outpoint(tx_in) for tx_in, _ in utxos)
+            self.clear(keep_reserved=True)
+            for tx_in, confirmed in utxos:
+                key = outpoint(tx_in)
+                if key not in self._spent and key not in self._utxos:
+                    self.add(tx_in, confirmed)
+
+    def mark_confirmed(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            if state == UNCONFIRMED:
+                value = self._utxos[key].value()
+                self._unindex(UNCONFIRMED, value, key)
+                bisect.insort(self._indexes[CONFIRMED], (value, key))
+                self._states[key] = CONFIRMED
+            elif state == RESERVED:
+                self._reserved[key] = CONFIRMED
+
+    def reserve(self, keys):
+        """
+        Take UTXOs out of selection for a transaction being built; returns their TxIns.
+        Reserves all of them or, when any is not available, none.
+        """
+        with self._lock:
+            keys = list(keys)
+            if len(set(keys)) < len(keys):
+                raise Exception("Cannot reserve a UTXO twice")
+            for key in keys:
+                state = self._states.get(key)
+                if state is None or state == RESERVED:
+                    raise Exception(f"UTXO {key[0]}:{key[1]} is not available")
+            tx_ins = []
+            for key in keys:
+                state = self._states[key]
+                tx_in = self._utxos[key]
+                self._unindex(state, tx_in.value(), key)
+                self._states[key] = RESERVED
+                self._reserved[key] = state
+                tx_ins.append(tx_in)
+            return tx_ins
+
+    def release(self, keys):
+        """Make reserved UTXOs selectable again, e.g. after a failed broadcast."""
+        with self._lock:
+            for key in keys:
+                state = self._reserved.pop(key, None)
+                if state is None:
+                    continue
+                self._states[key] = state
+                bisect.insort(self._indexes[state], (self._utxos[key].value(), key))
+
+    def candidates(self, include_unconfirmed=True):
+        """Available UTXOs as ``(value, outpoint)`` pairs, in ascending value order."""
+        with self._lock:
+            if not include_unconfirmed:
+                return list(self._indexes[CONFIRMED])
+            return list(heapq.merge(self._indexes[CONFIRMED], self._indexes[UNCONFIRMED]))
+
+    def smallest_at_least(self, min_value, include_unconfirmed=True):
+        """
+        Outpoint of the smallest available UTXO worth ``min_value`` or more, preferring
+        confirmed ones, or None.
+        """
+        with self._lock:
+            states = (CONFIRMED, UNCONFIRMED) if include_unconfirmed else (CONFIRMED,)
+            for state in states:
+                index = self._indexes[state]
+                position = bisect.bisect_left(index, (min_value,))
+                if position < len(index):
+                    return index[position][1]
+            return None
+
+    def take(self, min_value=0, include_unconfirmed=True):
+        """Remove and return the smallest available UTXO worth ``min_value`` or more."""
+        with self._lock:
+            key = self.smallest_at_least(min_value, include_unconfirmed)
+            return None if key is None else self.remove(key)
+
+    def reserve_at_least(self, min_value=0, include_unconfirmed=True):
+        """Reserve and return the smallest available UTXO worth ``min_value`` or more, or None."""
+        with self._lock:
+            key = self.smallest_at_least(min_value, include_unconfirmed)
+            return None if key is None else self.reserve([key])[0]
+
+    def _drop(self, key):
+        tx_in = self._utxos.pop(key, None)
+        if tx_in is None:
+            return None
+        state = self._states.pop(key)
+        self._reserved.pop(key, None)
+        if state != RESERVED:
+            self._unindex(state, tx_in.value(), key)
+        return tx_in
+
+    def _unindex(self, state, value, key):
+        index = self._indexes[state]
+        position = bisect.bisect_left(index, (value, key))
+        if position < len(index) and index[position] == (value, key):
+            del index[position]
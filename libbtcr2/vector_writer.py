@@ -0,0 +1,102 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+
+from .constants import DEFAULT_VECTOR_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+JSON = "json"
+TEXT = "text"
+
+
+class VectorWriter:
+    """
+    Write resolver test vectors from a background thread.
+
+    ``write_json`` and ``write_text`` only enqueue the artifact, so capturing vectors never
+    blocks the resolver's event loop on disk I/O. A worker thread drains the queue in batches,
+    creating each folder once per batch, serializing JSON and optionally gzip-compressing
+    every file (written with a ``.gz`` suffix). Callers hand over ownership of the data they
+    enqueue and must not mutate it afterwards. Text may be given as a zero-argument callable
+    so that producing it (e.g. canonicalization) also happens off the hot path.
+
+    When ``max_pending`` is set and the queue is full, artifacts are dropped (and counted)
+    rather than stalling resolution.
+    """
+
+    def __init__(self, compress=False, batch_size=DEFAULT_VECTOR_BATCH_SIZE, max_pending=0):
+        self.compress = compress
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def write_json(self, path, data):
+        self._submit((JSON, path, data))
+
+    def write_text(self, path, text):
+        self._submit((TEXT, path, text))
+
+    def _submit(self, item):
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Test vector queue full, dropping %s", item[1])
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="test-vector-writer", daemon=True
+                )
+                self._worker.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        """Block until every artifact enqueued so far has been written."""
+        if self._worker is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception:
+                logger.exception("Failed to write test vectors")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch):
+        folders = set()
+        for kind, path, data in batch:
+            folder = os.path.dirname(path)
+            if folder and folder not in folders:
+                os.makedirs(folder, exist_ok=True)
+                folders.add(folder)
+
+            if kind == JSON:
+                content = json.dumps(data, indent=2)
+            else:
+                content = data() if callable(data) else data
+            if self.compress:
+                with gzip.open(f"{path}.gz", "wt") as f:
+                    f.write(content)
+            else:
+                with open(path, "w") as f:
+                    f.write(content)
+        logger.debug("Wrote %d test vector files", len(batch))
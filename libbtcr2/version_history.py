@@ -0,0 +1,108 @@
+import bisect
+import copy
+import logging
+
+import jsonpatch
+
+from .constants import HISTORY_CHECKPOINT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class VersionHistory:
+    """
+    Index of every version of a DID, built by ``Btcr2Resolver.resolve_history``.
+
+    Each entry records the versionId, block height and time of the signal that announced it,
+    the update hash and the resulting document hash. Documents are not all kept in full:
+    every ``checkpoint_interval`` versions a full copy is stored, and other versions are
+    rebuilt by applying the update patches from the nearest earlier checkpoint.
+
+    Lookups by versionTime bisect over the running maximum of block times, mirroring the
+    traversal, which stops at the first signal block later than versionTime.
+    """
+
+    def __init__(
+        self,
+        identifier,
+        network,
+        initial_document,
+        checkpoint_interval=HISTORY_CHECKPOINT_INTERVAL,
+    ):
+        self.identifier = identifier
+        self.network = network
+        self.checkpoint_interval = checkpoint_interval
+        self.entries = [
+            {
+                "versionId": 1,
+                "blockHeight": None,
+                "blockTime": None,
+                "updateHash": None,
+                "documentHash": None,
+            }
+        ]
+        # versionId -> serialized document
+        self.checkpoints = {1: initial_document.serialize()}
+        # patches[i] turns version i + 1 into version i + 2
+        self.patches = []
+        # Running maximum of block times, from version 2
+        self._latest_times = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def latest_version_id(self):
+        return self.entries[-1]["versionId"]
+
+    def append(self, version_id, block_height, block_time, update, update_hash, document):
+        """Record ``document``, the result of applying ``update`` to the latest version."""
+        if version_id != self.latest_version_id + 1:
+            raise Exception(f"Expected version {self.latest_version_id + 1}, got {version_id}")
+        self.entries.append(
+            {
+                "versionId": version_id,
+                "blockHeight": block_height,
+                "blockTime": block_time,
+                "updateHash": update_hash.hex(),
+                "documentHash": update["targetHash"],
+            }
+        )
+        self.patches.append(update["patch"])
+        latest_time = max(block_time, self._latest_times[-1]) if self._latest_times else block_time
+        self._latest_times.append(latest_time)
+        if version_id % self.checkpoint_interval == 0:
+            self.checkpoints[version_id] = document.serialize()
+
+    def find(self, version_id=None, version_time=None):
+        """Index entry for ``version_id``, for the latest version at ``version_time``, or the
+        latest version when neither is given."""
+        if version_id is not None and version_time is not None:
+            raise Exception("InvalidResolutionOptions - cannot have versionTime and versionId")
+        if version_id is not None:
+            if not 1 <= version_id <= self.latest_version_id:
+                raise Exception(f"Unknown version {version_id}")
+            return self.entries[version_id - 1]
+        if version_time is not None:
+            return self.entries[bisect.bisect_right(self._latest_times, version_time)]
+        return self.entries[-1]
+
+    def document(self, version_id):
+        """Serialized DID document of ``version_id``."""
+        checkpoint = version_id - (version_id % self.checkpoint_interval)
+        if checkpoint < 1:
+            checkpoint = 1
+        document = copy.deepcopy(self.checkpoints[checkpoint])
+        for patch in self.patches[checkpoint - 1 : version_id - 1]:
+            # Copied so that documents never share values with the stored patches
+            document = jsonpatch.apply_patch(document, copy.deepcopy(patch), in_place=True)
+        return document
+
+    def resolve(self, version_id=None, version_time=None):
+        """Resolution result for a version, in the same shape as ``Btcr2Resolver.resolve``."""
+        entry = self.find(version_id, version_time)
+        return {
+            "didDocument": self.document(entry["versionId"]),
+            "didResolutionMetadata": {},
+            "didDocumentMetadata": {"network": self.network, "version": entry["versionId"]},
+        }
@@ -50,6 +50,7 @@ async def resolve_did():
     resolver = Btcr2Resolver(networkDefinitions=networkDefinitions, logging=True)
     print(resolver.logging)
     resolution_result = await resolver.resolve(did_to_resolve, resolution_options)
+    resolver.flush_test_vectors()
 
     print("Resolved Document")
     print(json.dumps(resolution_result, indent=2))
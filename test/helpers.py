@@ -0,0 +1,21 @@
+import requests
+
+
+def make_response(status_code, body=b"", headers=None, url="http://esplora/tx/abc/hex"):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers.update(headers or {})
+    response.request = requests.Request("GET", url).prepare()
+    response.url = url
+    return response
+
+
+def make_update(version_id=2, target_hash="target"):
+    return {
+        "targetVersionId": version_id,
+        "sourceHash": "source",
+        "targetHash": target_hash,
+        "patch": [],
+        "proof": {"capability": "urn:zcap:root:did", "verificationMethod": "did#key"},
+    }
@@ -0,0 +1,100 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from buidl.ecc import PrivateKey
+from buidl.tx import Tx
+
+from libbtcr2.address_manager import AddressManager
+from libbtcr2.fee_estimator import estimate_vsize
+
+
+def signed_vsize(tx):
+    weight = len(tx.serialize_legacy()) * 3 + len(tx.serialize())
+    return -(-weight // 4)
+
+
+class AddressManagerTestCase(TestCase):
+    sk = PrivateKey.parse("KyZpNDKnfs94vbrwhJneDi77V6jF64PWPF8x5cdJb8ifgg2DUc9d")
+
+    def setUp(self):
+        self.esplora = Mock()
+        self.esplora.get_address_utxos.return_value = [
+            {"txid": "aa" * 32, "vout": 0, "value": 60000},
+            {"txid": "bb" * 32, "vout": 1, "value": 44000},
+        ]
+        self.esplora.broadcast_tx.side_effect = lambda tx_hex: Tx.parse_hex(tx_hex).id()
+        self.esplora.get_fee_estimates.return_value = {"1": 20.5, "6": 10.0, "144": 1.0}
+        script_pubkey = self.sk.point.p2wpkh_script()
+        self.manager = AddressManager(self.esplora, "regtest", script_pubkey, self.sk)
+
+    def broadcast_tx(self):
+        return Tx.parse_hex(self.esplora.broadcast_tx.call_args.args[0])
+
+
+class FanOutTest(AddressManagerTestCase):
+    def test_equal_shares(self):
+        txid = self.manager.fan_out(4)
+        tx = self.broadcast_tx()
+        self.assertEqual(len(tx.tx_ins), 2)
+        fee = 10 * estimate_vsize([self.manager.script_pubkey] * 2, tx.tx_outs)
+        share = (104000 - fee) // 4
+        self.assertEqual([tx_out.amount for tx_out in tx.tx_outs], [share] * 4)
+        self.assertEqual(len(self.manager.utxos), 4)
+        for index, tx_in in enumerate(self.manager.utxo_tx_ins):
+            self.assertEqual(tx_in.prev_tx.hex(), txid)
+            self.assertEqual(tx_in.prev_index, index)
+            self.assertEqual(tx_in.value(), share)
+
+    def test_fixed_value_keeps_remainder(self):
+        self.manager.fan_out(3, 10000)
+        tx = self.broadcast_tx()
+        fee = 104000 - sum(tx_out.amount for tx_out in tx.tx_outs)
+        self.assertEqual([tx_out.amount for tx_out in tx.tx_outs][:3], [10000] * 3)
+        self.assertEqual(fee, 10 * estimate_vsize([self.manager.script_pubkey] * 2, tx.tx_outs))
+
+    def test_outputs_must_cover_a_fee(self):
+        with self.assertRaisesRegex(Exception, "Insufficient funds"):
+            self.manager.fan_out(60)
+        with self.assertRaisesRegex(Exception, "Insufficient funds"):
+            self.manager.fan_out(20, 10000)
+        self.esplora.broadcast_tx.assert_not_called()
+
+
+class SendToAddressTest(AddressManagerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.recipient = PrivateKey(12345).point.p2wpkh_script()
+
+    def test_spent_utxos_removed_and_change_tracked(self):
+        txid = self.manager.send_to_address(self.recipient, 30000)
+        tx = self.broadcast_tx()
+        # 30000 and the fee are covered by the 44000 UTXO alone
+        self.assertEqual(
+            [(tx_in.prev_tx.hex(), tx_in.prev_index) for tx_in in tx.tx_ins], [("bb" * 32, 1)]
+        )
+        self.assertEqual(tx.tx_outs[0].amount, 30000)
+        fee = 44000 - 30000 - tx.tx_outs[1].amount
+        # 10 sat/vB for the signed size, which the estimate can only exceed by a byte or so
+        self.assertGreaterEqual(fee, 10 * signed_vsize(tx))
+        self.assertLessEqual(fee, 10 * (signed_vsize(tx) + 1))
+        outpoints = {(tx_in.prev_tx.hex(), tx_in.prev_index) for tx_in in self.manager.utxos}
+        self.assertEqual(outpoints, {("aa" * 32, 0), (txid, 1)})
+
+    def test_changeless_match(self):
+        # The 60000 UTXO pays for 58800 and a 110 vB transaction at 10 sat/vB, with 100 to spare
+        self.manager.send_to_address(self.recipient, 58800)
+        tx = self.broadcast_tx()
+        self.assertEqual(len(tx.tx_outs), 1)
+        self.assertEqual(len(self.manager.utxos), 1)
+
+    def test_confirmation_target(self):
+        self.manager.send_to_address(self.recipient, 30000, conf_target=2)
+        tx = self.broadcast_tx()
+        fee = 44000 - 30000 - tx.tx_outs[1].amount
+        self.assertGreaterEqual(fee, 20.5 * signed_vsize(tx))
+
+    def test_failed_broadcast_releases_inputs(self):
+        self.esplora.broadcast_tx.side_effect = ConnectionError("offline")
+        with self.assertRaises(ConnectionError):
+            self.manager.send_to_address(self.recipient, 30000)
+        self.assertEqual(self.manager.utxos.available(), 2)
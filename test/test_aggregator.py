@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock
+
+from libbtcr2.aggregator import BeaconAggregator
+from libbtcr2.constants import CID_AGGREGATE_BEACON_TYPE, SMT_AGGREGATE_BEACON_TYPE
+from libbtcr2.content_store import SQLiteStore
+from libbtcr2.did_manager import DIDManager
+from libbtcr2.network_config import REGTEST
+from libbtcr2.resolver import Btcr2Resolver
+from libbtcr2.sidecar import SidecarIndex
+
+from .helpers import make_update
+
+DIDS = [f"did:btcr2:k1member{i}" for i in range(5)]
+
+
+class BeaconAggregatorTest(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.beacon_manager = Mock(address="bcrt1qaggregator", network="regtest")
+        self.beacon_manager.esplora_client.broadcast_tx.side_effect = lambda tx: f"txid{self.txs}"
+        self.resolver = Btcr2Resolver({"regtest": REGTEST})
+        self.members = {did: SimpleNamespace(signals_metadata={}) for did in DIDS}
+
+    @property
+    def txs(self):
+        return self.beacon_manager.esplora_client.broadcast_tx.call_count
+
+    def aggregator(self, beacon_type=SMT_AGGREGATE_BEACON_TYPE, **kwargs):
+        aggregator = BeaconAggregator(self.beacon_manager, beacon_type, **kwargs)
+        for did, member in self.members.items():
+            aggregator.register(did, member)
+        return aggregator
+
+    def commitment(self):
+        return self.beacon_manager.construct_beacon_signal.call_args.args[0]
+
+    async def resolve(self, did, beacon_type, txid, content_store=None):
+        self.resolver.content_store = content_store
+        signal = {"beaconType": beacon_type, "txid": txid, "signalHash": self.commitment()}
+        sidecar = SidecarIndex({"signalsMetadata": self.members[did].signals_metadata})
+        if beacon_type == CID_AGGREGATE_BEACON_TYPE:
+            signal["bundle"] = await self.resolver.cid_bundle(self.commitment(), sidecar)
+        return self.resolver.process_beacon_signals([signal], sidecar, did)
+
+    async def test_one_transaction_per_batch_window(self):
+        aggregator = self.aggregator(batch_window=0.01)
+        txids = await asyncio.gather(
+            *(aggregator.submit(did, make_update(target_hash=did)) for did in DIDS[:3])
+        )
+        self.assertEqual(txids, ["txid1"] * 3)
+        self.assertEqual(self.txs, 1)
+
+        for did in DIDS:
+            # Members without an update get a proof of that too
+            self.assertIn("txid1", self.members[did].signals_metadata)
+            updates = await self.resolve(did, SMT_AGGREGATE_BEACON_TYPE, "txid1")
+            self.assertEqual(
+                [update for update, _ in updates], [make_update(target_hash=did)][: did in DIDS[:3]]
+            )
+
+    async def test_full_batch_published_early(self):
+        aggregator = self.aggregator(batch_window=60, max_batch_size=2)
+        txids = await asyncio.wait_for(
+            asyncio.gather(
+                *(aggregator.submit(did, make_update(target_hash=did)) for did in DIDS[:2])
+            ),
+            1,
+        )
+        self.assertEqual(txids, ["txid1", "txid1"])
+
+    async def test_cid_bundle_published_to_content_store(self):
+        store = SQLiteStore(":memory:")
+        aggregator = self.aggregator(CID_AGGREGATE_BEACON_TYPE, content_store=store)
+        task = asyncio.ensure_future(aggregator.submit(DIDS[0], make_update(target_hash=DIDS[0])))
+        await asyncio.sleep(0)
+        self.assertEqual(await aggregator.flush(), "txid1")
+        self.assertEqual(await task, "txid1")
+
+        self.assertIsNotNone(store.get(self.commitment()))
+        self.assertNotIn("txid1", self.members[DIDS[1]].signals_metadata)
+        updates = await self.resolve(DIDS[0], CID_AGGREGATE_BEACON_TYPE, "txid1", store)
+        self.assertEqual(updates[0][0], make_update(target_hash=DIDS[0]))
+        self.assertEqual(await self.resolve(DIDS[1], CID_AGGREGATE_BEACON_TYPE, "txid1", store), [])
+
+    async def test_flushes_are_serialized(self):
+        lock = threading.Lock()
+        signing = []
+        overlaps = []
+
+        def construct(commitment):
+            with lock:
+                overlaps.append(bool(signing))
+                signing.append(commitment)
+            time.sleep(0.02)
+            with lock:
+                signing.remove(commitment)
+
+        self.beacon_manager.construct_beacon_signal.side_effect = construct
+        aggregator = self.aggregator(batch_window=60)
+        first = asyncio.ensure_future(aggregator.submit(DIDS[0], make_update(target_hash=DIDS[0])))
+        await asyncio.sleep(0)
+        first_flush = asyncio.ensure_future(aggregator.flush())
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(aggregator.submit(DIDS[1], make_update(target_hash=DIDS[1])))
+        await asyncio.sleep(0)
+
+        self.assertEqual(await aggregator.flush(), "txid2")
+        self.assertEqual(await first_flush, "txid1")
+        self.assertEqual([await first, await second], ["txid1", "txid2"])
+        self.assertEqual(overlaps, [False, False])
+
+    async def test_rejects_non_members_and_second_update(self):
+        aggregator = self.aggregator()
+        with self.assertRaisesRegex(Exception, "not a member"):
+            await aggregator.submit("did:btcr2:k1stranger", make_update(target_hash=DIDS[0]))
+        task = asyncio.ensure_future(aggregator.submit(DIDS[0], make_update(target_hash=DIDS[0])))
+        await asyncio.sleep(0)
+        with self.assertRaisesRegex(Exception, "already pending"):
+            await aggregator.submit(DIDS[0], make_update(target_hash=DIDS[0]))
+        await aggregator.flush()
+        await task
+
+    async def test_broadcast_failure_reported_to_submitters(self):
+        self.beacon_manager.esplora_client.broadcast_tx.side_effect = Exception("rejected")
+        aggregator = self.aggregator(batch_window=0.01)
+        with self.assertRaisesRegex(Exception, "rejected"):
+            await aggregator.submit(DIDS[0], make_update(target_hash=DIDS[0]))
+        self.assertEqual(aggregator.pending, {})
+
+    async def test_did_manager_announces_through_aggregator(self):
+        aggregator = self.aggregator(batch_window=0.01)
+        did_manager = DIDManager("regtest")
+        did_manager.did = DIDS[0]
+        did_manager.signals_metadata = {}
+        did_manager.join_aggregate_beacon(f"{DIDS[0]}#aggregateBeacon", aggregator)
+
+        update = make_update(target_hash=DIDS[0])
+        txid = await did_manager.announce_update(f"{DIDS[0]}#aggregateBeacon", update)
+        self.assertEqual(txid, "txid1")
+        self.assertEqual(did_manager.signals_metadata[txid]["updatePayload"], update)
+        self.assertIn("smtProof", did_manager.get_sidecar_data()["signalsMetadata"][txid])
@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from libbtcr2.block_index import BlockTimeIndex
+
+
+class FakeEsploraClient:
+    def __init__(self, median_times):
+        self.median_times = median_times
+        self.requests = 0
+
+    def get_tip_height(self):
+        return len(self.median_times) - 1
+
+    def get_blocks(self, start_height):
+        self.requests += 1
+        return [
+            {"height": height, "mediantime": self.median_times[height]}
+            for height in range(start_height, max(start_height - 10, -1), -1)
+        ]
+
+
+class BlockTimeIndexTest(TestCase):
+    def setUp(self):
+        # One block every 600s, median time past lagging the block time
+        self.client = FakeEsploraClient([1000 + 600 * height for height in range(1000)])
+        self.index = BlockTimeIndex(self.client)
+
+    def test_bound_is_first_height_with_later_median_time(self):
+        self.assertEqual(self.index.height_bound(1000 + 600 * 250), 250)
+        self.assertEqual(self.index.height_bound(1000 + 600 * 250 + 1), 251)
+        self.assertEqual(self.index.height_bound(0), 0)
+
+    def test_no_bound_beyond_tip(self):
+        self.assertIsNone(self.index.height_bound(1000 + 600 * 1000))
+
+    def test_headers_are_cached_below_reorg_depth(self):
+        self.index.height_bound(1000 + 600 * 250)
+        requests = self.client.requests
+        self.index.height_bound(1000 + 600 * 250)
+        # Only the tip, which is never cached, is fetched again
+        self.assertEqual(self.client.requests, requests + 1)
+        self.assertNotIn(999, self.index.median_times)
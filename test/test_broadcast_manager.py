@@ -0,0 +1,256 @@
+import threading
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock
+
+import requests
+from buidl.ecc import PrivateKey
+from buidl.tx import Tx
+
+from libbtcr2.beacon_manager import BeaconManager
+from libbtcr2.broadcast_manager import BROADCAST, CONFIRMED, QUEUED, BroadcastManager
+from libbtcr2.constants import RBF_SEQUENCE
+from libbtcr2.utxo_pool import UNCONFIRMED, outpoint
+
+
+class BroadcastManagerTest(IsolatedAsyncioTestCase):
+    sk = PrivateKey.parse("KyZpNDKnfs94vbrwhJneDi77V6jF64PWPF8x5cdJb8ifgg2DUc9d")
+
+    def setUp(self):
+        self.now = 0.0
+        self.tip = 100
+        # height -> txids mined in the block
+        self.blocks = {}
+        self.mempool = set()
+        self.esplora = Mock()
+        self.esplora.get_address_utxos.return_value = [
+            {"txid": f"{index:02x}" * 32, "vout": 0, "value": 100000} for index in range(1, 4)
+        ]
+        self.esplora.get_fee_estimates.return_value = {"1": 25.0, "6": 5.0}
+        self.esplora.broadcast_tx.side_effect = self.accept
+        self.esplora.get_tip_height.side_effect = lambda: self.tip
+        self.esplora.get_blocks.side_effect = lambda start: [
+            {"id": f"{height:064x}", "height": height}
+            for height in range(start, max(start - 10, 0), -1)
+        ]
+        self.esplora.get_block_txids.side_effect = lambda block_hash: self.blocks.get(
+            int(block_hash, 16), []
+        )
+        self.esplora.get_transaction.side_effect = self.lookup
+        self.beacon_manager = BeaconManager(
+            "regtest", "did:btcr2:k1x#beacon", self.sk, self.sk.point.p2wpkh_script(), self.esplora
+        )
+        self.manager = BroadcastManager(
+            self.esplora, "regtest", target_blocks=3, clock=lambda: self.now
+        )
+
+    def accept(self, tx_hex):
+        txid = Tx.parse_hex(tx_hex).id()
+        self.mempool.add(txid)
+        return txid
+
+    def lookup(self, txid):
+        if txid not in self.mempool:
+            raise requests.HTTPError("Transaction not found")
+        return {"txid": txid}
+
+    def mine(self, *txids):
+        self.tip += 1
+        self.blocks[self.tip] = ["ff" * 32, *txids]
+
+    def signal(self, commitment=b"\x01" * 32):
+        pending_signal = self.beacon_manager.construct_beacon_signal(commitment)
+        return self.beacon_manager.sign_beacon_signal(pending_signal)
+
+    async def test_one_scan_per_block_confirms_many(self):
+        txs = [self.signal(bytes([index]) * 32) for index in range(3)]
+        pendings = [await self.manager.broadcast(tx) for tx in txs]
+        self.assertEqual([pending.status for pending in pendings], [BROADCAST] * 3)
+
+        self.mine(txs[0].id(), txs[2].id())
+        self.mine()
+        self.mine(txs[1].id())
+        self.assertEqual(await self.manager.process(), [pendings[0], pendings[2], pendings[1]])
+        self.assertEqual(await self.manager.wait_for_confirmation(pendings[1]), 103)
+        self.assertEqual(pendings[0].block_height, 101)
+        self.assertEqual(pendings[2].status, CONFIRMED)
+        self.assertEqual(self.esplora.get_block_txids.call_count, 3)
+        self.esplora.get_transaction.assert_not_called()
+        self.assertEqual(self.manager.transactions, [])
+
+        # Nothing in flight, so idle polls do not touch the chain
+        self.mine()
+        await self.manager.process()
+        self.assertEqual(self.esplora.get_block_txids.call_count, 3)
+
+    async def test_transient_failures_retried_in_order(self):
+        parent, child = self.signal(), self.signal(b"\x02" * 32)
+        self.esplora.broadcast_tx.side_effect = requests.ConnectionError("offline")
+        first = self.manager.submit(parent)
+        second = self.manager.submit(child)
+        await self.manager.process()
+        self.assertEqual([first.status, second.status], [QUEUED, QUEUED])
+        self.assertEqual(self.esplora.broadcast_tx.call_count, 1)
+
+        # Not retried before the backoff has passed
+        await self.manager.process()
+        self.assertEqual(self.esplora.broadcast_tx.call_count, 1)
+        self.now += 10
+        self.esplora.broadcast_tx.side_effect = self.accept
+        await self.manager.process()
+        self.assertEqual([first.status, second.status], [BROADCAST, BROADCAST])
+        self.assertEqual(
+            [call.args[0] for call in self.esplora.broadcast_tx.call_args_list[-2:]],
+            [tx.serialize().hex() for tx in (parent, child)],
+        )
+
+    async def test_tip_height_failure_retried(self):
+        self.esplora.get_tip_height.side_effect = requests.ConnectionError("offline")
+        pending = self.manager.submit(self.signal())
+        # Handled like a failed broadcast attempt rather than raised from process
+        await self.manager.process()
+        self.assertEqual(pending.status, QUEUED)
+        self.esplora.broadcast_tx.assert_not_called()
+
+        self.now += 10
+        self.esplora.get_tip_height.side_effect = lambda: self.tip
+        await self.manager.process()
+        self.assertEqual(pending.status, BROADCAST)
+        self.assertEqual(pending.broadcast_height, 100)
+
+        # Given up on when it keeps failing, releasing the signal's input
+        self.esplora.get_tip_height.side_effect = requests.HTTPError(
+            "bad request", response=Mock(status_code=400)
+        )
+        manager = BroadcastManager(self.esplora, "regtest")
+        tx = self.signal(b"\x02" * 32)
+        available = self.beacon_manager.utxos.available()
+        with self.assertRaises(requests.HTTPError):
+            await manager.broadcast(tx, replacer=self.beacon_manager)
+        self.assertEqual(manager.transactions, [])
+        self.assertEqual(self.beacon_manager.utxos.available(), available + 1)
+
+    async def test_already_confirmed_transaction_settled(self):
+        tx = self.signal()
+        self.esplora.broadcast_tx.side_effect = requests.HTTPError("already in block chain")
+        self.esplora.get_transaction.side_effect = lambda txid: {
+            "txid": txid,
+            "status": {"confirmed": True, "block_height": 90},
+        }
+        pending = self.manager.submit(tx, replacer=self.beacon_manager)
+        self.assertEqual(await self.manager.process(), [pending])
+        self.assertEqual(await self.manager.wait_for_confirmation(pending), 90)
+        self.assertEqual(self.manager.transactions, [])
+
+    async def test_broadcast_without_a_task_waits_out_failures(self):
+        manager = BroadcastManager(self.esplora, "regtest", retry_backoff=0)
+        offline = [requests.ConnectionError("offline")] * 2
+
+        def broadcast(tx_hex):
+            if offline:
+                raise offline.pop()
+            return self.accept(tx_hex)
+
+        self.esplora.broadcast_tx.side_effect = broadcast
+        pending = await manager.broadcast(self.signal())
+        self.assertEqual(pending.status, BROADCAST)
+        self.assertEqual(self.esplora.broadcast_tx.call_count, 3)
+
+        # Given up on rather than left queued, to be broadcast later without its caller
+        manager.max_attempts = 2
+        self.esplora.broadcast_tx.side_effect = requests.ConnectionError("offline")
+        with self.assertRaises(requests.ConnectionError):
+            await manager.broadcast(self.signal(b"\x02" * 32))
+        self.assertEqual(manager.transactions, [pending])
+
+    async def test_rejected_transaction_fails(self):
+        response = Mock(status_code=400)
+        self.esplora.broadcast_tx.side_effect = requests.HTTPError("bad-txns", response=response)
+        tx = self.signal()
+        with self.assertRaises(requests.HTTPError):
+            await self.manager.broadcast(tx, replacer=self.beacon_manager)
+        self.assertEqual(self.manager.transactions, [])
+        # The input is released and no change tracked
+        self.assertEqual(self.beacon_manager.utxos.available(), 3)
+        self.assertIsNone(
+            self.beacon_manager.utxos.state(outpoint(self.beacon_manager.change_tx_in(tx)))
+        )
+        self.esplora.broadcast_tx.side_effect = self.accept
+
+        # Already known to the network, e.g. from an attempt that timed out
+        tx = self.signal(b"\x02" * 32)
+        self.mempool.add(tx.id())
+        pending = await self.manager.broadcast(tx)
+        self.assertEqual(pending.status, BROADCAST)
+
+    async def test_stuck_signal_replaced_with_higher_fee(self):
+        tx = self.signal()
+        self.assertEqual(tx.tx_ins[0].sequence.serialize(), RBF_SEQUENCE.to_bytes(4, "little"))
+        replaced = []
+        pending = await self.manager.broadcast(
+            tx,
+            fee_rate=5.0,
+            replacer=self.beacon_manager,
+            on_replaced=lambda pending, old_txid: replaced.append(
+                (old_txid, threading.get_ident())
+            ),
+        )
+        self.mine()
+        self.mine()
+        await self.manager.process()
+        self.assertEqual(pending.txids, [tx.id()])
+
+        self.mine()
+        await self.manager.process()
+        # Called on the event loop thread
+        self.assertEqual(replaced, [(tx.id(), threading.get_ident())])
+        replacement = pending.tx
+        self.assertEqual(pending.txids, [tx.id(), replacement.id()])
+        self.assertEqual(replacement.tx_ins[0].prev_tx, tx.tx_ins[0].prev_tx)
+        self.assertEqual(replacement.tx_outs[1].script_pubkey, tx.tx_outs[1].script_pubkey)
+        # Paid at the next-block rate, 25 sat/vB instead of 5
+        old_fee = 100000 - tx.tx_outs[0].amount
+        new_fee = 100000 - replacement.tx_outs[0].amount
+        self.assertEqual(new_fee, old_fee * 5)
+        # The pool follows the replacement's change
+        self.assertIsNone(
+            self.beacon_manager.utxos.state(outpoint(self.beacon_manager.change_tx_in(tx)))
+        )
+        self.assertEqual(
+            self.beacon_manager.utxos.state(
+                outpoint(self.beacon_manager.change_tx_in(replacement))
+            ),
+            UNCONFIRMED,
+        )
+
+        # Either version confirming settles it
+        self.mine(tx.id())
+        await self.manager.process()
+        self.assertEqual(pending.status, CONFIRMED)
+        self.assertEqual(pending.txid, tx.id())
+
+    async def test_signal_with_spent_change_not_replaced(self):
+        self.esplora.get_address_utxos.return_value = self.esplora.get_address_utxos.return_value[
+            :1
+        ]
+        self.beacon_manager.refresh_utxos()
+        tx = self.signal()
+        pending = await self.manager.broadcast(tx, replacer=self.beacon_manager)
+        # The next signal spends the first one's change
+        child = self.signal(b"\x02" * 32)
+        self.assertEqual(child.tx_ins[0].prev_tx, tx.hash())
+        for _ in range(3):
+            self.mine()
+        await self.manager.process()
+        self.assertEqual(pending.txids, [tx.id()])
+        self.assertEqual(self.esplora.broadcast_tx.call_count, 1)
+
+    async def test_rejected_replacement_releases_change(self):
+        pending = await self.manager.broadcast(self.signal(), replacer=self.beacon_manager)
+        change = outpoint(self.beacon_manager.change_tx_in(pending.tx))
+        self.esplora.broadcast_tx.side_effect = requests.HTTPError("insufficient fee")
+        for _ in range(3):
+            self.mine()
+        await self.manager.process()
+        self.assertEqual(pending.txids, [pending.txid])
+        self.assertEqual(pending.status, BROADCAST)
+        self.assertEqual(self.beacon_manager.utxos.state(change), UNCONFIRMED)
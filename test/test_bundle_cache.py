@@ -0,0 +1,103 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import Mock
+
+import jcs
+from buidl.helper import sha256
+from ipfs_cid import cid_sha256_wrap_digest
+
+from libbtcr2.bundle_cache import CIDBundleCache, index_bundle
+from libbtcr2.constants import CID_AGGREGATE_BEACON_TYPE
+from libbtcr2.network_config import REGTEST
+from libbtcr2.resolver import Btcr2Resolver
+from libbtcr2.sidecar import SidecarIndex
+
+from .helpers import make_update
+
+
+class IndexBundleTest(TestCase):
+    def test_index_by_did(self):
+        digest = sha256(b"update")
+        index = index_bundle({"did:btcr2:k1a": cid_sha256_wrap_digest(digest)})
+        self.assertEqual(index, {"did:btcr2:k1a": digest})
+
+    def test_invalid_bundle(self):
+        with self.assertRaisesRegex(Exception, "InvalidAggregateBundle"):
+            index_bundle(["not", "a", "bundle"])
+        with self.assertRaisesRegex(Exception, "InvalidAggregateBundle"):
+            index_bundle({"did:btcr2:k1a": "not a cid"})
+
+
+class CIDBundleCacheTest(IsolatedAsyncioTestCase):
+    async def test_concurrent_requests_share_one_fetch(self):
+        cache = CIDBundleCache()
+        fetches = []
+
+        async def fetch(bundle_hash):
+            fetches.append(bundle_hash)
+            await asyncio.sleep(0.01)
+            return {"did:btcr2:k1a": cid_sha256_wrap_digest(sha256(b"update"))}
+
+        key = sha256(b"bundle")
+        first, second = await asyncio.gather(cache.get(key, fetch), cache.get(key, fetch))
+        self.assertIs(first, second)
+        self.assertIs(await cache.get(key, fetch), first)
+        self.assertEqual(fetches, [key])
+        self.assertIn(key, cache)
+
+    async def test_evicts_least_recently_used(self):
+        cache = CIDBundleCache(cache_size=1)
+
+        async def fetch(bundle_hash):
+            return {}
+
+        await cache.get(b"a", fetch)
+        await cache.get(b"b", fetch)
+        self.assertNotIn(b"a", cache)
+        self.assertIn(b"b", cache)
+
+
+class CIDBeaconSignalTest(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.updates = {f"did:btcr2:k1test{i}": make_update(2) for i in range(3)}
+        self.updates["did:btcr2:k1test1"]["targetHash"] = "other"
+        self.bundle = {
+            did: cid_sha256_wrap_digest(sha256(jcs.canonicalize(update)))
+            for did, update in self.updates.items()
+        }
+        self.bundle_hash = sha256(jcs.canonicalize(self.bundle))
+        self.content_store = Mock()
+        self.content_store.get_json.side_effect = lambda digest: next(
+            update for update in self.updates.values() if sha256(jcs.canonicalize(update)) == digest
+        )
+        self.resolver = Btcr2Resolver({"regtest": REGTEST}, content_store=self.content_store)
+        self.esplora = self.resolver.networks["regtest"]["esplora_client"] = Mock()
+        beacon = Mock(id="did:btcr2:k1test0#cidBeacon", type=CID_AGGREGATE_BEACON_TYPE)
+        tx_data = {"txid": "cd" * 32, "vout": [{"scriptpubkey": "6a20" + self.bundle_hash.hex()}]}
+        self.block = {"block_height": 10, "block_time": 1000, "candidates": [(beacon, tx_data)]}
+
+    async def resolve_signal(self, did, sidecar):
+        signals = await self.resolver.parse_block_signals(
+            self.block, "regtest", sidecar=sidecar, identifier=did
+        )
+        return self.resolver.process_beacon_signals(signals, sidecar, did)
+
+    async def test_bundle_fetched_once_for_every_did(self):
+        sidecar = SidecarIndex({"signalsMetadata": {"cd" * 32: {"aggregateBundle": self.bundle}}})
+        for did, update in self.updates.items():
+            updates = await self.resolve_signal(did, sidecar)
+            self.assertEqual(updates, [(update, sha256(jcs.canonicalize(update)))])
+        # Later resolutions find the bundle cached and need neither sidecar nor transaction
+        updates = await self.resolve_signal("did:btcr2:k1test2", SidecarIndex())
+        self.assertEqual(len(updates), 1)
+        self.esplora.get_transaction_hex.assert_not_called()
+        self.assertEqual(self.content_store.get_json.call_count, 4)
+
+    async def test_did_not_in_bundle(self):
+        sidecar = SidecarIndex({"signalsMetadata": {"cd" * 32: {"aggregateBundle": self.bundle}}})
+        self.assertEqual(await self.resolve_signal("did:btcr2:k1absent", sidecar), [])
+
+    async def test_missing_bundle(self):
+        self.content_store.get_json.side_effect = lambda digest: None
+        with self.assertRaisesRegex(Exception, "Aggregate bundle .* not found"):
+            await self.resolver.cid_bundle(self.bundle_hash, SidecarIndex())
@@ -0,0 +1,64 @@
+import itertools
+import random
+from unittest import TestCase
+
+from libbtcr2.coin_selection import (
+    select_branch_and_bound,
+    select_coins,
+    select_largest_first,
+    select_lowest_larger,
+    select_single_random_draw,
+)
+
+
+def candidates(values):
+    return sorted((value, (f"{index:064x}", 0)) for index, value in enumerate(values))
+
+
+def total(pairs, keys):
+    values = dict((key, value) for value, key in pairs)
+    return sum(values[key] for key in keys)
+
+
+class CoinSelectionTest(TestCase):
+    def test_branch_and_bound_finds_changeless_match(self):
+        pairs = candidates([1000, 2000, 3000, 5000, 40000])
+        selection = select_branch_and_bound(pairs, 7000, 100)
+        self.assertEqual(total(pairs, selection), 7000)
+        self.assertIsNone(select_branch_and_bound(pairs, 6500, 100))
+        self.assertIsNone(select_branch_and_bound(pairs, 60000, 100))
+
+    def test_branch_and_bound_matches_exhaustive_search(self):
+        rng = random.Random(7)
+        for _ in range(50):
+            values = [rng.randrange(1000, 20000) for _ in range(8)]
+            pairs = candidates(values)
+            target = rng.randrange(5000, 40000)
+            exists = any(
+                target <= sum(combination) <= target + 500
+                for size in range(1, len(values) + 1)
+                for combination in itertools.combinations(values, size)
+            )
+            selection = select_branch_and_bound(pairs, target, 500)
+            self.assertEqual(selection is not None, exists)
+            if selection is not None:
+                self.assertTrue(target <= total(pairs, selection) <= target + 500)
+
+    def test_single_random_draw_leaves_room_for_change(self):
+        pairs = candidates([1000, 2000, 3000, 5000])
+        selection = select_single_random_draw(pairs, 4000, 546, random.Random(1))
+        self.assertGreaterEqual(total(pairs, selection), 4546)
+        self.assertEqual(len(select_single_random_draw(pairs, 10900, 546)), 4)
+        self.assertIsNone(select_single_random_draw(pairs, 12000, 546))
+
+    def test_largest_first_and_lowest_larger(self):
+        pairs = candidates([1000, 2000, 3000, 5000])
+        self.assertEqual(total(pairs, select_largest_first(pairs, 6000, 546)), 8000)
+        self.assertEqual(total(pairs, select_lowest_larger(pairs, 2000, 546)), 3000)
+        self.assertIsNone(select_lowest_larger(pairs, 5000, 546))
+
+    def test_select_coins_prefers_no_change(self):
+        pairs = candidates([1000, 2000, 3000, 50000])
+        self.assertEqual(total(pairs, select_coins(pairs, 4000, 546)), 4000)
+        self.assertEqual(total(pairs, select_coins(pairs, 7000, 546)), 50000)
+        self.assertIsNone(select_coins(pairs, 60000, 546))
@@ -0,0 +1,109 @@
+import json
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import Mock, patch
+
+import jcs
+import requests
+from buidl.ecc import PrivateKey
+from buidl.helper import sha256
+
+from libbtcr2.constants import EXTERNAL
+from libbtcr2.content_store import (
+    CachingStore,
+    ContentStore,
+    FileSystemStore,
+    GatewayStore,
+    SQLiteStore,
+)
+from libbtcr2.did import encode_identifier
+from libbtcr2.diddoc.builder import Btcr2DIDDocumentBuilder
+from libbtcr2.diddoc.doc import IntermediateBtcr2DIDDocument
+from libbtcr2.network_config import REGTEST
+from libbtcr2.resolver import Btcr2Resolver
+
+
+class ContentStoreTest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def test_local_stores_round_trip_and_verify(self):
+        sqlite_store = SQLiteStore(os.path.join(self.folder.name, "content.db"))
+        self.addCleanup(sqlite_store.close)
+        for store in (FileSystemStore(self.folder.name), sqlite_store):
+            digest = store.put(b'{"a":1}')
+            self.assertEqual(digest, sha256(b'{"a":1}'))
+            self.assertEqual(store.get_json(digest), {"a": 1})
+            self.assertIsNone(store.get(sha256(b"missing")))
+
+        # Tampered content is never returned
+        with open(FileSystemStore(self.folder.name).path(digest), "wb") as f:
+            f.write(b'{"a":2}')
+        self.assertIsNone(FileSystemStore(self.folder.name).get(digest))
+
+    def test_backends_implement_read_and_write(self):
+        with self.assertRaises(TypeError):
+            ContentStore()
+        with self.assertRaisesRegex(Exception, "read-only"):
+            GatewayStore("http://gateway").put(b"data")
+
+    def test_failed_file_write_leaves_no_temporary_file(self):
+        store = FileSystemStore(self.folder.name)
+        digest = sha256(b"data")
+        with patch("os.replace", side_effect=OSError("disk full")), self.assertRaises(OSError):
+            store.put(b"data")
+        self.assertEqual(os.listdir(os.path.dirname(store.path(digest))), [])
+
+    def test_gateway_content_is_verified(self):
+        gateway = GatewayStore("http://gateway")
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b"forged"
+        gateway.session.get = Mock(return_value=response)
+        self.assertIsNone(gateway.get(sha256(b"genuine")))
+        self.assertIn("/ipfs/bafkrei", gateway.session.get.call_args.args[0])
+
+        response._content = b"genuine"
+        self.assertEqual(gateway.get(sha256(b"genuine")), b"genuine")
+
+    def test_caching_store_writes_back_and_evicts(self):
+        local = FileSystemStore(self.folder.name)
+        remote = FileSystemStore(os.path.join(self.folder.name, "remote"))
+        digests = [remote.put(bytes([i])) for i in range(3)]
+        remote.read_only = True
+        store = CachingStore([local, remote], cache_size=2)
+
+        results = store.get_many(digests + [sha256(b"missing")])
+        self.assertEqual([results[digest] for digest in digests], [b"\x00", b"\x01", b"\x02"])
+        self.assertIsNone(results[sha256(b"missing")])
+        self.assertEqual(list(store.cache), digests[1:])
+        self.assertEqual(local.get(digests[0]), b"\x00")
+
+        digest = store.put(b"new")
+        self.assertEqual(local.get(digest), b"new")
+        self.assertEqual(list(store.cache), [digests[2], digest])
+
+
+class CasRetrievalTest(IsolatedAsyncioTestCase):
+    async def test_external_initial_document_from_content_store(self):
+        sk = PrivateKey.parse("KyZpNDKnfs94vbrwhJneDi77V6jF64PWPF8x5cdJb8ifgg2DUc9d")
+        document = Btcr2DIDDocumentBuilder.from_secp256k1_key(sk.point, "regtest").build()
+        intermediate = IntermediateBtcr2DIDDocument.from_did_document(document).serialize()
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        store = CachingStore([FileSystemStore(folder.name)])
+        genesis_bytes = store.put(jcs.canonicalize(intermediate))
+        identifier = encode_identifier(EXTERNAL, 1, "regtest", genesis_bytes)
+
+        resolver = Btcr2Resolver({"regtest": REGTEST}, content_store=store)
+        initial_document = await resolver.cas_retrieval(identifier, genesis_bytes, 1, "regtest")
+        self.assertEqual(initial_document.id, identifier)
+        self.assertEqual(
+            json.dumps(initial_document.serialize()).replace(identifier, document.id),
+            json.dumps(document.serialize()),
+        )
+
+        with self.assertRaisesRegex(Exception, "not found"):
+            await resolver.cas_retrieval(identifier, sha256(b"missing"), 1, "regtest")
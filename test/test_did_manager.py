@@ -1,10 +1,15 @@
 from random import randint
 from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock
 
+import requests
 from buidl.ecc import N, PrivateKey
+from buidl.tx import Tx
 
 from libbtcr2.did_manager import DIDManager
 
+from .helpers import make_update
+
 
 class DIDManagerTest(IsolatedAsyncioTestCase):
     sk = PrivateKey.parse("KyZpNDKnfs94vbrwhJneDi77V6jF64PWPF8x5cdJb8ifgg2DUc9d")
@@ -33,3 +38,28 @@ class DIDManagerTest(IsolatedAsyncioTestCase):
         self.assertEqual(did_doc.verification_method[0].id, did_doc.capability_invocation[0])
         self.assertEqual(did_doc.verification_method[0].id, did_doc.authentication[0])
         self.assertEqual(did_doc.verification_method[0].id, did_doc.assertion_method[0])
+
+    async def test_failed_signal_broadcast_keeps_its_utxo(self):
+        esplora = Mock()
+        esplora.get_address_utxos.return_value = [{"txid": "01" * 32, "vout": 0, "value": 100000}]
+        esplora.get_fee_estimates.return_value = {"1": 25.0, "6": 5.0}
+        esplora.broadcast_tx.side_effect = requests.ConnectionError("offline")
+        did_manager = DIDManager("regtest")
+        did_manager.esplora_client = esplora
+        did_manager.signals_metadata = {}
+        beacon_id = "did:btcr2:k1x#initialP2WPKH"
+        beacon_manager = did_manager.add_beacon_manager(
+            beacon_id, self.sk, self.sk.point.p2wpkh_script()
+        )
+
+        with self.assertRaises(requests.ConnectionError):
+            await did_manager.announce_update(beacon_id, make_update())
+        # Still spendable, also after a refresh from the unchanged address listing
+        beacon_manager.refresh_utxos()
+        self.assertEqual([value for value, _ in beacon_manager.utxos.candidates()], [100000])
+
+        esplora.broadcast_tx.side_effect = lambda tx_hex: Tx.parse_hex(tx_hex).id()
+        txid = await did_manager.announce_update(beacon_id, make_update())
+        signal = Tx.parse_hex(esplora.broadcast_tx.call_args.args[0])
+        self.assertEqual(txid, signal.id())
+        self.assertEqual([tx_in.prev_tx for tx_in in beacon_manager.utxo_tx_ins], [signal.hash()])
@@ -0,0 +1,246 @@
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+from libbtcr2.constants import BACKGROUND_PRIORITY, INTERACTIVE_PRIORITY
+from libbtcr2.deadline import request_deadline
+from libbtcr2.error import DeadlineExceededError
+from libbtcr2.esplora_client import CircuitBreaker, EsploraClient
+from libbtcr2.metrics import CACHE_REQUESTS
+from libbtcr2.rate_limiter import TokenBucket, request_priority
+
+from .helpers import make_response
+
+
+class EsploraClientTest(TestCase):
+    base_url = "http://esplora"
+
+    def test_advertises_compression(self):
+        client = EsploraClient(self.base_url)
+        self.assertIn("gzip", client.session.headers["Accept-Encoding"])
+
+    def test_conditional_request_served_from_cache(self):
+        client = EsploraClient(self.base_url)
+        hits = CACHE_REQUESTS.value(("esplora_etag", "hit"))
+        misses = CACHE_REQUESTS.value(("esplora_etag", "miss"))
+        responses = [
+            make_response(200, b"deadbeef", {"ETag": '"v1"', "Content-Length": "8"}),
+            make_response(304, headers={"ETag": '"v1"'}),
+        ]
+        with patch.object(client.session, "request", side_effect=responses) as request:
+            self.assertEqual(client.get_transaction_hex("abc"), "deadbeef")
+            self.assertEqual(client.get_transaction_hex("abc"), "deadbeef")
+
+        first_headers = request.call_args_list[0].kwargs["headers"]
+        second_headers = request.call_args_list[1].kwargs["headers"]
+        self.assertNotIn("If-None-Match", first_headers)
+        self.assertEqual(second_headers["If-None-Match"], '"v1"')
+        self.assertEqual(CACHE_REQUESTS.value(("esplora_etag", "hit")), hits + 1)
+        self.assertEqual(CACHE_REQUESTS.value(("esplora_etag", "miss")), misses + 1)
+
+        stats = client.get_transfer_stats()["tx/:txid/hex"]
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["not_modified"], 1)
+        self.assertEqual(stats["bytes_in"], 8)
+        self.assertGreater(stats["bytes_out"], 0)
+
+    def test_etag_cache_is_bounded(self):
+        client = EsploraClient(self.base_url, etag_cache_size=1)
+        responses = [
+            make_response(200, b"aa", {"ETag": '"a"'}),
+            make_response(200, b"bb", {"ETag": '"b"'}),
+        ]
+        with patch.object(client.session, "request", side_effect=responses):
+            client.get_transaction_hex("a")
+            client.get_transaction_hex("b")
+
+        self.assertEqual(list(client.etag_cache), [f"{self.base_url}/tx/b/hex"])
+
+    def test_error_status_raises(self):
+        client = EsploraClient(self.base_url, max_retries=0)
+        with (
+            patch.object(client.session, "request", return_value=make_response(500)),
+            self.assertRaises(requests.HTTPError),
+        ):
+            client.get_transaction_hex("abc")
+
+    def test_client_error_is_not_retried(self):
+        client = EsploraClient(self.base_url, max_retries=3)
+        with (
+            patch.object(client.session, "request", return_value=make_response(404)) as request,
+            self.assertRaises(requests.HTTPError),
+        ):
+            client.get_transaction_hex("abc")
+        self.assertEqual(request.call_count, 1)
+
+    def test_fails_over_to_next_backend(self):
+        client = EsploraClient(["http://primary", "http://secondary"], retry_backoff=0)
+
+        def request(method, url, **kwargs):
+            if url.startswith("http://primary"):
+                raise requests.ConnectionError("down")
+            return make_response(200, b"cafe", url=url)
+
+        with patch.object(client.session, "request", side_effect=request) as mock_request:
+            self.assertEqual(client.get_transaction_hex("abc"), "cafe")
+
+        urls = [call.args[1] for call in mock_request.call_args_list]
+        self.assertEqual(urls, ["http://primary/tx/abc/hex", "http://secondary/tx/abc/hex"])
+        self.assertEqual(mock_request.call_args_list[0].kwargs["timeout"], client.timeout)
+
+    def test_circuit_breaker_opens_and_half_opens(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertFalse(breaker.available())
+
+        now[0] = 10.0
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now[0] = 20.0
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_breaker_admits_a_single_trial(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertFalse(breaker.available())
+
+        now[0] = 10.0
+        self.assertTrue(breaker.available())
+        self.assertTrue(breaker.acquire())
+        self.assertFalse(breaker.available())
+        self.assertFalse(breaker.acquire())
+
+        # A throttled trial says nothing either way, so another one may go
+        breaker.release()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.acquire())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.acquire())
+
+    def test_refused_trial_spends_no_rate_limit_token(self):
+        now = [0.0]
+        limiter = TokenBucket(rate=1, burst=5, clock=lambda: now[0])
+        client = EsploraClient(self.base_url, max_retries=0, rate_limiter=limiter)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+        client.endpoints[0].breaker = breaker
+        breaker.record_failure()
+        now[0] = 10.0
+        # Another thread's trial request is in flight
+        threading.Thread(target=breaker.acquire).start()
+        while breaker.available():
+            time.sleep(0.001)
+
+        with (
+            patch.object(client.session, "request") as request,
+            self.assertRaisesRegex(requests.ConnectionError, "trial request in flight"),
+        ):
+            client.get_transaction_hex("abc")
+        request.assert_not_called()
+        self.assertEqual(limiter.tokens, 5)
+
+    def test_broadcast_is_not_retried_after_read_timeout(self):
+        client = EsploraClient(self.base_url, retry_backoff=0)
+        timeout = requests.ReadTimeout
+        with (
+            patch.object(client.session, "request", side_effect=timeout) as request,
+            self.assertRaises(timeout),
+        ):
+            client.broadcast_tx("00")
+        self.assertEqual(request.call_count, 1)
+
+        responses = [requests.ConnectTimeout(), make_response(200, b"abc")]
+        with patch.object(client.session, "request", side_effect=responses) as request:
+            self.assertEqual(client.broadcast_tx("00"), "abc")
+        self.assertEqual(request.call_count, 2)
+
+    def test_coalesces_only_within_a_priority(self):
+        client = EsploraClient(self.base_url)
+        release = threading.Event()
+        results = []
+
+        def request(method, url, **kwargs):
+            release.wait(2)
+            return make_response(200, b"cafe", url=url)
+
+        def fetch(priority):
+            request_priority.set(priority)
+            results.append(client.get_transaction_hex("abc"))
+
+        with patch.object(client.session, "request", side_effect=request) as mock_request:
+            threads = [
+                threading.Thread(target=fetch, args=(priority,))
+                for priority in (BACKGROUND_PRIORITY, INTERACTIVE_PRIORITY)
+            ]
+            for thread in threads:
+                thread.start()
+            started = time.monotonic()
+            while client._inflight.in_flight() < 2 and time.monotonic() - started < 1:
+                time.sleep(0.001)
+            in_flight = client._inflight.in_flight()
+            release.set()
+            for thread in threads:
+                thread.join(2)
+
+        self.assertEqual(in_flight, 2)
+        self.assertEqual(results, ["cafe"] * 2)
+        self.assertEqual(mock_request.call_count, 2)
+
+    def test_hedges_slow_primary(self):
+        client = EsploraClient(["http://slow", "http://fast"], hedge_percentile=50)
+        client.endpoints[0].latencies.extend([0.01] * 50)
+        release = threading.Event()
+
+        def request(method, url, **kwargs):
+            if url.startswith("http://slow"):
+                release.wait(5)
+                return make_response(200, b"slow", url=url)
+            return make_response(200, b"fast", url=url)
+
+        with patch.object(client.session, "request", side_effect=request):
+            self.assertEqual(client.get_transaction_hex("abc"), "fast")
+        release.set()
+        client.close()
+
+    def test_throttled_request_honors_retry_after(self):
+        client = EsploraClient(
+            self.base_url, retry_backoff=0, rate_limiter=TokenBucket(rate=1000, burst=10)
+        )
+        responses = [
+            make_response(429, headers={"Retry-After": "0.05"}),
+            make_response(200, b"beef"),
+        ]
+        with patch.object(client.session, "request", side_effect=responses):
+            started = time.monotonic()
+            self.assertEqual(client.get_transaction_hex("abc"), "beef")
+            self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(client.endpoints[0].breaker.failures, 0)
+
+    def test_requests_respect_deadline(self):
+        client = EsploraClient(self.base_url, timeout=10, retry_backoff=1)
+        token = request_deadline.set(time.monotonic() + 0.2)
+        try:
+            with patch.object(client.session, "request", side_effect=requests.Timeout) as request:
+                started = time.monotonic()
+                with self.assertRaises(DeadlineExceededError):
+                    client.get_transaction_hex("abc")
+                self.assertLess(time.monotonic() - started, 1)
+            self.assertLessEqual(request.call_args_list[0].kwargs["timeout"], 0.2)
+
+            request_deadline.set(time.monotonic() - 1)
+            with patch.object(client.session, "request") as request:
+                with self.assertRaises(DeadlineExceededError):
+                    client.get_transaction_hex("abc")
+                request.assert_not_called()
+        finally:
+            request_deadline.reset(token)
@@ -0,0 +1,94 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from buidl.ecc import PrivateKey
+from buidl.tx import Tx, TxIn, TxOut
+
+from libbtcr2.constants import FALLBACK_FEE_RATE
+from libbtcr2.fee_estimator import (
+    FeeEstimator,
+    estimate_vsize,
+    fee_for_vsize,
+    shared_fee_estimator,
+)
+
+
+class FeeEstimatorTest(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.esplora = Mock()
+        self.esplora.get_fee_estimates.return_value = {"1": 30.2, "3": 12.5, "6": 8.0, "144": 0.5}
+        self.estimator = FeeEstimator(self.esplora, ttl=60, clock=lambda: self.now)
+
+    def test_rate_for_confirmation_target(self):
+        self.assertEqual(self.estimator.fee_rate(1), 30.2)
+        self.assertEqual(self.estimator.fee_rate(4), 12.5)
+        self.assertEqual(self.estimator.fee_rate(6), 8.0)
+        # Below the relay minimum
+        self.assertEqual(self.estimator.fee_rate(1008), 1.0)
+        self.esplora.get_fee_estimates.return_value = {"2": 20.0}
+        self.estimator.invalidate()
+        self.assertEqual(self.estimator.fee_rate(1), 20.0)
+
+    def test_estimates_cached_for_ttl(self):
+        self.estimator.fee_rate(1)
+        self.estimator.fee_rate(6)
+        self.now += 59
+        self.estimator.fee_rate(3)
+        self.assertEqual(self.esplora.get_fee_estimates.call_count, 1)
+        self.now += 1
+        self.esplora.get_fee_estimates.return_value = {"1": 50.0}
+        self.assertEqual(self.estimator.fee_rate(1), 50.0)
+        self.assertEqual(self.esplora.get_fee_estimates.call_count, 2)
+
+    def test_failed_refresh_keeps_previous_estimates(self):
+        self.estimator.fee_rate(1)
+        self.now += 60
+        self.esplora.get_fee_estimates.side_effect = ConnectionError("offline")
+        self.assertEqual(self.estimator.fee_rate(1), 30.2)
+
+        estimator = FeeEstimator(self.esplora)
+        self.assertEqual(estimator.fee_rate(1), FALLBACK_FEE_RATE)
+        self.esplora.get_fee_estimates.side_effect = None
+        self.esplora.get_fee_estimates.return_value = {}
+        estimator.invalidate()
+        self.assertEqual(estimator.fee_rate(1), FALLBACK_FEE_RATE)
+
+    def test_shared_per_client(self):
+        self.assertIs(shared_fee_estimator(self.esplora), shared_fee_estimator(self.esplora))
+        self.assertIsNot(shared_fee_estimator(self.esplora), shared_fee_estimator(Mock()))
+
+
+class EstimateVsizeTest(TestCase):
+    sk = PrivateKey(424242)
+
+    def signed_tx(self, script_pubkey, input_count, segwit):
+        tx_ins = []
+        for index in range(input_count):
+            tx_in = TxIn(prev_tx=bytes([index + 1]) * 32, prev_index=index)
+            tx_in._script_pubkey = script_pubkey
+            tx_in._value = 50000
+            tx_ins.append(tx_in)
+        tx_outs = [TxOut(40000, PrivateKey(7).point.p2wpkh_script()), TxOut(5000, script_pubkey)]
+        tx = Tx(1, tx_ins, tx_outs, 0, network="regtest", segwit=segwit)
+        for index in range(input_count):
+            self.assertTrue(tx.sign_input(index, self.sk))
+        weight = len(tx.serialize_legacy()) * 3 + len(tx.serialize())
+        return tx, -(-weight // 4)
+
+    def test_covers_signed_size(self):
+        for script_pubkey, segwit in (
+            (self.sk.point.p2wpkh_script(), True),
+            (self.sk.point.p2pkh_script(), False),
+        ):
+            for input_count in (1, 3):
+                tx, vsize = self.signed_tx(script_pubkey, input_count, segwit)
+                estimate = estimate_vsize([script_pubkey] * input_count, tx.tx_outs)
+                self.assertGreaterEqual(estimate, vsize)
+                # Only signatures shorter than the maximum and the segwit marker are slack
+                self.assertLessEqual(estimate, vsize + input_count + 1)
+
+    def test_fee_rounds_up(self):
+        self.assertEqual(fee_for_vsize(141, 10.0), 1410)
+        self.assertEqual(fee_for_vsize(141, 1.01), 143)
+        self.assertEqual(fee_for_vsize(141, 0.2), 141)
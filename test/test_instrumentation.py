@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from libbtcr2.instrumentation import (
+    ESPLORA,
+    ResolutionHooks,
+    ResolutionProfile,
+    current_profile,
+    record_transfer_bytes,
+)
+
+
+class RecordingHooks(ResolutionHooks):
+    def __init__(self):
+        self.phases = []
+        self.resolutions = []
+
+    def on_phase(self, identifier, phase, seconds, nbytes, beacon_id=None):
+        self.phases.append((identifier, phase, nbytes, beacon_id))
+
+    def on_resolution(self, identifier, profile):
+        self.resolutions.append(identifier)
+
+
+class ResolutionProfileTest(TestCase):
+    def test_phases_bytes_and_hooks(self):
+        hooks = RecordingHooks()
+        profile = ResolutionProfile("did:btcr2:k1abc", [hooks])
+        token = current_profile.set(profile)
+        try:
+            with profile.phase(ESPLORA, "#initialP2PKH"):
+                record_transfer_bytes(512)
+            with profile.phase(ESPLORA, "#initialP2PKH"):
+                record_transfer_bytes(256)
+        finally:
+            current_profile.reset(token)
+        profile.count("signals", 2)
+        profile.finish()
+
+        serialized = profile.serialize()
+        self.assertEqual(serialized["phases"][ESPLORA]["calls"], 2)
+        self.assertEqual(serialized["phases"][ESPLORA]["bytes"], 768)
+        self.assertEqual(serialized["beacons"]["#initialP2PKH"][ESPLORA]["bytes"], 768)
+        self.assertEqual(serialized["counters"], {"signals": 2})
+        self.assertEqual(
+            hooks.phases,
+            [
+                ("did:btcr2:k1abc", ESPLORA, 512, "#initialP2PKH"),
+                ("did:btcr2:k1abc", ESPLORA, 256, "#initialP2PKH"),
+            ],
+        )
+        self.assertEqual(hooks.resolutions, ["did:btcr2:k1abc"])
+
+    def test_bytes_outside_a_resolution_are_ignored(self):
+        profile = ResolutionProfile("did:btcr2:k1abc")
+        with profile.phase(ESPLORA):
+            record_transfer_bytes(100)
+        self.assertEqual(profile.serialize()["phases"][ESPLORA]["bytes"], 0)
+
+    def test_bytes_outside_a_phase_are_recorded_as_esplora(self):
+        hooks = RecordingHooks()
+        profile = ResolutionProfile("did:btcr2:k1abc", [hooks])
+        token = current_profile.set(profile)
+        try:
+            record_transfer_bytes(100)
+        finally:
+            current_profile.reset(token)
+        self.assertEqual(
+            profile.serialize()["phases"][ESPLORA], {"calls": 0, "seconds": 0.0, "bytes": 100}
+        )
+        self.assertEqual(hooks.phases, [])
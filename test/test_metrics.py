@@ -0,0 +1,66 @@
+import threading
+import urllib.request
+from unittest import TestCase
+
+from libbtcr2.metrics import Metric, MetricsRegistry, start_metrics_server
+
+
+class MetricsRegistryTest(TestCase):
+    def test_counter_aggregates_across_threads(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("resolutions", "Resolutions", ["outcome"])
+
+        def work():
+            for _ in range(1000):
+                counter.inc(labels=("success",))
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counter.value(("success",)), 4000)
+        self.assertIn('resolutions_total{outcome="success"} 4000', registry.expose())
+
+    def test_metric_requires_samples(self):
+        with self.assertRaises(TypeError):
+            Metric("untyped", "No samples")
+
+    def test_histogram_exposition(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("latency_seconds", "Latency", ["route"], buckets=(0.1, 1))
+        histogram.observe(0.05, labels=("tx",))
+        histogram.observe(0.5, labels=("tx",))
+        histogram.observe(5, labels=("tx",))
+
+        text = registry.expose()
+        self.assertIn("# TYPE latency_seconds histogram", text)
+        self.assertIn('latency_seconds_bucket{route="tx",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{route="tx",le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{route="tx",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{route="tx"} 3', text)
+        self.assertIn('latency_seconds_sum{route="tx"} 5.55', text)
+
+    def test_gauge_and_conflicting_registration(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge("utxos", "UTXOs")
+        gauge.inc(3)
+        gauge.dec()
+        self.assertEqual(gauge.value(), 2)
+        self.assertIs(registry.gauge("utxos", "UTXOs"), gauge)
+        with self.assertRaises(ValueError):
+            registry.counter("utxos", "UTXOs")
+
+    def test_metrics_endpoint(self):
+        registry = MetricsRegistry()
+        registry.counter("requests", "Requests").inc()
+        server = start_metrics_server(0, registry=registry)
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                body = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn("requests_total 1", body)
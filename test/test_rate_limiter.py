@@ -0,0 +1,39 @@
+import threading
+import time
+from unittest import TestCase
+
+from libbtcr2.constants import BACKGROUND_PRIORITY, INTERACTIVE_PRIORITY
+from libbtcr2.rate_limiter import TokenBucket
+
+
+class TokenBucketTest(TestCase):
+    def test_burst_then_timeout(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertFalse(bucket.acquire(timeout=0.01))
+
+    def test_interactive_requests_jump_the_queue(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.acquire()
+        order = []
+
+        def acquire(priority, name):
+            bucket.acquire(priority)
+            order.append(name)
+
+        background = threading.Thread(target=acquire, args=(BACKGROUND_PRIORITY, "background"))
+        background.start()
+        time.sleep(0.02)
+        interactive = threading.Thread(target=acquire, args=(INTERACTIVE_PRIORITY, "interactive"))
+        interactive.start()
+        background.join(2)
+        interactive.join(2)
+
+        self.assertEqual(order, ["interactive", "background"])
+
+    def test_pause_blocks_issuance(self):
+        bucket = TokenBucket(rate=100, burst=5)
+        bucket.pause(0.1)
+        self.assertFalse(bucket.acquire(timeout=0.02))
+        self.assertTrue(bucket.acquire(timeout=1))
@@ -0,0 +1,270 @@
+import asyncio
+import copy
+import json
+import os
+import tempfile
+import urllib
+from contextlib import aclosing
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import Mock, patch
+
+import base58
+import jcs
+from buidl.ecc import PrivateKey
+from buidl.helper import bytes_to_str, sha256
+
+from libbtcr2.deadline import request_deadline
+from libbtcr2.diddoc.builder import Btcr2DIDDocumentBuilder
+from libbtcr2.network_config import REGTEST
+from libbtcr2.resolver import Btcr2Resolver, check_update_shape
+
+
+def document_hash(document):
+    return bytes_to_str(base58.b58encode(sha256(jcs.canonicalize(document))))
+
+
+class ApplyDidUpdateTest(TestCase):
+    sk = PrivateKey.parse("KyZpNDKnfs94vbrwhJneDi77V6jF64PWPF8x5cdJb8ifgg2DUc9d")
+
+    def setUp(self):
+        self.resolver = Btcr2Resolver({"regtest": REGTEST})
+        self.document = Btcr2DIDDocumentBuilder.from_secp256k1_key(self.sk.point, "regtest").build()
+        service = {
+            "id": f"{self.document.id}#newBeacon",
+            "type": "SingletonBeacon",
+            "serviceEndpoint": f"bitcoin:{self.sk.point.p2wpkh_address(network='signet')}",
+        }
+        source = self.document.serialize()
+        patch_operations = [
+            {"op": "add", "path": f"/service/{len(source['service'])}", "value": service}
+        ]
+        target = copy.deepcopy(source)
+        target["service"].append(service)
+        self.update = {
+            "patch": patch_operations,
+            "sourceHash": document_hash(source),
+            "targetHash": document_hash(target),
+            "targetVersionId": 2,
+            "proof": {
+                "capability": f"urn:zcap:root:{urllib.parse.quote(self.document.id)}",
+                "verificationMethod": f"{self.document.id}#initialKey",
+            },
+        }
+
+    def assert_rejected_before_verification(self, update, error):
+        with (
+            patch("libbtcr2.resolver.DataIntegrityProof") as proof,
+            self.assertRaisesRegex(Exception, error),
+        ):
+            self.resolver.apply_did_update(self.document, update)
+        proof.assert_not_called()
+
+    def test_wrong_target_hash_rejected_before_verification(self):
+        self.update["targetHash"] = self.update["sourceHash"]
+        self.assert_rejected_before_verification(self.update, "LatePublishingError")
+
+    def test_foreign_capability_rejected_before_verification(self):
+        self.update["proof"]["capability"] = "urn:zcap:root:did%3Abtcr2%3Ak1other"
+        self.assert_rejected_before_verification(self.update, "Invalid Capability Invocation")
+
+    def test_malformed_patch_rejected_before_verification(self):
+        self.update["patch"] = [{"op": "explode", "path": "/service"}]
+        self.assert_rejected_before_verification(self.update, "InvalidUpdate")
+        self.update["patch"] = "not a patch"
+        self.assert_rejected_before_verification(self.update, "InvalidUpdate")
+
+    def test_proof_verified_last(self):
+        with patch("libbtcr2.resolver.DataIntegrityProof") as proof:
+            proof.return_value.verify_proof.return_value = {"verified": True}
+            updated = self.resolver.apply_did_update(self.document, self.update)
+        proof.return_value.verify_proof.assert_called_once()
+        self.assertEqual(len(updated.service), len(self.document.service) + 1)
+
+    def test_duplicate_updates_confirmed_by_version(self):
+        update_hash = sha256(jcs.canonicalize(self.update))
+        update_hashes = {2: update_hash}
+        self.resolver.confirm_duplicate_update(self.update, update_hashes, update_hash)
+        self.resolver.confirm_duplicate_update(self.update, update_hashes)
+        with self.assertRaisesRegex(Exception, "Late Publishing"):
+            self.resolver.confirm_duplicate_update(self.update, {2: b"\x00" * 32})
+        with self.assertRaisesRegex(Exception, "Late Publishing"):
+            self.resolver.confirm_duplicate_update(self.update, {})
+
+    def test_update_shape(self):
+        check_update_shape(self.update)
+        for key in ("targetVersionId", "sourceHash", "targetHash", "proof", "patch"):
+            malformed = {k: v for k, v in self.update.items() if k != key}
+            with self.assertRaisesRegex(Exception, "InvalidUpdate"):
+                check_update_shape(malformed)
+
+
+class IterVersionsTest(IsolatedAsyncioTestCase):
+    sk = PrivateKey.parse("KyZpNDKnfs94vbrwhJneDi77V6jF64PWPF8x5cdJb8ifgg2DUc9d")
+
+    def setUp(self):
+        self.resolver = Btcr2Resolver({"regtest": REGTEST})
+        self.identifier, self.updates, self.options, blocks = self.make_history(self.sk)
+
+        async def fetch_candidate_blocks(beacons, height, network, profile, max_height=None):
+            return [block for block in blocks if block["block_height"] >= height]
+
+        self.resolver.fetch_candidate_blocks = fetch_candidate_blocks
+        self.esplora_client = self.resolver.networks["regtest"]["esplora_client"] = Mock()
+        self.resolver.networks["regtest"]["block_index"] = Mock(
+            **{"height_bound.return_value": 250}
+        )
+        verified = patch("libbtcr2.resolver.DataIntegrityProof")
+        proof = verified.start()
+        proof.return_value.verify_proof.return_value = {"verified": True}
+        self.addCleanup(verified.stop)
+
+    def make_history(self, sk, first_height=100):
+        """A DID for ``sk`` with three updates, announced one block apart from ``first_height``."""
+        builder = Btcr2DIDDocumentBuilder.from_secp256k1_key(sk.point, "regtest")
+        identifier = builder.build().id
+        # Each update adds a beacon service
+        updates = []
+        document = builder.build().serialize()
+        for version_id in range(2, 5):
+            service = {
+                "id": f"{identifier}#beacon{version_id}",
+                "type": "SingletonBeacon",
+                "serviceEndpoint": f"bitcoin:{sk.point.p2wpkh_address(network='signet')}",
+            }
+            target = copy.deepcopy(document)
+            target["service"].append(service)
+            update = {
+                "patch": [
+                    {"op": "add", "path": f"/service/{len(document['service'])}", "value": service}
+                ],
+                "sourceHash": document_hash(document),
+                "targetHash": document_hash(target),
+                "targetVersionId": version_id,
+                "proof": {
+                    "capability": f"urn:zcap:root:{urllib.parse.quote(identifier)}",
+                    "verificationMethod": f"{identifier}#initialKey",
+                },
+            }
+            updates.append(update)
+            document = target
+
+        # Signals commit to the update hashes; the payloads come as sidecar data
+        beacon = Mock(id=f"{identifier}#initialP2PKH", type="SingletonBeacon")
+        signals_metadata = {}
+        blocks = []
+        for index, update in enumerate(updates):
+            block_height = first_height + 100 * index
+            txid = sha256(identifier.encode() + bytes([index])).hex()
+            signals_metadata[txid] = {"updatePayload": update}
+            update_hash = sha256(jcs.canonicalize(update))
+            tx_data = {"txid": txid, "vout": [{"scriptpubkey": f"6a20{update_hash.hex()}"}]}
+            blocks.append(
+                {
+                    "block_height": block_height,
+                    "block_time": 10 * block_height,
+                    "candidates": [(beacon, tx_data)],
+                }
+            )
+        return identifier, updates, {"sidecarData": {"signalsMetadata": signals_metadata}}, blocks
+
+    async def test_streams_every_version(self):
+        versions = [
+            version async for version in self.resolver.iter_versions(self.identifier, self.options)
+        ]
+        self.assertEqual([version["versionId"] for version in versions], [1, 2, 3, 4])
+        self.assertEqual([version["blockHeight"] for version in versions], [None, 100, 200, 300])
+        self.assertEqual(versions[2]["update"], self.updates[1])
+        self.assertEqual(
+            len(versions[3]["didDocument"].service), len(versions[0]["didDocument"].service) + 3
+        )
+        # Every signal was matched to its sidecar payload from the transaction listing
+        self.esplora_client.get_transaction_hex.assert_not_called()
+
+    async def test_stops_at_requested_version(self):
+        options = {"versionId": 3, **self.options}
+        async with aclosing(self.resolver.iter_versions(self.identifier, options)) as versions:
+            version_ids = [version["versionId"] async for version in versions]
+        self.assertEqual(version_ids, [1, 2, 3])
+
+        result = await self.resolver.resolve(self.identifier, {"versionTime": 2500, **self.options})
+        self.assertEqual(result["didDocumentMetadata"]["version"], 3)
+
+    async def test_history_matches_resolution(self):
+        history = await self.resolver.resolve_history(self.identifier, self.options)
+        self.assertEqual(len(history), 4)
+        for version_id in range(1, 5):
+            options = {"versionId": version_id, **self.options}
+            result = await self.resolver.resolve(self.identifier, options)
+            self.assertEqual(history.resolve(version_id=version_id), result)
+
+    async def test_timeout_does_not_leak_into_the_caller(self):
+        options = {"timeout": 30, **self.options}
+        await self.resolver.resolve_history(self.identifier, options)
+        self.assertIsNone(request_deadline.get())
+
+        async with aclosing(self.resolver.iter_versions(self.identifier, options)) as versions:
+            async for _ in versions:
+                self.assertIsNotNone(request_deadline.get())
+                break
+        self.assertIsNone(request_deadline.get())
+
+    async def test_versions_can_be_modified_by_the_consumer(self):
+        service_counts = []
+        async for version in self.resolver.iter_versions(self.identifier, self.options):
+            service_counts.append(len(version["didDocument"].service))
+            version["didDocument"].service.clear()
+        self.assertEqual(service_counts, [service_counts[0] + n for n in range(4)])
+
+    async def test_concurrent_resolutions_keep_separate_state(self):
+        other_sk = PrivateKey(secret=0x5EED)
+        histories = {
+            self.identifier: (self.updates, self.options, self.resolver.fetch_candidate_blocks)
+        }
+        other, other_updates, other_options, other_blocks = self.make_history(other_sk, 150)
+
+        async def other_candidate_blocks(beacons, height, network, profile, max_height=None):
+            return [block for block in other_blocks if block["block_height"] >= height]
+
+        histories[other] = (other_updates, other_options, other_candidate_blocks)
+
+        async def fetch_candidate_blocks(beacons, *args, **kwargs):
+            await asyncio.sleep(0)
+            _, _, fetch = histories[beacons[0].id.split("#")[0]]
+            return await fetch(beacons, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as log_folder:
+            resolver = Btcr2Resolver({"regtest": REGTEST}, logging=True, log_folder=log_folder)
+            resolver.networks["regtest"] = self.resolver.networks["regtest"]
+            resolver.fetch_candidate_blocks = fetch_candidate_blocks
+            results = await asyncio.gather(
+                *(resolver.resolve(did, options) for did, (_, options, _) in histories.items())
+            )
+            resolver.flush_test_vectors()
+
+            for (did, (updates, _, _)), result, first_height in zip(
+                histories.items(), results, (100, 150), strict=True
+            ):
+                self.assertEqual(result["didDocument"]["id"], did)
+                self.assertEqual(result["didDocumentMetadata"]["version"], 4)
+                did_folder = os.path.join(log_folder, "regtest", did.split(":")[2])
+                heights = [first_height + 100 * index for index in range(3)]
+                self.assertEqual(
+                    sorted(os.listdir(did_folder)),
+                    sorted(f"block{height}" for height in heights),
+                )
+                for height, update in zip(heights, updates, strict=True):
+                    with open(os.path.join(did_folder, f"block{height}", "updates.json")) as f:
+                        self.assertEqual(json.load(f), [update])
+                    with open(
+                        os.path.join(did_folder, f"block{height}", "contemporaryDidDocument.json")
+                    ) as f:
+                        document = json.load(f)
+                    self.assertEqual(document["id"], did)
+                    self.assertEqual(document_hash(document), update["targetHash"])
+
+    async def test_inconsistent_sidecar_rejected_before_fetching(self):
+        self.updates[1]["sourceHash"] = self.updates[1]["targetHash"]
+        self.resolver.fetch_candidate_blocks = Mock()
+        with self.assertRaisesRegex(Exception, "InvalidSidecarData"):
+            await self.resolver.resolve(self.identifier, self.options)
+        self.resolver.fetch_candidate_blocks.assert_not_called()
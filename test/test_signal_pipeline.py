@@ -0,0 +1,70 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from libbtcr2.instrumentation import NULL_PROFILE
+from libbtcr2.resolution_context import ResolutionContext
+from libbtcr2.signal_pipeline import SignalPipeline
+
+
+class FakeResolver:
+    def __init__(self, heights, fail_at=None):
+        self.heights = heights
+        self.fail_at = fail_at
+        self.parsed = []
+
+    async def fetch_candidate_blocks(
+        self, beacons, start_height, network, profile=NULL_PROFILE, max_height=None
+    ):
+        return [
+            {"block_height": height}
+            for height in self.heights
+            if height >= start_height and (max_height is None or height <= max_height)
+        ]
+
+    async def parse_block_signals(
+        self, block, network, profile=NULL_PROFILE, sidecar=None, identifier=None
+    ):
+        height = block["block_height"]
+        if height == self.fail_at:
+            raise Exception("Bad transaction")
+        self.parsed.append(height)
+        return [{"block_height": height}]
+
+
+class SignalPipelineTest(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.context = ResolutionContext("did:btcr2:k1abc", "regtest")
+
+    async def test_yields_blocks_in_order(self):
+        pipeline = SignalPipeline(FakeResolver([5, 9, 12]), [], 6, self.context)
+        heights = []
+        while signals := await pipeline.next_signals():
+            heights.append(signals[0]["block_height"])
+        self.assertEqual(heights, [9, 12])
+        self.assertEqual(await pipeline.next_signals(), [])
+        await pipeline.close()
+
+    async def test_stops_at_height_bound(self):
+        self.context.height_bound = 9
+        pipeline = SignalPipeline(FakeResolver([5, 9, 12]), [], 0, self.context)
+        self.assertEqual((await pipeline.next_signals())[0]["block_height"], 5)
+        self.assertEqual((await pipeline.next_signals())[0]["block_height"], 9)
+        self.assertEqual(await pipeline.next_signals(), [])
+        await pipeline.close()
+
+    async def test_prefetch_is_bounded(self):
+        resolver = FakeResolver(list(range(100)))
+        pipeline = SignalPipeline(resolver, [], 0, self.context, depth=2)
+        await pipeline.next_signals()
+        await asyncio.sleep(0.01)
+        # One block consumed, two queued and one waiting in the parse stage
+        self.assertLessEqual(len(resolver.parsed), 4)
+        await pipeline.close()
+        self.assertTrue(all(task.done() for task in pipeline._tasks))
+
+    async def test_stage_errors_reach_the_consumer(self):
+        pipeline = SignalPipeline(FakeResolver([1, 2], fail_at=2), [], 0, self.context)
+        await pipeline.next_signals()
+        with self.assertRaisesRegex(Exception, "Bad transaction"):
+            await pipeline.next_signals()
+        await pipeline.close()
@@ -0,0 +1,250 @@
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock
+
+import requests
+from buidl.ecc import PrivateKey
+from buidl.tx import Tx
+
+from libbtcr2.beacon_manager import BeaconManager
+from libbtcr2.broadcast_manager import BroadcastManager
+from libbtcr2.signal_queue import (
+    BROADCAST,
+    CONFIRMED,
+    SIGNALS_IN_FLIGHT,
+    SIGNED,
+    BeaconSignalQueue,
+    BeaconSignalScheduler,
+)
+
+
+class BeaconTestCase(IsolatedAsyncioTestCase):
+    sk = PrivateKey.parse("KyZpNDKnfs94vbrwhJneDi77V6jF64PWPF8x5cdJb8ifgg2DUc9d")
+
+    def setUp(self):
+        self.tip = 100
+        # height -> txids mined in the block
+        self.blocks = {}
+        self.esplora = self.make_esplora()
+        self.beacon_manager = self.make_beacon_manager()
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.state_dir.name, "signals.json")
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def make_esplora(self):
+        esplora = Mock()
+        esplora.get_address_utxos.return_value = [{"txid": "aa" * 32, "vout": 0, "value": 100000}]
+        esplora.broadcast_tx.side_effect = lambda tx_hex: Tx.parse_hex(tx_hex).id()
+        esplora.get_tip_height.side_effect = lambda: self.tip
+        esplora.get_blocks.side_effect = lambda start: [
+            {"id": f"{height:064x}", "height": height}
+            for height in range(start, max(start - 10, 0), -1)
+        ]
+        esplora.get_block_txids.side_effect = lambda block_hash: self.blocks.get(
+            int(block_hash, 16), []
+        )
+        esplora.get_transaction.side_effect = requests.HTTPError("Transaction not found")
+        return esplora
+
+    def mine(self, *txids):
+        self.tip += 1
+        self.blocks[self.tip] = ["ff" * 32, *txids]
+
+    def make_beacon_manager(self):
+        return BeaconManager(
+            "regtest", "did:btcr2:k1x#beacon", self.sk, self.sk.point.p2wpkh_script(), self.esplora
+        )
+
+    def broadcast_txs(self):
+        return [Tx.parse_hex(call.args[0]) for call in self.esplora.broadcast_tx.call_args_list]
+
+
+class BeaconSignalQueueTest(BeaconTestCase):
+    async def test_signals_chain_through_unconfirmed_change(self):
+        queue = BeaconSignalQueue(self.beacon_manager)
+        for index in range(3):
+            queue.enqueue(bytes([index]) * 32)
+        self.assertEqual(await queue.publish(), 3)
+
+        txs = self.broadcast_txs()
+        self.assertEqual(txs[0].tx_ins[0].prev_tx.hex(), "aa" * 32)
+        for parent, child in zip(txs, txs[1:], strict=False):
+            self.assertEqual(child.tx_ins[0].prev_tx, parent.hash())
+            self.assertEqual(child.tx_ins[0].prev_index, 0)
+        self.assertEqual(txs[2].tx_outs[1].script_pubkey.commands[1], bytes([2]) * 32)
+        self.assertEqual(queue.in_flight, 3)
+
+    async def test_ancestor_limit_waits_for_confirmations(self):
+        reported = []
+        queue = BeaconSignalQueue(
+            self.beacon_manager, ancestor_limit=2, on_confirmed=reported.append
+        )
+        records = [queue.enqueue(bytes([index]) * 32) for index in range(3)]
+        self.assertEqual(await queue.publish(), 2)
+        self.assertEqual(records[2]["txid"], None)
+
+        waiter = asyncio.ensure_future(queue.wait_for_confirmation(records[0]["id"]))
+        self.mine(records[0]["txid"])
+        self.assertEqual(await queue.poll_confirmations(), [records[0]])
+        self.assertEqual((await waiter)["status"], CONFIRMED)
+        self.assertEqual(reported, [records[0]])
+        self.assertEqual(records[0]["blockHeight"], 101)
+
+        self.assertEqual(await queue.publish(), 1)
+        self.assertEqual(records[2]["status"], BROADCAST)
+        # Found by scanning the new block, not by looking up each signal
+        self.esplora.get_transaction.assert_not_called()
+
+    async def test_announce_without_a_task(self):
+        queue = BeaconSignalQueue(self.beacon_manager, self.state_path, ancestor_limit=1)
+        await queue.announce(b"\x01" * 32)
+        with self.assertRaisesRegex(Exception, "beacon chain is full"):
+            await queue.announce(b"\x02" * 32)
+        # The signal is dropped rather than broadcast later without its caller
+        self.assertEqual(len(queue.signals), 1)
+        restarted = BeaconSignalQueue(self.make_beacon_manager(), self.state_path)
+        self.assertEqual(len(restarted.signals), 1)
+
+        # A signed signal may already be on the network, so it is retried instead
+        queue.ancestor_limit = 2
+        queue.poll_interval = 0
+        offline = [ConnectionError("offline")]
+
+        def broadcast(tx_hex):
+            if offline:
+                raise offline.pop()
+            return Tx.parse_hex(tx_hex).id()
+
+        self.esplora.broadcast_tx.side_effect = broadcast
+        self.esplora.get_transaction.side_effect = ConnectionError("offline")
+        txid = await queue.announce(b"\x03" * 32)
+        self.assertEqual(self.broadcast_txs()[-1].id(), txid)
+        self.assertEqual(self.esplora.broadcast_tx.call_count, 3)
+
+    async def test_signal_that_fails_to_sign_is_dropped(self):
+        self.esplora.get_address_utxos.return_value = [{"txid": "aa" * 32, "vout": 0, "value": 500}]
+        queue = BeaconSignalQueue(self.make_beacon_manager(), self.state_path)
+        with self.assertRaisesRegex(Exception, "Insufficient funds"):
+            await queue.announce(b"\x01" * 32)
+        self.assertEqual(queue.signals, {})
+        self.assertEqual(BeaconSignalQueue(self.make_beacon_manager(), self.state_path).signals, {})
+
+        # Also when signed by the background task
+        queue.start()
+        try:
+            with self.assertRaisesRegex(Exception, "Insufficient funds"):
+                await queue.announce(b"\x02" * 32)
+        finally:
+            await queue.stop()
+        self.assertEqual(queue.signals, {})
+
+        # Once funded, only the next signal is broadcast
+        self.esplora.get_address_utxos.return_value = [
+            {"txid": "bb" * 32, "vout": 0, "value": 100000}
+        ]
+        queue.beacon_manager.refresh_utxos()
+        await queue.announce(b"\x03" * 32)
+        txs = self.broadcast_txs()
+        self.assertEqual(len(txs), 1)
+        self.assertEqual(txs[0].tx_outs[1].script_pubkey.commands[1], b"\x03" * 32)
+
+    async def test_stuck_chain_tip_replaced(self):
+        manager = BroadcastManager(self.esplora, "regtest", target_blocks=2)
+        queue = BeaconSignalQueue(self.beacon_manager, self.state_path, broadcast_manager=manager)
+        records = [queue.enqueue(bytes([index]) * 32) for index in range(2)]
+        self.assertEqual(await queue.publish(), 2)
+        first, second = self.broadcast_txs()
+
+        self.mine()
+        self.mine()
+        await queue.poll_confirmations()
+        # Only the last signal, as the first one's change is spent by it
+        replacement = self.broadcast_txs()[-1]
+        self.assertEqual(self.esplora.broadcast_tx.call_count, 3)
+        self.assertEqual(replacement.tx_ins[0].prev_tx, second.tx_ins[0].prev_tx)
+        self.assertLess(replacement.tx_outs[0].amount, second.tx_outs[0].amount)
+        self.assertEqual(records[1]["txid"], replacement.id())
+        self.assertEqual(queue.chain_tip.prev_tx, replacement.hash())
+        restarted = BeaconSignalQueue(self.make_beacon_manager(), self.state_path)
+        self.assertEqual(restarted.signals[records[1]["id"]]["txid"], replacement.id())
+
+        # The chain continues from the replacement's change
+        queue.enqueue(b"\x02" * 32)
+        await queue.publish()
+        self.assertEqual(self.broadcast_txs()[-1].tx_ins[0].prev_tx, replacement.hash())
+
+        self.mine(first.id(), replacement.id())
+        self.assertEqual(await queue.poll_confirmations(), records)
+
+    async def test_refresh_leaves_chain_tip_to_the_queue(self):
+        queue = BeaconSignalQueue(self.beacon_manager)
+        queue.enqueue(b"\x01" * 32)
+        await queue.publish()
+        tip = queue.chain_tip
+        self.esplora.get_address_utxos.return_value = [
+            {"txid": tip.prev_tx.hex(), "vout": 0, "value": tip.value()}
+        ]
+        self.beacon_manager.refresh_utxos()
+        self.assertEqual(len(self.beacon_manager.utxos), 0)
+
+    async def test_restart_rebroadcasts_signed_signals(self):
+        queue = BeaconSignalQueue(self.beacon_manager, self.state_path)
+        first = queue.enqueue(b"\x01" * 32)
+        await queue.publish()
+        # The network is unreachable while the second signal is published
+        self.esplora.broadcast_tx.side_effect = ConnectionError("offline")
+        self.esplora.get_transaction.side_effect = ConnectionError("offline")
+        second = queue.enqueue(b"\x02" * 32)
+        self.assertEqual(await queue.publish(), 0)
+        self.assertEqual(second["status"], SIGNED)
+
+        self.esplora = self.make_esplora()
+        restarted = BeaconSignalQueue(self.make_beacon_manager(), self.state_path)
+        self.assertEqual(
+            [record["status"] for record in restarted.signals.values()], [BROADCAST, SIGNED]
+        )
+        self.assertEqual(await restarted.publish(), 1)
+        self.assertEqual(self.esplora.broadcast_tx.call_args.args[0], second["tx"])
+
+        # New signals continue the persisted chain rather than spending the funding UTXO again
+        restarted.enqueue(b"\x03" * 32)
+        await restarted.publish()
+        third = self.broadcast_txs()[-1]
+        self.assertEqual(third.tx_ins[0].prev_tx.hex(), second["txid"])
+        self.assertEqual(first["txid"], restarted.signals[first["id"]]["txid"])
+
+
+class BeaconSignalSchedulerTest(BeaconTestCase):
+    async def test_lanes_spend_independent_utxos(self):
+        scheduler = BeaconSignalScheduler(self.beacon_manager, lanes=3)
+        fan_out_txid = scheduler.prepare()
+        self.assertIsNotNone(fan_out_txid)
+        self.assertIsNone(scheduler.prepare())
+
+        txids = await asyncio.gather(*(scheduler.announce(bytes([i]) * 32) for i in range(6)))
+        self.assertEqual(len(set(txids)), 6)
+        signals = self.broadcast_txs()[1:]
+        roots = [tx.tx_ins[0].prev_tx.hex() for tx in signals]
+        self.assertEqual(roots.count(fan_out_txid), 3)
+        self.assertEqual([len(lane.signals) for lane in scheduler.lanes], [2, 2, 2])
+        # Each lane reports its own signals
+        for lane in range(3):
+            labels = (self.beacon_manager.beacon_id, str(lane), BROADCAST)
+            self.assertEqual(SIGNALS_IN_FLIGHT.value(labels), 2)
+
+        self.mine(*txids)
+        self.assertEqual(len(await scheduler.poll_confirmations()), 6)
+
+    def test_lanes_get_utxos_large_enough_for_a_signal(self):
+        # Shares of 3200 satoshis would pay for a one-output transaction, but not a signal
+        self.esplora.get_address_utxos.return_value = [
+            {"txid": "aa" * 32, "vout": 0, "value": 13040}
+        ]
+        scheduler = BeaconSignalScheduler(self.make_beacon_manager(), lanes=3)
+        with self.assertRaisesRegex(Exception, "Insufficient funds"):
+            scheduler.prepare()
+        self.esplora.broadcast_tx.assert_not_called()
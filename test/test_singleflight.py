@@ -0,0 +1,79 @@
+import asyncio
+import threading
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from libbtcr2.singleflight import AsyncSingleFlight, SingleFlight
+
+
+class SingleFlightTest(TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        group = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(2)
+            return "body"
+
+        threads = [
+            threading.Thread(target=lambda: results.append(group.do("tx/abc/hex", fetch)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        while group.in_flight() == 0:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join(2)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["body"] * 5)
+        self.assertEqual(group.in_flight(), 0)
+
+    def test_exception_is_shared_and_forgotten(self):
+        group = SingleFlight()
+
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            group.do("key", fail)
+        self.assertEqual(group.do("key", lambda: "ok"), "ok")
+
+
+class AsyncSingleFlightTest(IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_one_task(self):
+        group = AsyncSingleFlight()
+        calls = []
+
+        async def traverse(identifier):
+            calls.append(identifier)
+            await asyncio.sleep(0.01)
+            return {"id": identifier}
+
+        results = await asyncio.gather(*(group.do("did", traverse, "did") for _ in range(10)))
+
+        self.assertEqual(calls, ["did"])
+        self.assertEqual(results, [{"id": "did"}] * 10)
+        self.assertEqual(group.in_flight(), 0)
+
+    async def test_cancelling_one_caller_keeps_shared_task(self):
+        group = AsyncSingleFlight()
+        started = asyncio.Event()
+
+        async def traverse():
+            started.set()
+            await asyncio.sleep(0.02)
+            return "done"
+
+        first = asyncio.create_task(group.do("did", traverse))
+        second = asyncio.create_task(group.do("did", traverse))
+        await started.wait()
+        first.cancel()
+
+        self.assertEqual(await second, "done")
+        with self.assertRaises(asyncio.CancelledError):
+            await first
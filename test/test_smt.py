@@ -0,0 +1,123 @@
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+import jcs
+from buidl.helper import sha256
+
+from libbtcr2.constants import SMT_AGGREGATE_BEACON_TYPE
+from libbtcr2.network_config import REGTEST
+from libbtcr2.resolver import Btcr2Resolver
+from libbtcr2.sidecar import SidecarIndex
+from libbtcr2.smt import EMPTY_HASHES, SMT_DEPTH, SMTVerifier, SparseMerkleTree, hash_pair
+
+DIDS = [f"did:btcr2:k1test{i}" for i in range(20)]
+
+
+def build_tree(updates):
+    tree = SparseMerkleTree()
+    for did in DIDS:
+        tree.set(did, os.urandom(32), updates.get(did))
+    return tree
+
+
+class SparseMerkleTreeTest(TestCase):
+    def test_empty_subtree_hashes(self):
+        self.assertEqual(len(EMPTY_HASHES), SMT_DEPTH + 1)
+        self.assertEqual(EMPTY_HASHES[1], hash_pair(bytes(32), bytes(32)))
+        self.assertEqual(SparseMerkleTree().root(), EMPTY_HASHES[SMT_DEPTH])
+
+    def test_inclusion_and_non_inclusion(self):
+        update_hash = sha256(b"update")
+        tree = build_tree({DIDS[0]: update_hash})
+        verifier = SMTVerifier(tree.root())
+        self.assertEqual(verifier.verify(DIDS[0], tree.proof(DIDS[0])), update_hash)
+        self.assertIsNone(verifier.verify(DIDS[1], tree.proof(DIDS[1])))
+        # A DID with no leaf at all is proven absent by an empty leaf
+        self.assertIsNone(verifier.verify("did:btcr2:k1absent", tree.proof("did:btcr2:k1absent")))
+
+    def test_invalid_proofs_rejected(self):
+        tree = build_tree({DIDS[0]: sha256(b"update")})
+        verifier = SMTVerifier(tree.root())
+        proof = tree.proof(DIDS[0])
+        forged = dict(proof, updateId=sha256(b"other").hex())
+        with self.assertRaisesRegex(Exception, "InvalidSMTProof"):
+            verifier.verify(DIDS[0], forged)
+        # Proof for another DID's leaf
+        with self.assertRaisesRegex(Exception, "InvalidSMTProof"):
+            verifier.verify(DIDS[1], proof)
+        with self.assertRaisesRegex(Exception, "InvalidSMTProof"):
+            verifier.verify(DIDS[0], dict(proof, hashes=proof["hashes"][:-1]))
+        # Dropping the update from an inclusion proof does not prove non-inclusion
+        without_update = {key: value for key, value in proof.items() if key != "updateId"}
+        with self.assertRaisesRegex(Exception, "InvalidSMTProof"):
+            verifier.verify(DIDS[0], without_update)
+
+    def test_verified_nodes_memoized(self):
+        tree = build_tree({DIDS[0]: sha256(b"update")})
+        verifier = SMTVerifier(tree.root())
+        verifier.verify(DIDS[0], tree.proof(DIDS[0]))
+        self.assertEqual(len(verifier.verified), 256)
+        # Verifying again stops at the first memoized node without hashing
+        with patch("libbtcr2.smt.hash_pair", wraps=hash_pair) as hashed:
+            self.assertEqual(verifier.verify(DIDS[0], tree.proof(DIDS[0])), sha256(b"update"))
+            self.assertEqual(hashed.call_count, 0)
+            # Another DID's path hashes only up to where it meets a memoized node
+            self.assertIsNone(verifier.verify(DIDS[1], tree.proof(DIDS[1])))
+            self.assertLess(hashed.call_count, 256)
+        # A memoized node is not reused for different children
+        forged = dict(tree.proof(DIDS[0]), updateId=sha256(b"other").hex())
+        with self.assertRaisesRegex(Exception, "InvalidSMTProof"):
+            verifier.verify(DIDS[0], forged)
+
+
+class SMTBeaconSignalTest(TestCase):
+    def setUp(self):
+        self.resolver = Btcr2Resolver({"regtest": REGTEST})
+        self.update = {
+            "targetVersionId": 2,
+            "sourceHash": "source",
+            "targetHash": "target",
+            "patch": [],
+            "proof": {"capability": "urn:zcap:root:did", "verificationMethod": "did#key"},
+        }
+        self.update_hash = sha256(jcs.canonicalize(self.update))
+        self.tree = build_tree({DIDS[0]: self.update_hash})
+
+    def signal(self):
+        return {
+            "beaconType": SMT_AGGREGATE_BEACON_TYPE,
+            "txid": "ab" * 32,
+            "signalHash": self.tree.root(),
+        }
+
+    def sidecar(self, did, include_payload=True):
+        metadata = {"smtProof": self.tree.proof(did)}
+        if include_payload:
+            metadata["updatePayload"] = self.update
+        return SidecarIndex({"signalsMetadata": {"ab" * 32: metadata}})
+
+    def test_included_update(self):
+        updates = self.resolver.process_beacon_signals(
+            [self.signal()], self.sidecar(DIDS[0]), DIDS[0]
+        )
+        self.assertEqual(updates, [(self.update, self.update_hash)])
+        # The verifier for the root is shared between resolutions
+        self.assertIs(
+            self.resolver.smt_verifier(self.tree.root()),
+            self.resolver.smt_verifier(self.tree.root()),
+        )
+
+    def test_not_included(self):
+        sidecar = self.sidecar(DIDS[1], include_payload=False)
+        self.assertEqual(
+            self.resolver.process_beacon_signals([self.signal()], sidecar, DIDS[1]), []
+        )
+
+    def test_missing_proof_or_payload(self):
+        with self.assertRaisesRegex(Exception, "SMT proof"):
+            self.resolver.process_beacon_signals([self.signal()], SidecarIndex(), DIDS[0])
+        with self.assertRaisesRegex(Exception, "not found"):
+            self.resolver.process_beacon_signals(
+                [self.signal()], self.sidecar(DIDS[0], include_payload=False), DIDS[0]
+            )
@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+from unittest import TestCase
+from unittest.mock import patch
+
+from libbtcr2.esplora_client import EsploraClient
+from libbtcr2.resolver import Btcr2Resolver
+from libbtcr2.tracing import NOOP_SPAN, set_tracer, start_span
+
+from .helpers import make_response
+
+
+class RecordingSpan:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes or {})
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+class RecordingTracer:
+    def __init__(self):
+        self.spans = []
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None, **kwargs):
+        span = RecordingSpan(name, attributes)
+        self.spans.append(span)
+        yield span
+
+
+class TracingTest(TestCase):
+    def tearDown(self):
+        set_tracer(None)
+
+    def test_disabled_by_default(self):
+        with start_span("btcr2.resolve", {"btcr2.did": "did:btcr2:k1abc"}) as span:
+            self.assertIs(span, NOOP_SPAN)
+            self.assertFalse(span.is_recording())
+
+    def test_explicit_tracer_takes_precedence(self):
+        global_tracer, tracer = RecordingTracer(), RecordingTracer()
+        set_tracer(global_tracer)
+        with start_span("btcr2.resolve", tracer=tracer):
+            pass
+        self.assertEqual([span.name for span in tracer.spans], ["btcr2.resolve"])
+        self.assertEqual(global_tracer.spans, [])
+
+    def test_esplora_requests_are_traced(self):
+        tracer = RecordingTracer()
+        set_tracer(tracer)
+        client = EsploraClient("http://esplora")
+        with patch.object(client.session, "request", return_value=make_response(200, b"ab")):
+            client.get_transaction_hex("abc")
+
+        (span,) = tracer.spans
+        self.assertEqual(span.name, "esplora.request")
+        self.assertEqual(span.attributes["esplora.route"], "tx/:txid/hex")
+        self.assertEqual(span.attributes["http.status_code"], 200)
+
+    def test_esplora_client_uses_its_own_tracer(self):
+        global_tracer, tracer = RecordingTracer(), RecordingTracer()
+        set_tracer(global_tracer)
+        resolver = Btcr2Resolver({"regtest": {"esplora_api": "http://esplora"}}, tracer=tracer)
+        client = resolver.networks["regtest"]["esplora_client"]
+        with patch.object(client.session, "request", return_value=make_response(200, b"ab")):
+            client.get_transaction_hex("abc")
+
+        self.assertEqual([span.name for span in tracer.spans], ["esplora.request"])
+        self.assertEqual(global_tracer.spans, [])
@@ -0,0 +1,95 @@
+from unittest import TestCase
+
+from buidl.tx import TxIn
+
+from libbtcr2.utxo_pool import CONFIRMED, RESERVED, UNCONFIRMED, UTXOPool, outpoint
+
+
+def utxo(index, value):
+    tx_in = TxIn(prev_tx=bytes([index]) * 32, prev_index=index % 3)
+    tx_in._value = value
+    return tx_in
+
+
+class UTXOPoolTest(TestCase):
+    def setUp(self):
+        self.pool = UTXOPool()
+        self.utxos = [utxo(i, value) for i, value in enumerate([5000, 1000, 3000, 8000])]
+        for tx_in in self.utxos:
+            self.pool.add(tx_in)
+        self.change = utxo(9, 2000)
+        self.pool.add(self.change, confirmed=False)
+
+    def test_indexed_by_outpoint_and_value(self):
+        self.assertEqual(len(self.pool), 5)
+        self.assertIs(self.pool.get(outpoint(self.utxos[2])), self.utxos[2])
+        values = [value for value, _ in self.pool.candidates()]
+        self.assertEqual(values, [1000, 2000, 3000, 5000, 8000])
+        self.assertEqual(self.pool.total_value(include_unconfirmed=False), 17000)
+        self.assertEqual(self.pool.state(outpoint(self.change)), UNCONFIRMED)
+
+    def test_take_prefers_smallest_confirmed(self):
+        self.assertIs(self.pool.take(1500), self.utxos[2])
+        self.assertIs(self.pool.take(9000), None)
+        self.assertIs(self.pool.take(8000), self.utxos[3])
+        # Confirmed UTXOs go first, even when larger
+        self.assertIs(self.pool.take(1500), self.utxos[0])
+        self.assertIs(self.pool.take(1500), self.change)
+        self.assertIsNone(self.pool.take(1500, include_unconfirmed=False))
+        self.assertEqual(len(self.pool), 1)
+
+    def test_reserve_and_release(self):
+        keys = [outpoint(self.utxos[0]), outpoint(self.change)]
+        self.assertEqual(self.pool.reserve(keys), [self.utxos[0], self.change])
+        self.assertEqual(self.pool.state(keys[0]), RESERVED)
+        self.assertEqual(self.pool.available(), 3)
+        with self.assertRaisesRegex(Exception, "not available"):
+            self.pool.reserve(keys[:1])
+        # Nothing is reserved when any UTXO is unavailable
+        key = outpoint(self.utxos[1])
+        with self.assertRaisesRegex(Exception, "not available"):
+            self.pool.reserve([key, keys[0]])
+        self.assertEqual(self.pool.state(key), CONFIRMED)
+        with self.assertRaisesRegex(Exception, "twice"):
+            self.pool.reserve([key, key])
+        self.assertEqual(self.pool.available(), 3)
+
+        self.pool.mark_confirmed(keys[1])
+        self.pool.release(keys)
+        self.assertEqual(self.pool.state(keys[1]), CONFIRMED)
+        self.assertEqual(self.pool.available(include_unconfirmed=False), 5)
+
+    def test_remove_and_clear(self):
+        key = outpoint(self.utxos[1])
+        self.assertIs(self.pool.remove(key), self.utxos[1])
+        self.assertIsNone(self.pool.remove(key))
+        self.pool.reserve([outpoint(self.utxos[0])])
+        self.pool.clear(keep_reserved=True)
+        self.assertEqual(list(self.pool), [self.utxos[0]])
+        self.assertEqual(self.pool.candidates(), [])
+
+    def test_replace_leaves_out_removed_utxos(self):
+        reserved, taken, spent = (outpoint(tx_in) for tx_in in self.utxos[:3])
+        self.pool.reserve([reserved])
+        self.assertIs(self.pool.take(1000), self.utxos[1])
+        self.pool.remove(spent)
+        # A chain tip kept by its owner, never tracked by the pool
+        tip = utxo(7, 4000)
+        self.pool.remove(outpoint(tip))
+
+        # The listing does not show the taken and removed UTXOs spent yet
+        listing = [(tx_in, True) for tx_in in self.utxos] + [(tip, False), (utxo(8, 6000), True)]
+        self.pool.replace(listing)
+        self.assertEqual(sorted(value for value, _ in self.pool.candidates()), [6000, 8000])
+        self.assertEqual(self.pool.state(reserved), RESERVED)
+
+        # Once they are seen spent they are forgotten; a later listing may add them again
+        self.pool.replace([(tx_in, True) for tx_in in self.utxos[3:]])
+        self.pool.replace([(self.utxos[1], True)])
+        self.assertEqual([value for value, _ in self.pool.candidates()], [1000])
+
+        # Handing a removed UTXO back makes it selectable again
+        self.pool.remove(outpoint(tip))
+        self.pool.add(tip, confirmed=False)
+        self.pool.replace([(tip, False)])
+        self.assertEqual(self.pool.state(outpoint(tip)), UNCONFIRMED)
@@ -0,0 +1,32 @@
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from libbtcr2.vector_writer import VectorWriter
+
+
+class VectorWriterTest(TestCase):
+    def test_writes_json_and_text(self):
+        with tempfile.TemporaryDirectory() as folder:
+            writer = VectorWriter()
+            block_folder = f"{folder}/regtest/k1abc/block101"
+            writer.write_json(f"{block_folder}/updates.json", [{"targetVersionId": 2}])
+            writer.write_text(f"{block_folder}/update_hash_hex.txt", lambda: "ab" * 32)
+            writer.flush()
+
+            with open(f"{block_folder}/updates.json") as f:
+                self.assertEqual(json.load(f), [{"targetVersionId": 2}])
+            with open(f"{block_folder}/update_hash_hex.txt") as f:
+                self.assertEqual(f.read(), "ab" * 32)
+
+    def test_compressed_output(self):
+        with tempfile.TemporaryDirectory() as folder:
+            writer = VectorWriter(compress=True)
+            writer.write_text(f"{folder}/canonical_document.txt", "{}")
+            writer.flush()
+
+            self.assertFalse(os.path.exists(f"{folder}/canonical_document.txt"))
+            with gzip.open(f"{folder}/canonical_document.txt.gz", "rt") as f:
+                self.assertEqual(f.read(), "{}")
@@ -0,0 +1,56 @@
+from unittest import TestCase
+
+from libbtcr2.version_history import VersionHistory
+
+
+class Document:
+    def __init__(self, data):
+        self.data = data
+
+    def serialize(self):
+        return dict(self.data)
+
+
+class VersionHistoryTest(TestCase):
+    def setUp(self):
+        self.history = VersionHistory("did:btcr2:k1abc", "regtest", Document({}), 4)
+        # Version n sets "counter" to n; block times are not monotonic
+        block_times = [100, 90, 200, 300, 250, 400, 500, 600, 700]
+        for version_id, block_time in enumerate(block_times, start=2):
+            update = {
+                "patch": [{"op": "add", "path": "/counter", "value": {"n": version_id}}],
+                "targetHash": f"hash{version_id}",
+            }
+            self.history.append(
+                version_id,
+                version_id * 10,
+                block_time,
+                update,
+                bytes([version_id]),
+                Document({"counter": {"n": version_id}}),
+            )
+
+    def test_documents_rebuilt_from_checkpoints(self):
+        self.assertEqual(sorted(self.history.checkpoints), [1, 4, 8])
+        self.assertEqual(self.history.document(1), {})
+        for version_id in range(2, 11):
+            self.assertEqual(self.history.document(version_id), {"counter": {"n": version_id}})
+
+    def test_documents_do_not_share_patch_values(self):
+        self.history.document(3)["counter"]["n"] = "changed"
+        self.assertEqual(self.history.document(3), {"counter": {"n": 3}})
+
+    def test_find_by_version_time(self):
+        self.assertEqual(self.history.find(version_time=50)["versionId"], 1)
+        self.assertEqual(self.history.find(version_time=100)["versionId"], 3)
+        # Version 6 (block time 250) comes after version 5 (block time 300)
+        self.assertEqual(self.history.find(version_time=260)["versionId"], 4)
+        self.assertEqual(self.history.find(version_time=10**10)["versionId"], 10)
+
+    def test_resolve(self):
+        result = self.history.resolve(version_id=6)
+        self.assertEqual(result["didDocument"], {"counter": {"n": 6}})
+        self.assertEqual(result["didDocumentMetadata"]["version"], 6)
+        self.assertEqual(self.history.resolve()["didDocumentMetadata"]["version"], 10)
+        with self.assertRaisesRegex(Exception, "Unknown version"):
+            self.history.find(version_id=11)